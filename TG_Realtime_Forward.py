@@ -12,16 +12,30 @@ TG Realtime Forward - Telegram实时消息转发工具
 - 完整的错误处理和日志记录
 """
 
+import array
 import asyncio
+import atexit
+import bisect
 import json
 import os
 import re
 import hashlib
+import heapq
+import mmap
+import sqlite3
+import struct
+import threading
 import time
 import logging
+import logging.handlers
+import queue
+import signal
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime
 from typing import Dict, List, Optional, Set, Tuple
-from telethon import TelegramClient, errors, events
+from telethon import TelegramClient, errors, events, utils
+from telethon.tl import types
 from telethon.tl.types import Message, MessageMediaPhoto, MessageMediaDocument
 
 # ============ 配置类 ============
@@ -46,6 +60,13 @@ class Config:
     preset_source_channels = []  # 源频道列表，支持ID、用户名、链接
     preset_target_channel = -100123456789  # 目标频道ID
     
+    # 路由表：每个源频道可转发到多个目标，每个目标使用自己的过滤配置和去重范围
+    # 为空时使用 preset_source_channels -> preset_target_channel（全局去重范围）
+    # 格式: [{"sources": [...], "targets": [-100..., {"target": -100..., "filter": "名称", "dedup_scope": "名称"}]}]
+    # 省略 dedup_scope 时每个目标单独去重，"global" 表示与未配置路由时共用去重历史
+    routes = []
+    filter_profiles = {}  # 过滤配置名称 -> 覆盖的过滤参数，如 {"strict": {"min_message_length": 20}}
+    
     # 实时转发配置
     enable_realtime_forward = True  # 是否启用实时转发
     forward_only_new_messages = True  # 只转发新消息，不处理历史消息
@@ -53,6 +74,8 @@ class Config:
     health_check_interval = 300  # 健康检查间隔（秒）
     max_reconnect_attempts = 10  # 最大重连尝试次数
     reconnect_delay = 60  # 重连延迟（秒）
+    client_start_timeout = 30  # 单个账号启动超时（秒），超时的账号暂时停用并在后台重试
+    client_start_retry_interval = 60  # 启动失败账号的后台重试间隔（秒）
     
     # 账号轮换配置
     enable_account_rotation = True  # 是否启用账号轮换
@@ -60,15 +83,85 @@ class Config:
     account_delay = 5  # 账号切换延迟（秒）
     enable_smart_account_switch = True  # 是否启用智能账号切换
     
+    # 处理队列配置
+    message_queue_size = 1000  # 待处理消息队列上限，队列满时丢弃新消息
+    worker_count = 3  # 并发处理消息的工作协程数量
+    
     # 转发延迟配置
     delay_single = 2  # 单条消息延迟（秒）
-    delay_group = 4  # 相册延迟（秒）
+    delay_group = 4  # 相册延迟（秒），相册按 delay_group/delay_single 倍消耗发送令牌
+    enable_album_forward = True  # 相册整体过滤、去重并在一次请求中转发
+    
+    # 批量转发配置
+    forward_batch_window = 1.0  # 同一来源通过过滤的消息合并等待时间（秒），0表示不合并
+    forward_batch_max_messages = 50  # 单次 forward_messages 请求最多包含的消息数（上限100）
+    
+    # 发送限流配置（每个账号一个令牌桶）
+    send_rate_per_account = None  # 持续发送速率（次/秒），None表示按 1/delay_single 计算
+    send_burst_per_account = 5  # 令牌桶容量：账号空闲后允许连续发送的次数
+    
+    # 发送账号池配置
+    enable_sender_pool = True  # 所有可用账号并发发送，关闭时使用当前账号并按 rotation_interval 轮换
+    max_inflight_per_account = 2  # 每个账号同时进行中的转发请求上限
+    flood_sleep_threshold = 0  # FloodWait 不超过该秒数时由 Telethon 原地等待，超过则标记账号受限并换账号重试
+    no_access_retry_interval = 600  # 账号无法访问频道（如禁止写入）后，多少秒后再尝试用其发送
+    
+    # 频道实体缓存配置
+    entity_cache_file = "entity_cache.json"  # 按账号保存频道ID和access_hash，热启动时无需联网解析
+    entity_resolve_concurrency = 5  # 启动时并发解析频道的数量上限
+    entity_cache_ttl = 7 * 86400  # 缓存超过该秒数后在后台重新验证，0表示不重新验证
+    
+    # 后台持久化配置
+    persist_flush_interval = 0.5  # 文件修改后最长等待多少秒在后台线程中写入
+    persist_flush_max_records = 200  # 累计多少条记录后立即写入
+    
+    # 指标监控配置
+    enable_metrics = True  # 在本地提供 Prometheus 格式的 /metrics 接口
+    metrics_host = "127.0.0.1"  # 监听地址，仅本机访问
+    metrics_port = 9108  # 监听端口
+    
+    # 事件录制配置
+    event_capture_file = None  # 将收到的源频道消息录制到该 JSONL 文件，供 benchmark.py replay 回放，None表示不录制
     
     # 文件配置
     forward_history_file = "forward_history.json"  # 转发历史记录文件
     dedup_history_file = "dedup_history.json"  # 去重历史记录文件
     log_file = "tg_realtime_forward.log"  # 日志文件
     
+    # 日志配置
+    log_level = "INFO"  # 日志级别，调试时改为 "DEBUG"
+    log_rotation = "size"  # 日志轮转方式: "size"（按大小）或 "time"（按时间）
+    log_max_bytes = 10 * 1024 * 1024  # 按大小轮转时单个日志文件上限（字节）
+    log_rotate_when = "midnight"  # 按时间轮转的周期，取值同 TimedRotatingFileHandler 的 when
+    log_backup_count = 7  # 保留的历史日志文件数
+    log_sample_limit = 20  # 同类高频日志（如过滤消息）每个周期最多输出条数，0表示不限制
+    log_sample_interval = 60  # 高频日志采样周期（秒）
+    
+    # 转发历史存储配置
+    forward_history_backend = "sqlite"  # 存储后端: "sqlite" 或 "json"
+    forward_history_db = "forward_history.db"  # SQLite数据库文件
+    history_commit_batch_size = 50  # SQLite每累计多少条记录提交一次
+    history_commit_interval = 5  # SQLite最长提交间隔（秒）
+    
+    # 断线补发配置
+    enable_gap_backfill = True  # 启动和重连后补发每个源频道在断线期间遗漏的消息
+    backfill_rate = 5  # 补发速率上限（条/秒），避免挤占实时消息
+    backfill_max_messages = 1000  # 每个源频道单次最多补发的消息数，None表示不限制
+    
+    # 去重历史存储配置
+    dedup_storage_mode = "journal"  # 存储模式: "journal"（快照+追加日志）、"binary"（紧凑二进制表）或 "json"（每条重写）
+    dedup_digest_file = "dedup_history.bin"  # binary模式的摘要表文件
+    dedup_compact_interval = 600  # 日志压缩间隔（秒）
+    dedup_compact_threshold = 5000  # 日志累计多少条后提前压缩
+    dedup_retention_days = 30  # 去重历史保留天数，None表示永久保留
+    dedup_max_entries = 500000  # 去重历史最大条数，None表示不限制
+    
+    # 近似重复检测配置（只针对纯文本消息）
+    enable_near_duplicate = False  # 用 MinHash 识别只差链接、表情或签名的重复文本，保留期和条数上限与去重历史一致
+    near_duplicate_threshold = 0.8  # 估计的 Jaccard 相似度不低于该值视为重复，越小越宽松
+    near_duplicate_min_length = 20  # 去掉链接和符号后短于该长度的文本只做精确去重
+    near_duplicate_file = "dedup_minhash.bin"  # MinHash 签名快照文件（另有 .journal 追加日志）
+    
     # 广告过滤配置
     enable_ad_filter = True
     ad_keywords = [
@@ -77,6 +170,10 @@ class Config:
         "入款", "出款", "返水", "彩金", "资金保障", "提款"
     ]
     
+    # 广告正则模式，可写成 (正则, 角色) 指定用途：
+    #   "count_links" - 统计链接数量，超过 max_links_per_message 时判定为广告
+    #   "reject"      - 只要匹配即判定为广告
+    # 只写正则时，链接正则默认为 "count_links"，其余为 "reject"
     ad_patterns = [
         r'https?://[^\s]+',  # 链接
         r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}',  # 邮箱
@@ -107,19 +204,78 @@ class Config:
     # 内容去重配置
     enable_content_deduplication = True
     target_channel_scan_limit = None  # 目标频道扫描范围，None表示扫描所有
+    enable_target_scan = True  # 启动后在后台扫描目标频道已有消息，写入去重历史
+    scan_checkpoint_file = "scan_checkpoint.json"  # 扫描进度，中断后从上次位置继续
+    scan_batch_size = 500  # 每扫描多少条消息批量写入去重历史并保存进度
     verbose_dedup_logging = False  # 是否显示详细的去重日志
 
 # ============ 日志配置 ============
+class SamplingFilter(logging.Filter):
+    """按类别限制高频日志的输出条数
+    
+    带 category 属性的日志（通过 extra={"category": ...} 传入）每个周期最多
+    输出 log_sample_limit 条，其余丢弃；下一个周期的第一条日志附带上个周期
+    省略的条数。不带类别的日志不受影响。
+    """
+    
+    def __init__(self, limit, interval):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.windows = {}  # 类别 -> [周期开始时间, 已输出条数, 已省略条数]
+        self.lock = threading.Lock()
+    
+    def filter(self, record):
+        category = getattr(record, "category", None)
+        if category is None or not self.limit:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(category)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self.windows[category] = [now, 1, 0]
+                if suppressed:
+                    record.msg = f"{record.getMessage()}（过去 {self.interval} 秒省略同类日志 {suppressed} 条）"
+                    record.args = None
+                return True
+            if window[1] < self.limit:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
 def setup_logging():
-    """设置日志系统"""
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(Config.log_file, encoding='utf-8'),
-            logging.StreamHandler()
-        ]
+    """设置日志系统：日志先放入队列，由后台线程写入轮转文件和终端"""
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if Config.log_rotation == "time":
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            Config.log_file, when=Config.log_rotate_when,
+            backupCount=Config.log_backup_count, encoding='utf-8'
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            Config.log_file, maxBytes=Config.log_max_bytes,
+            backupCount=Config.log_backup_count, encoding='utf-8'
+        )
+    stream_handler = logging.StreamHandler()
+    file_handler.setFormatter(formatter)
+    stream_handler.setFormatter(formatter)
+    
+    # 事件循环中只把日志记录放入队列，磁盘和终端I/O在监听线程中进行
+    log_queue = queue.Queue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(Config.log_sample_limit, Config.log_sample_interval))
+    listener = logging.handlers.QueueListener(
+        log_queue, file_handler, stream_handler, respect_handler_level=True
     )
+    listener.start()
+    # 退出时写完队列中剩余的日志
+    atexit.register(listener.stop)
+    
+    root = logging.getLogger()
+    root.setLevel(Config.log_level)
+    root.addHandler(queue_handler)
     return logging.getLogger('TG_Realtime_Forward')
 
 logger = setup_logging()
@@ -153,13 +309,651 @@ def get_channel_name(entity):
     """安全地获取频道名称"""
     return getattr(entity, 'title', None) or getattr(entity, 'name', None) or "未知频道"
 
+def scoped_file(path, scope):
+    """为指定范围生成独立的文件名，如 dedup_history.json -> dedup_history.news.json"""
+    if not scope:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{scope}{ext}"
+
+def describe_messages(messages):
+    """生成消息或相册的日志描述"""
+    if len(messages) == 1:
+        return str(messages[0].id)
+    return f"相册 {messages[0].id}-{messages[-1].id}（{len(messages)}条）"
+
+def write_file_atomic(path, data):
+    """先写临时文件并同步到磁盘，再替换目标文件，崩溃时不会留下写了一半的文件"""
+    tmp_file = f"{path}.tmp"
+    mode = "wb" if isinstance(data, bytes) else "w"
+    encoding = None if isinstance(data, bytes) else "utf-8"
+    with open(tmp_file, mode, encoding=encoding) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+# ============ 限流器 ============
+class TokenBucket:
+    """令牌桶限流器
+    
+    令牌按 rate 个/秒补充，最多累积 capacity 个。发送前先预扣令牌，
+    令牌不足时只等待欠缺部分对应的时间，并发调用者按到达顺序排队。
+    """
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.total_wait = 0.0
+        self.wait_count = 0
+    
+    def refill(self):
+        """按经过的时间补充令牌"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    async def acquire(self, tokens=1):
+        """获取令牌，令牌不足时等待"""
+        self.refill()
+        self.tokens -= tokens
+        if self.tokens < 0:
+            wait = -self.tokens / self.rate
+            self.total_wait += wait
+            self.wait_count += 1
+            await asyncio.sleep(wait)
+    
+    def available(self):
+        """当前可用令牌数（预扣后可能为负）"""
+        self.refill()
+        return self.tokens
+    
+    def get_state(self):
+        """获取令牌桶状态"""
+        self.refill()
+        return {
+            "tokens": round(self.tokens, 2),
+            "capacity": self.capacity,
+            "rate": self.rate,
+            "wait_count": self.wait_count,
+            "total_wait": round(self.total_wait, 2),
+        }
+
+def create_rate_limiter():
+    """按配置创建账号的令牌桶"""
+    rate = Config.send_rate_per_account
+    if not rate:
+        rate = 1 / Config.delay_single if Config.delay_single > 0 else 1000
+    return TokenBucket(rate, max(1, Config.send_burst_per_account))
+
+# ============ 指标监控 ============
+class Histogram:
+    """Prometheus 直方图：按桶上界统计观测次数，并记录总和与总数"""
+    
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value):
+        """记录一次观测值"""
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """进程内指标注册表，以 Prometheus 文本格式通过本地HTTP接口输出
+    
+    计数器和直方图由处理流程直接更新；队列深度、账号状态等即时值
+    由采集函数在每次抓取时刷新，平时不产生额外开销。
+    """
+    
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    
+    # 指标名称 -> (类型, 说明)
+    DEFINITIONS = {
+        "tg_forward_received_total": ("counter", "Messages received from source channels"),
+        "tg_forward_dropped_total": ("counter", "Messages dropped because the processing queue was full"),
+        "tg_forward_filtered_total": ("counter", "Messages skipped per target, by reason"),
+        "tg_forward_forwarded_total": ("counter", "Messages forwarded to target channels"),
+        "tg_forward_failed_total": ("counter", "Messages that failed to forward"),
+        "tg_forward_stage_seconds": ("histogram", "Latency of pipeline stages in seconds"),
+        "tg_forward_queue_depth": ("gauge", "Units waiting in the processing queue"),
+        "tg_forward_event_loop_lag_seconds": ("gauge", "Event loop scheduling delay in seconds"),
+        "tg_forward_account_flood_waits_total": ("counter", "FloodWait errors received per account"),
+        "tg_forward_account_flood_wait_seconds_total": ("counter", "FloodWait seconds received per account"),
+        "tg_forward_account_blocked_seconds": ("gauge", "Remaining FloodWait block per account in seconds"),
+        "tg_forward_account_inflight": ("gauge", "Forward requests in progress per account"),
+        "tg_forward_persist_flushes_total": ("counter", "Background persistence flushes"),
+        "tg_forward_persist_records_total": ("counter", "Records written by background persistence flushes"),
+        "tg_forward_persist_pending": ("gauge", "Files waiting for the background writer"),
+        "tg_forward_persist_flush_seconds": ("gauge", "Background persistence flush latency in seconds"),
+    }
+    
+    def __init__(self):
+        self.values = {}  # (指标名称, 标签) -> 数值，计数器和即时值共用
+        self.histograms = {}  # (指标名称, 标签) -> Histogram
+        self.collectors = []  # 抓取前调用的采集函数
+        self.server = None
+        self.lag_task = None
+    
+    @staticmethod
+    def label_key(labels):
+        return tuple(sorted(labels.items()))
+    
+    def inc(self, name, value=1, **labels):
+        """计数器增加"""
+        key = (name, self.label_key(labels))
+        self.values[key] = self.values.get(key, 0) + value
+    
+    def set(self, name, value, **labels):
+        """设置即时值"""
+        self.values[(name, self.label_key(labels))] = value
+    
+    def observe(self, name, value, **labels):
+        """记录一次耗时观测"""
+        key = (name, self.label_key(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.LATENCY_BUCKETS)
+        histogram.observe(value)
+    
+    @contextmanager
+    def timer(self, name, **labels):
+        """统计代码块耗时"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+    
+    def add_collector(self, collector):
+        """注册抓取前调用的采集函数"""
+        if collector not in self.collectors:
+            self.collectors.append(collector)
+    
+    @staticmethod
+    def format_labels(labels):
+        """格式化标签，转义反斜杠、引号和换行"""
+        if not labels:
+            return ""
+        pairs = []
+        for key, value in labels:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            pairs.append(f'{key}="{value}"')
+        return "{" + ",".join(pairs) + "}"
+    
+    def render(self):
+        """以 Prometheus 文本格式输出全部指标"""
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.debug(f"指标采集失败: {e}")
+        
+        series = {}
+        for (name, labels), value in sorted(self.values.items(), key=lambda item: str(item[0])):
+            series.setdefault(name, []).append(f"{name}{self.format_labels(labels)} {value}")
+        # 直方图按标签组输出，组内的桶按上界从小到大，+Inf 之后是 _sum 和 _count
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: str(item[0])):
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{self.format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{self.format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{name}_sum{self.format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{self.format_labels(labels)} {histogram.count}")
+        
+        output = []
+        for name in sorted(series):
+            metric_type, description = self.DEFINITIONS.get(name, ("untyped", name))
+            output.append(f"# HELP {name} {description}")
+            output.append(f"# TYPE {name} {metric_type}")
+            output.extend(series[name])
+        return "\n".join(output) + "\n"
+    
+    async def handle_request(self, reader, writer):
+        """处理一次HTTP请求，只支持 GET /metrics"""
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # 读取并忽略请求头
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status = "200 OK"
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+                body = self.render().encode("utf-8")
+            else:
+                status = "404 Not Found"
+                content_type = "text/plain; charset=utf-8"
+                body = b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f"指标请求处理失败: {e}")
+        finally:
+            writer.close()
+    
+    async def start(self, host, port):
+        """启动指标接口和事件循环延迟监测，端口被占用时只记录错误"""
+        try:
+            self.server = await asyncio.start_server(self.handle_request, host, port)
+        except OSError as e:
+            logger.error(f"❌ 指标接口启动失败 {host}:{port}: {e}")
+            return
+        self.lag_task = asyncio.create_task(self.monitor_event_loop_lag())
+        logger.info(f"📈 指标接口已启动: http://{host}:{port}/metrics")
+    
+    async def stop(self):
+        """关闭指标接口"""
+        if self.lag_task is not None:
+            self.lag_task.cancel()
+            self.lag_task = None
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+    
+    async def monitor_event_loop_lag(self, interval=1.0):
+        """定期测量 sleep 的实际超时时间，反映事件循环被阻塞的程度"""
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            self.set("tg_forward_event_loop_lag_seconds", max(0.0, time.monotonic() - started - interval))
+
+metrics = Metrics()
+
+# ============ 后台持久化 ============
+class PersistenceWriter:
+    """后台持久化线程
+    
+    调用方在事件循环中通过 schedule 登记待写入的目标和写入函数，同一目标
+    的多次修改合并为一次写入。写入线程在首次修改后等待 persist_flush_interval
+    秒，或累计 persist_flush_max_records 条记录后批量执行写入函数，写入函数
+    自行复制状态快照并原子写入文件。线程未启动时 schedule 直接同步写入。
+    """
+    
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = OrderedDict()  # 目标 -> [写入函数, 记录数, 首次修改时间]
+        self.pending_records = 0
+        self.thread = None
+        self.stopping = False
+        self.stats = {
+            "flushes": 0,
+            "records": 0,
+            "errors": 0,
+            "last_latency": 0.0,
+            "max_latency": 0.0,
+            "total_latency": 0.0,
+        }
+    
+    def start(self):
+        """启动写入线程"""
+        if self.thread is not None:
+            return
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name="persistence-writer", daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """写完全部待写入的目标后停止线程（会阻塞，可在线程池中调用）"""
+        if self.thread is None:
+            return
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join()
+        self.thread = None
+    
+    def schedule(self, key, write, records=1):
+        """登记一次修改，write 为在写入线程中执行的无参写入函数"""
+        if self.thread is None:
+            self.write_batch({key: [write, records, time.monotonic()]})
+            return
+        with self.condition:
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [write, records, time.monotonic()]
+            else:
+                entry[0] = write
+                entry[1] += records
+            self.pending_records += records
+            if self.pending_records >= Config.persist_flush_max_records or len(self.pending) == 1:
+                self.condition.notify()
+    
+    def run(self):
+        """写入线程主循环：等待到期或记录数达到上限后批量写入"""
+        while True:
+            with self.condition:
+                while True:
+                    if self.stopping or self.pending_records >= Config.persist_flush_max_records:
+                        break
+                    if self.pending:
+                        first_dirty = next(iter(self.pending.values()))[2]
+                        remaining = first_dirty + Config.persist_flush_interval - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+                    else:
+                        self.condition.wait()
+                if self.stopping and not self.pending:
+                    return
+                batch = self.pending
+                self.pending = OrderedDict()
+                self.pending_records = 0
+            self.write_batch(batch)
+    
+    def write_batch(self, batch):
+        """依次执行一批写入函数并记录耗时"""
+        started = time.perf_counter()
+        records = 0
+        for key, (write, count, _) in batch.items():
+            try:
+                write()
+                records += count
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"❌ 后台写入 {key} 失败: {e}")
+        latency = time.perf_counter() - started
+        stats = self.stats
+        stats["flushes"] += 1
+        stats["records"] += records
+        stats["last_latency"] = latency
+        stats["max_latency"] = max(stats["max_latency"], latency)
+        stats["total_latency"] += latency
+    
+    def get_stats(self):
+        """获取写入统计：写入次数、每次平均记录数和耗时"""
+        stats = self.stats
+        flushes = stats["flushes"]
+        return {
+            "flushes": flushes,
+            "records": stats["records"],
+            "errors": stats["errors"],
+            "pending": len(self.pending),
+            "records_per_flush": stats["records"] / flushes if flushes else 0.0,
+            "avg_latency": stats["total_latency"] / flushes if flushes else 0.0,
+            "last_latency": stats["last_latency"],
+            "max_latency": stats["max_latency"],
+        }
+
+persistence_writer = PersistenceWriter()
+# 未经停止流程退出时（例如启动阶段异常），解释器退出前仍写完待写入的数据
+atexit.register(persistence_writer.stop)
+
+# ============ 事件录制 ============
+class CapturedMessage:
+    """由录制记录还原的消息，只包含处理流程用到的字段"""
+    
+    MEDIA_FIELDS = ("photo", "document", "video", "audio")
+    
+    def __init__(self, record):
+        self.id = record["id"]
+        self.chat_id = record["chat_id"]
+        self.message = record.get("text")
+        self.grouped_id = record.get("grouped_id")
+        self.timestamp = record["timestamp"]
+        date = record.get("date")
+        self.date = datetime.fromtimestamp(date) if date is not None else None
+        self.media = self.build_media(record.get("media"), record.get("media_id"))
+    
+    @classmethod
+    def build_media(cls, kind, media_id):
+        """还原媒体对象，去重哈希按属性名和 ID 区分媒体"""
+        if kind is None:
+            return None
+        if kind in cls.MEDIA_FIELDS:
+            media = type("CapturedMedia", (), {})()
+            setattr(media, kind, type("CapturedFile", (), {"id": media_id})())
+            return media
+        # 其他媒体只按类型名参与哈希
+        return type(kind, (), {})()
+
+class EventRecorder:
+    """将收到的源频道消息录制为 JSONL 文件，供 benchmark.py replay 离线回放
+    
+    每条消息一行，只保存处理流程用到的字段：ID、chat_id、文本、媒体类型和ID、
+    grouped_id、消息时间和接收时间。记录先缓冲在内存中，由后台写入线程追加到文件。
+    """
+    
+    def __init__(self, capture_file):
+        self.capture_file = capture_file
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.handle = open(capture_file, "ab")
+        self.recorded = 0
+    
+    @staticmethod
+    def describe_media(media):
+        """返回媒体类型和ID，与 DeduplicationManager.get_hash_content 的判断顺序一致"""
+        if not media:
+            return None, None
+        for kind in CapturedMessage.MEDIA_FIELDS:
+            if hasattr(media, kind):
+                return kind, getattr(getattr(media, kind), "id", None)
+        return type(media).__name__, None
+    
+    @classmethod
+    def encode_message(cls, message, received_at):
+        """将一条消息编码为录制行"""
+        media, media_id = cls.describe_media(message.media)
+        record = {
+            "id": message.id,
+            "chat_id": message.chat_id,
+            "text": message.message,
+            "media": media,
+            "media_id": media_id,
+            "grouped_id": message.grouped_id,
+            "date": message.date.timestamp() if message.date else None,
+            "timestamp": received_at,
+        }
+        return (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+    
+    def record(self, messages):
+        """录制一条消息或一个相册"""
+        received_at = time.time()
+        data = b"".join(self.encode_message(message, received_at) for message in messages)
+        with self.lock:
+            self.buffer.append(data)
+            self.recorded += len(messages)
+        persistence_writer.schedule(self.capture_file, self.flush_buffer, len(messages))
+    
+    def flush_buffer(self):
+        """将缓冲的记录追加到录制文件（在写入线程中执行）"""
+        with self.lock:
+            if not self.buffer or self.handle is None:
+                return
+            data = b"".join(self.buffer)
+            self.buffer.clear()
+            self.handle.write(data)
+            self.handle.flush()
+    
+    def close(self):
+        """写入剩余的缓冲记录并关闭录制文件"""
+        self.flush_buffer()
+        with self.lock:
+            if self.handle:
+                self.handle.close()
+                self.handle = None
+    
+    @staticmethod
+    def load(capture_file):
+        """读取录制文件，按接收顺序返回 CapturedMessage 列表，跳过写了一半的行"""
+        messages = []
+        with open(capture_file, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                try:
+                    messages.append(CapturedMessage(json.loads(line)))
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return messages
+
+# ============ 频道实体缓存 ============
+class EntityCache:
+    """持久化的频道实体缓存
+    
+    access_hash 因账号而异，按账号分别保存：
+    aliases 将配置中的频道标识（ID、用户名、链接）映射到 peer ID，
+    peers 保存 peer ID 对应的类型、access_hash 和名称，可离线还原为实体。
+    """
+    
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.accounts = self.load()
+    
+    def load(self):
+        """加载缓存文件"""
+        if os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, "r", encoding="utf-8") as f:
+                    return json.load(f).get("accounts", {})
+            except Exception as e:
+                logger.warning(f"频道实体缓存格式错误，将重新解析: {e}")
+        return {}
+    
+    def save(self):
+        """登记后台写入缓存文件"""
+        persistence_writer.schedule(self.cache_file, self.write)
+    
+    def write(self):
+        """原子写入缓存文件（在写入线程中执行）"""
+        # 复制两层字典，写入线程序列化时事件循环可以继续修改缓存
+        snapshot = {
+            account: {"aliases": dict(data["aliases"]), "peers": dict(data["peers"])}
+            for account, data in list(self.accounts.items())
+        }
+        write_file_atomic(self.cache_file, json.dumps({"accounts": snapshot}, ensure_ascii=False, indent=2))
+    
+    def get_account(self, account):
+        return self.accounts.setdefault(account, {"aliases": {}, "peers": {}})
+    
+    @staticmethod
+    def to_record(entity):
+        """将实体或 InputPeer 转换为可保存的记录，不支持的类型返回None"""
+        if isinstance(entity, (types.Channel, types.InputPeerChannel)):
+            kind, raw_id = "channel", getattr(entity, "id", None) or getattr(entity, "channel_id", None)
+        elif isinstance(entity, (types.Chat, types.InputPeerChat)):
+            kind, raw_id = "chat", getattr(entity, "id", None) or getattr(entity, "chat_id", None)
+        elif isinstance(entity, (types.User, types.InputPeerUser)):
+            kind, raw_id = "user", getattr(entity, "id", None) or getattr(entity, "user_id", None)
+        else:
+            return None
+        return {
+            "type": kind,
+            "id": raw_id,
+            "access_hash": getattr(entity, "access_hash", None),
+            "title": get_channel_name(entity) if hasattr(entity, "title") else getattr(entity, "first_name", None),
+            "username": getattr(entity, "username", None),
+            "broadcast": bool(getattr(entity, "broadcast", False)),
+            "cached_at": time.time(),
+        }
+    
+    @staticmethod
+    def to_entity(record):
+        """由记录还原实体，只包含转发所需的字段"""
+        if record["type"] == "channel":
+            return types.Channel(
+                id=record["id"], title=record["title"] or "", photo=types.ChatPhotoEmpty(), date=None,
+                access_hash=record["access_hash"], username=record["username"],
+                broadcast=record.get("broadcast"), megagroup=not record.get("broadcast")
+            )
+        if record["type"] == "chat":
+            return types.Chat(
+                id=record["id"], title=record["title"] or "", photo=types.ChatPhotoEmpty(),
+                participants_count=0, date=None, version=0
+            )
+        return types.User(
+            id=record["id"], access_hash=record["access_hash"],
+            first_name=record["title"], username=record["username"]
+        )
+    
+    @staticmethod
+    def to_input_peer(record):
+        """由记录还原 InputPeer"""
+        if record["type"] == "channel":
+            return types.InputPeerChannel(record["id"], record["access_hash"])
+        if record["type"] == "chat":
+            return types.InputPeerChat(record["id"])
+        return types.InputPeerUser(record["id"], record["access_hash"])
+    
+    def get_entity(self, account, alias):
+        """按配置中的频道标识获取缓存的实体，未缓存时返回None"""
+        data = self.accounts.get(account)
+        if not data:
+            return None
+        peer_id = data["aliases"].get(str(alias))
+        record = data["peers"].get(str(peer_id)) if peer_id is not None else None
+        return self.to_entity(record) if record else None
+    
+    def put_entity(self, account, alias, entity):
+        """缓存解析结果"""
+        record = self.to_record(entity)
+        if record is None:
+            return
+        data = self.get_account(account)
+        peer_id = utils.get_peer_id(entity)
+        data["aliases"][str(alias)] = peer_id
+        data["peers"][str(peer_id)] = record
+    
+    def get_input_peer(self, account, peer_id):
+        """获取缓存的 InputPeer，未缓存时返回None"""
+        data = self.accounts.get(account)
+        record = data["peers"].get(str(peer_id)) if data else None
+        return self.to_input_peer(record) if record else None
+    
+    def put_input_peer(self, account, peer_id, input_peer):
+        """缓存账号解析出的 InputPeer，不覆盖已有的名称信息"""
+        record = self.to_record(input_peer)
+        if record is None:
+            return
+        peers = self.get_account(account)["peers"]
+        existing = peers.get(str(peer_id))
+        if existing:
+            existing.update(access_hash=record["access_hash"], cached_at=record["cached_at"])
+        else:
+            peers[str(peer_id)] = record
+    
+    def invalidate(self, account, peer_id):
+        """删除失效的缓存记录"""
+        data = self.accounts.get(account)
+        if data:
+            data["peers"].pop(str(peer_id), None)
+    
+    def get_stale_aliases(self, account, ttl):
+        """超过有效期需要重新验证的频道标识"""
+        data = self.accounts.get(account)
+        if not data or not ttl:
+            return []
+        cutoff = time.time() - ttl
+        return [
+            alias for alias, peer_id in data["aliases"].items()
+            if data["peers"].get(str(peer_id), {}).get("cached_at", 0) < cutoff
+        ]
+
 # ============ 客户端管理 ============
+class NoSenderAvailableError(Exception):
+    """没有可以访问源频道和目标频道的发送账号"""
+
 class ClientManager:
     """客户端管理器"""
     
     def __init__(self):
         self.clients = []
         self.current_index = 0
+        self.sender_available = None  # 有账号释放发送槽位时通知等待者
+        self.entity_cache = EntityCache(Config.entity_cache_file)
+        self.entity_owner = None  # 解析频道实体的账号，实体中的 access_hash 属于该账号
         self.setup_clients()
     
     def setup_clients(self):
@@ -171,7 +965,8 @@ class ClientManager:
                     account["session_name"], 
                     account["api_id"], 
                     account["api_hash"], 
-                    proxy=proxy
+                    proxy=proxy,
+                    flood_sleep_threshold=Config.flood_sleep_threshold
                 )
                 
                 self.clients.append({
@@ -180,7 +975,15 @@ class ClientManager:
                     "forward_count": 0,
                     "last_used": 0,
                     "enabled": True,
-                    "name": account["session_name"]
+                    "name": account["session_name"],
+                    "rate_limiter": create_rate_limiter(),
+                    "inflight": 0,  # 进行中的转发请求数
+                    "start_time": None,  # 最近一次启动耗时（秒）
+                    "blocked_until": 0,  # FloodWait 解除时间（time.monotonic）
+                    "flood_waits": 0,
+                    "flood_wait_seconds": 0,
+                    "peers": {},  # 频道ID -> 该账号下的 InputPeer
+                    "no_access_until": {}  # 频道ID -> 恢复尝试时间（time.monotonic）
                 })
     
     def get_current_client(self):
@@ -189,6 +992,228 @@ class ClientManager:
             raise Exception("没有可用的账号！")
         return self.clients[self.current_index]["client"]
     
+    def get_current_rate_limiter(self):
+        """获取当前账号的令牌桶"""
+        return self.clients[self.current_index]["rate_limiter"]
+    
+    def get_rate_limit_stats(self):
+        """获取所有账号的令牌桶状态"""
+        return {
+            client_data["name"]: client_data["rate_limiter"].get_state()
+            for client_data in self.clients
+        }
+    
+    def get_sender_stats(self):
+        """获取所有账号的发送状态"""
+        now = time.monotonic()
+        return {
+            client_data["name"]: {
+                "enabled": client_data["enabled"],
+                "inflight": client_data["inflight"],
+                "forward_count": client_data["forward_count"],
+                "blocked_for": max(0, round(client_data["blocked_until"] - now)),
+                "flood_waits": client_data["flood_waits"],
+                "flood_wait_seconds": client_data["flood_wait_seconds"],
+            }
+            for client_data in self.clients
+        }
+    
+    def block_account(self, client_data, seconds):
+        """记录账号的 FloodWait，在解除前不再用其发送"""
+        client_data["blocked_until"] = max(client_data["blocked_until"], time.monotonic() + seconds)
+        client_data["flood_waits"] += 1
+        client_data["flood_wait_seconds"] += seconds
+        logger.warning(
+            f"⏸ 账号 {client_data['name']} 触发 FloodWait，{seconds} 秒内不再使用"
+            f"（累计 {client_data['flood_waits']} 次 {client_data['flood_wait_seconds']} 秒）"
+        )
+    
+    def get_sender_candidates(self, channels):
+        """可用于发送的账号：已启用且近期未发现无法访问相关频道"""
+        now = time.monotonic()
+        candidates = [c for c in self.clients if c["enabled"]]
+        return [
+            c for c in candidates
+            if all(
+                c["no_access_until"].get(normalize_channel_id(channel.id), 0) <= now
+                for channel in channels
+            )
+        ]
+    
+    def filter_unblocked(self, candidates):
+        """排除 FloodWait 中的账号；未启用账号池时优先使用当前账号，受限时才换用其他账号"""
+        now = time.monotonic()
+        unblocked = [c for c in candidates if c["blocked_until"] <= now]
+        if not Config.enable_sender_pool:
+            current = self.clients[self.current_index]
+            if current in unblocked:
+                return [current]
+            return unblocked[:1]
+        return unblocked
+    
+    async def resolve_entities(self, aliases):
+        """用当前账号并发解析频道标识，优先使用持久化缓存，返回 {标识: 实体}"""
+        client_data = self.clients[self.current_index]
+        self.entity_owner = client_data
+        semaphore = asyncio.Semaphore(max(1, Config.entity_resolve_concurrency))
+        cache_hits = 0
+        
+        async def resolve(alias):
+            nonlocal cache_hits
+            entity = self.entity_cache.get_entity(client_data["name"], alias)
+            if entity is not None:
+                cache_hits += 1
+                return entity
+            async with semaphore:
+                # FloodWait 只对联网解析原地等待，转发请求的 FloodWait 在 forward_message_safe 中换账号
+                while True:
+                    try:
+                        entity = await client_data["client"].get_entity(alias)
+                        break
+                    except errors.FloodWaitError as e:
+                        logger.warning(f"⏸ 解析频道 {alias} 触发 FloodWait，{e.seconds} 秒后重试")
+                        await asyncio.sleep(e.seconds)
+            self.entity_cache.put_entity(client_data["name"], alias, entity)
+            return entity
+        
+        started = time.monotonic()
+        entities = await asyncio.gather(*[resolve(alias) for alias in aliases])
+        if cache_hits < len(aliases):
+            self.entity_cache.save()
+        logger.info(
+            f"🔎 已解析 {len(aliases)} 个频道（缓存命中 {cache_hits}，"
+            f"联网解析 {len(aliases) - cache_hits}），耗时 {time.monotonic() - started:.2f}秒"
+        )
+        return dict(zip(aliases, entities))
+    
+    async def revalidate_entities(self):
+        """在后台按较低并发重新解析超过有效期的缓存实体，更新失效的 access_hash"""
+        client_data = self.entity_owner
+        if client_data is None:
+            return
+        aliases = self.entity_cache.get_stale_aliases(client_data["name"], Config.entity_cache_ttl)
+        if not aliases:
+            return
+        refreshed = 0
+        for alias in aliases:
+            try:
+                entity = await client_data["client"].get_entity(alias)
+            except errors.FloodWaitError as e:
+                logger.warning(f"⏸ 重新验证频道触发 FloodWait，{e.seconds} 秒后继续")
+                await asyncio.sleep(e.seconds)
+                continue
+            except Exception as e:
+                logger.warning(f"⚠️ 重新验证频道 {alias} 失败: {e}")
+                continue
+            self.entity_cache.put_entity(client_data["name"], alias, entity)
+            client_data["peers"].pop(normalize_channel_id(entity.id), None)
+            refreshed += 1
+            await asyncio.sleep(1)
+        self.entity_cache.save()
+        logger.info(f"🔎 已重新验证 {refreshed}/{len(aliases)} 个缓存频道")
+    
+    async def resolve_peer(self, client_data, channel):
+        """获取频道在指定账号下的 InputPeer
+        
+        access_hash 因账号而异：依次使用内存、持久化缓存和 Telethon 会话缓存，
+        解析频道实体的账号直接使用实体，其他账号最后才按用户名联网解析。
+        """
+        channel_id = normalize_channel_id(channel.id)
+        peer = client_data["peers"].get(channel_id)
+        if peer is not None:
+            return peer
+        
+        client = client_data["client"]
+        peer_id = utils.get_peer_id(channel)
+        peer = self.entity_cache.get_input_peer(client_data["name"], peer_id)
+        if peer is None:
+            try:
+                peer = await client.get_input_entity(peer_id)
+            except (ValueError, TypeError):
+                username = getattr(channel, "username", None)
+                if client_data is self.entity_owner:
+                    peer = utils.get_input_peer(channel)
+                elif username:
+                    peer = await client.get_input_entity(username)
+                else:
+                    raise
+            self.entity_cache.put_input_peer(client_data["name"], peer_id, peer)
+            self.entity_cache.save()
+        client_data["peers"][channel_id] = peer
+        account_channel_access.setdefault(client_data["name"], {})[channel_id] = True
+        return peer
+    
+    def invalidate_peers(self, client_data, channels):
+        """丢弃账号下失效的频道 InputPeer，下次发送时重新解析"""
+        for channel in channels:
+            client_data["peers"].pop(normalize_channel_id(channel.id), None)
+            self.entity_cache.invalidate(client_data["name"], utils.get_peer_id(channel))
+        self.entity_cache.save()
+    
+    async def acquire_sender(self, source_channel, target_channel):
+        """选择发送账号并占用一个发送槽位
+        
+        优先令牌最多的账号，令牌相同时选择最久未使用的账号；
+        所有账号都达到进行中上限时等待槽位释放。返回 (client_data, 源InputPeer, 目标InputPeer)。
+        """
+        if self.sender_available is None:
+            self.sender_available = asyncio.Condition()
+        channels = (source_channel, target_channel)
+        
+        while True:
+            candidates = self.get_sender_candidates(channels)
+            if not candidates:
+                raise NoSenderAvailableError("没有可以访问源频道和目标频道的账号！")
+            
+            # 只有全部账号都在 FloodWait 中时才等待
+            unblocked = self.filter_unblocked(candidates)
+            if not unblocked:
+                wait = min(c["blocked_until"] for c in candidates) - time.monotonic()
+                logger.warning(f"⏸ 所有账号都在 FloodWait 中，等待 {wait:.0f} 秒")
+                await asyncio.sleep(max(0, wait))
+                continue
+            
+            free = [c for c in unblocked if c["inflight"] < Config.max_inflight_per_account]
+            if not free:
+                async with self.sender_available:
+                    await self.sender_available.wait()
+                continue
+            
+            client_data = max(free, key=lambda c: (c["rate_limiter"].available(), -c["last_used"]))
+            client_data["inflight"] += 1
+            client_data["last_used"] = time.monotonic()
+            try:
+                source_peer = await self.resolve_peer(client_data, source_channel)
+                target_peer = await self.resolve_peer(client_data, target_channel)
+            except errors.FloodWaitError as e:
+                await self.release_sender(client_data)
+                self.block_account(client_data, e.seconds + 5)
+                continue
+            except Exception as e:
+                await self.release_sender(client_data)
+                # 只有其他账号找不到频道时才标记，网络错误和当前账号的解析失败按普通错误处理
+                if not isinstance(e, (ValueError, TypeError)) or client_data is self.entity_owner:
+                    raise
+                logger.warning(f"⚠️ 账号 {client_data['name']} 无法访问频道，不再用其发送: {e}")
+                for channel in channels:
+                    if normalize_channel_id(channel.id) not in client_data["peers"]:
+                        self.mark_no_access(client_data, channel)
+                continue
+            return client_data, source_peer, target_peer
+    
+    def mark_no_access(self, client_data, channel):
+        """记录账号无法访问某频道，no_access_retry_interval 秒后重新解析并再次尝试"""
+        channel_id = normalize_channel_id(channel.id)
+        client_data["peers"].pop(channel_id, None)
+        client_data["no_access_until"][channel_id] = time.monotonic() + Config.no_access_retry_interval
+        account_channel_access.setdefault(client_data["name"], {})[channel_id] = False
+    
+    async def release_sender(self, client_data):
+        """释放发送槽位"""
+        client_data["inflight"] -= 1
+        async with self.sender_available:
+            self.sender_available.notify()
+    
     def get_current_account_info(self):
         """获取当前账号信息"""
         if not self.clients:
@@ -210,169 +1235,1207 @@ class ClientManager:
         return True
     
     def should_rotate_account(self):
-        """判断是否应该轮换账号"""
-        if not Config.enable_account_rotation or len(self.clients) <= 1:
+        """判断是否应该轮换账号（账号池模式下所有账号同时发送，无需轮换）"""
+        if Config.enable_sender_pool or not Config.enable_account_rotation or len(self.clients) <= 1:
             return False
         
         current_client_data = self.clients[self.current_index]
         return current_client_data["forward_count"] >= Config.rotation_interval
     
-    def increment_forward_count(self):
-        """增加转发计数"""
-        self.clients[self.current_index]["forward_count"] += 1
+    def increment_forward_count(self, count=1, client_data=None):
+        """增加转发计数，默认计入当前账号"""
+        if client_data is None:
+            client_data = self.clients[self.current_index]
+        client_data["forward_count"] += count
     
     def reset_forward_count(self):
         """重置转发计数"""
         self.clients[self.current_index]["forward_count"] = 0
 
+# ============ 广告匹配器 ============
+def compile_keyword_regex(keywords):
+    """将关键词编译为一个前缀树结构的正则
+    
+    公共前缀只比较一次，首字符集合可由正则引擎直接跳过不相关位置。
+    只关心"是否包含任一关键词"，所以某个关键词结束后不再展开更长的分支。
+    """
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    
+    def to_regex(node):
+        if "" in node:
+            return ""
+        branches = [re.escape(char) + to_regex(child) for char, child in sorted(node.items())]
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")"
+    
+    if not trie:
+        return None
+    return re.compile(to_regex(trie))
+
+class CompiledAdMatcher:
+    """编译后的广告规则：关键词合并为单个正则，正则模式按角色预编译"""
+    
+    LINK_PATTERN = r'https?://[^\s]+'
+    
+    def __init__(self, keywords, patterns):
+        self.keyword_regex = compile_keyword_regex(keywords)
+        self.link_patterns = []
+        self.reject_patterns = []
+        for entry in patterns:
+            if isinstance(entry, (tuple, list)):
+                pattern, role = entry
+            else:
+                pattern = entry
+                role = "count_links" if pattern == self.LINK_PATTERN else "reject"
+            
+            if role == "count_links":
+                self.link_patterns.append(re.compile(pattern))
+            elif role == "reject":
+                self.reject_patterns.append(re.compile(pattern))
+            else:
+                raise ValueError(f"未知的广告正则角色: {role}")
+    
+    def has_keyword(self, text_lower):
+        """是否包含广告关键词"""
+        return self.keyword_regex is not None and self.keyword_regex.search(text_lower) is not None
+    
+    def has_reject_pattern(self, text):
+        """是否匹配任一拒绝模式"""
+        for pattern in self.reject_patterns:
+            if pattern.search(text):
+                return True
+        return False
+    
+    def count_links(self, text, limit):
+        """统计链接数量，超过 limit 后提前停止"""
+        link_count = 0
+        for pattern in self.link_patterns:
+            for _ in pattern.finditer(text):
+                link_count += 1
+                if link_count > limit:
+                    return link_count
+        return link_count
+
 # ============ 消息过滤器 ============
 class MessageFilter:
     """消息过滤器"""
     
-    @staticmethod
-    def is_ad_message(text, has_media=False):
+    # 计入有意义内容、且不计为表情符号的标点
+    MEANINGFUL_PUNCTUATION = frozenset('，。！？；：""（）【】《》')
+    
+    _ad_matcher = None
+    _ad_matcher_key = None
+    _meaningless_words = None
+    _meaningless_words_key = None
+    
+    def __init__(self, profile=None):
+        """profile 为覆盖全局配置的过滤参数，如 {"min_message_length": 20}"""
+        self.profile = dict(profile or {})
+        unknown = [name for name in self.profile if not hasattr(Config, name)]
+        if unknown:
+            raise ValueError(f"未知的过滤配置项: {', '.join(unknown)}")
+        
+        # 覆盖了规则列表的配置使用自己编译的规则，否则共用全局缓存
+        self.ad_matcher = None
+        self.meaningless_words = None
+        if "ad_keywords" in self.profile or "ad_patterns" in self.profile:
+            self.ad_matcher = CompiledAdMatcher(self.setting("ad_keywords"), self.setting("ad_patterns"))
+        if "meaningless_words" in self.profile:
+            self.meaningless_words = frozenset(word.lower() for word in self.profile["meaningless_words"])
+    
+    def setting(self, name):
+        """读取过滤参数，未覆盖时使用全局配置"""
+        if name in self.profile:
+            return self.profile[name]
+        return getattr(Config, name)
+    
+    @classmethod
+    def get_ad_matcher(cls):
+        """获取广告匹配器，只在关键词或正则配置变化时重新编译
+        
+        按列表对象和长度判断是否变化，开销与关键词数量无关；
+        原地修改列表内容后请调用 reload_rules()。
+        """
+        key = (id(Config.ad_keywords), len(Config.ad_keywords),
+               id(Config.ad_patterns), len(Config.ad_patterns))
+        if cls._ad_matcher is None or key != cls._ad_matcher_key:
+            cls._ad_matcher = CompiledAdMatcher(Config.ad_keywords, Config.ad_patterns)
+            cls._ad_matcher_key = key
+        return cls._ad_matcher
+    
+    @classmethod
+    def get_meaningless_words(cls):
+        """获取小写化的无意义词汇集合，只在配置变化时重建"""
+        key = (id(Config.meaningless_words), len(Config.meaningless_words))
+        if cls._meaningless_words is None or key != cls._meaningless_words_key:
+            cls._meaningless_words = frozenset(word.lower() for word in Config.meaningless_words)
+            cls._meaningless_words_key = key
+        return cls._meaningless_words
+    
+    @classmethod
+    def reload_rules(cls):
+        """丢弃已编译的规则，下次过滤时按当前配置重新编译"""
+        cls._ad_matcher = None
+        cls._meaningless_words = None
+    
+    def is_ad_message(self, text, has_media=False):
         """检测广告消息"""
-        if not Config.enable_ad_filter or not text:
+        if not self.setting("enable_ad_filter") or not text:
             return False
         
-        text_lower = text.lower()
+        matcher = self.ad_matcher or self.get_ad_matcher()
         
         # 检查关键词
-        for keyword in Config.ad_keywords:
-            if keyword in text_lower:
-                return True
+        if matcher.has_keyword(text.lower()):
+            return True
         
         # 检查正则模式
-        link_count = 0
-        for pattern in Config.ad_patterns:
-            matches = re.findall(pattern, text)
-            if pattern == r'https?://[^\s]+':
-                link_count += len(matches)
-            elif matches:
-                return True
+        if matcher.has_reject_pattern(text):
+            return True
         
         # 检查链接数量
-        if link_count > Config.max_links_per_message:
+        max_links = self.setting("max_links_per_message")
+        if matcher.count_links(text, max_links) > max_links:
             return True
         
         # 检查消息长度
-        if len(text.strip()) < Config.min_message_length:
+        if len(text.strip()) < self.setting("min_message_length"):
             if not has_media:
                 return True
         
         return False
     
-    @staticmethod
-    def is_meaningless_message(text, has_media=False):
+    def is_meaningless_message(self, text, has_media=False):
         """检测无意义消息"""
-        if not Config.enable_content_filter or not text:
+        if not self.setting("enable_content_filter") or not text:
             return False
         
         text = text.strip()
         
         # 检查无意义词汇
-        if text.lower() in [word.lower() for word in Config.meaningless_words]:
+        if text.lower() in (self.meaningless_words or self.get_meaningless_words()):
             return not has_media
         
+        # 一次遍历统计字符频次，其余指标都从频次表按不同字符计算
+        char_counts = Counter(text)
+        text_length = len(text)
+        max_char_count = 0
+        emoji_count = 0
+        meaningful_chars = 0
+        punctuation = self.MEANINGFUL_PUNCTUATION
+        for char, count in char_counts.items():
+            if count > max_char_count:
+                max_char_count = count
+            if char in punctuation:
+                meaningful_chars += count
+            else:
+                if ord(char) > 127:
+                    emoji_count += count
+                if char.isalnum():
+                    meaningful_chars += count
+        
         # 检查重复字符
-        if len(text) > 1:
-            char_counts = {}
-            for char in text:
-                char_counts[char] = char_counts.get(char, 0) + 1
-            max_char_count = max(char_counts.values())
-            if max_char_count > Config.max_repeat_chars and max_char_count / len(text) > 0.6:
+        if text_length > 1:
+            if max_char_count > self.setting("max_repeat_chars") and max_char_count / text_length > 0.6:
                 return not has_media
         
         # 检查表情符号比例
-        emoji_count = len([c for c in text if ord(c) > 127 and c not in '，。！？；：""''（）【】《》'])
-        if len(text) > 0 and emoji_count / len(text) > Config.max_emoji_ratio:
+        if text_length > 0 and emoji_count / text_length > self.setting("max_emoji_ratio"):
             return not has_media
         
         # 检查有意义内容长度
-        meaningful_chars = len([c for c in text if c.isalnum() or c in '，。！？；：""''（）【】《》'])
-        if meaningful_chars < Config.min_meaningful_length:
+        if meaningful_chars < self.setting("min_meaningful_length"):
             return not has_media
         
         # 检查单字符重复
-        if len(set(text.replace(' ', ''))) <= 1 and len(text) > 1:
+        distinct_chars = len(char_counts) - (' ' in char_counts)
+        if distinct_chars <= 1 and text_length > 1:
             return not has_media
         
         return False
 
-# ============ 去重管理器 ============
-class DeduplicationManager:
-    """去重管理器"""
+# ============ 去重历史日志 ============
+class DedupJournal:
+    """去重历史追加日志
     
-    def __init__(self):
-        self.history_file = Config.dedup_history_file
-        self.history = self.load_history()
+    每条新哈希追加一行JSON到日志文件，压缩时将完整历史写入快照并清空日志。
+    启动时按 快照 → 压缩中日志 → 当前日志 的顺序回放，重复回放是幂等的。
+    """
     
-    def load_history(self):
-        """加载去重历史"""
-        if os.path.exists(self.history_file):
-            try:
-                with open(self.history_file, "r", encoding="utf-8") as f:
-                    content = f.read().strip()
-                    if content:
-                        return json.loads(content)
-            except Exception as e:
-                logger.warning(f"去重历史文件格式错误: {e}")
-        return {}
+    merge_separator = b"\n"
     
-    def save_history(self):
-        """保存去重历史"""
-        try:
-            with open(self.history_file, "w", encoding="utf-8") as f:
-                json.dump(self.history, f, indent=2, ensure_ascii=False)
-        except Exception as e:
-            logger.error(f"保存去重历史失败: {e}")
+    def __init__(self, snapshot_file):
+        self.snapshot_file = snapshot_file
+        self.journal_file = f"{snapshot_file}.journal"
+        self.compacting_file = f"{self.journal_file}.compacting"
+        self.lock = threading.Lock()
+        self.handle = None
+        self.buffer = []  # 已编码、等待写入线程写入日志的记录
+        self.appended_count = 0
+        self.evicted_count = 0
+        self.last_compact = time.time()
+        self.needs_recovery = False
     
-    def generate_message_hash(self, message):
-        """生成消息哈希"""
-        hash_content = ""
-        
-        if message.media:
-            if hasattr(message.media, 'photo'):
-                hash_content += f"photo:{message.media.photo.id}"
-            elif hasattr(message.media, 'document'):
-                hash_content += f"doc:{message.media.document.id}"
-            elif hasattr(message.media, 'video'):
-                hash_content += f"video:{message.media.video.id}"
-            elif hasattr(message.media, 'audio'):
-                hash_content += f"audio:{message.media.audio.id}"
-            else:
-                hash_content += f"media:{type(message.media).__name__}"
-        else:
-            if message.message:
-                normalized_text = re.sub(r'\s+', ' ', message.message.strip().lower())
-                hash_content += f"text:{normalized_text}"
-            else:
-                hash_content += f"empty:{message.id}"
-        
-        return hashlib.md5(hash_content.encode('utf-8')).hexdigest()
+    def replay(self, history):
+        """将日志回放到历史字典中"""
+        self.needs_recovery = os.path.exists(self.compacting_file)
+        replayed = 0
+        for path in (self.compacting_file, self.journal_file):
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        history[record["hash"]] = {
+                            "timestamp": record["timestamp"],
+                            "source": record.get("source", "")
+                        }
+                    except (ValueError, KeyError, TypeError):
+                        # 崩溃时写了一半的行，直接跳过
+                        continue
+                    replayed += 1
+        self.appended_count = replayed
+        if replayed:
+            logger.info(f"📒 已回放 {replayed} 条去重日志记录")
     
-    def is_duplicate(self, message_hash):
-        """检查是否重复"""
-        if not Config.enable_content_deduplication:
-            return False
-        return message_hash in self.history
+    def open(self):
+        """以追加方式打开日志文件"""
+        # 上次崩溃可能留下没有换行的半行，补一个换行使其与新记录隔离
+        needs_newline = False
+        if os.path.exists(self.journal_file) and os.path.getsize(self.journal_file) > 0:
+            with open(self.journal_file, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        self.handle = open(self.journal_file, "ab")
+        if needs_newline:
+            self.handle.write(b"\n")
+            self.handle.flush()
     
-    def add_to_history(self, message_hash, source_info=""):
+    def encode_record(self, message_hash, entry):
+        """将一条记录编码为日志行"""
+        line = json.dumps(
+            {"hash": message_hash, "timestamp": entry["timestamp"], "source": entry["source"]},
+            ensure_ascii=False
+        )
+        return (line + "\n").encode("utf-8")
+    
+    def append(self, message_hash, entry):
+        """追加一条记录，写入量与历史规模无关"""
+        self.write_records(self.encode_record(message_hash, entry), 1)
+    
+    def append_many(self, records):
+        """一次写入追加多条记录，records 为 encode_record 的参数元组列表"""
+        if records:
+            self.write_records(b"".join(self.encode_record(*record) for record in records), len(records))
+    
+    def write_records(self, data, count):
+        """缓冲已编码的记录，由写入线程合并写入日志"""
+        with self.lock:
+            self.buffer.append(data)
+            self.appended_count += count
+        persistence_writer.schedule(self.journal_file, self.flush_buffer, count)
+    
+    def flush_buffer(self):
+        """将缓冲的记录写入日志文件（在锁内完成，压缩轮转日志时不会丢失）"""
+        with self.lock:
+            if not self.buffer or self.handle is None:
+                return
+            data = b"".join(self.buffer)
+            self.buffer.clear()
+            self.handle.write(data)
+            self.handle.flush()
+    
+    def take_snapshot(self, history):
+        """复制当前历史（在锁内调用）"""
+        return dict(history)
+    
+    def write_snapshot(self, path, snapshot):
+        """将快照写入文件，返回快照条数"""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        return len(snapshot)
+    
+    def should_compact(self):
+        """判断是否需要压缩日志"""
+        dirty_count = self.appended_count + self.evicted_count
+        if dirty_count >= Config.dedup_compact_threshold:
+            return True
+        return (dirty_count > 0
+                and time.time() - self.last_compact >= Config.dedup_compact_interval)
+    
+    def compact(self, history):
+        """写入快照并清空日志（可在后台线程中执行）"""
+        with self.lock:
+            if self.handle is None:
+                return
+            # 先轮转日志，之后的新记录写入新日志，不会在压缩期间丢失
+            self.handle.close()
+            if not os.path.exists(self.compacting_file):
+                os.replace(self.journal_file, self.compacting_file)
+            else:
+                # 上一次压缩未完成：把当前日志并入待压缩日志
+                with open(self.journal_file, "rb") as src, \
+                        open(self.compacting_file, "ab") as dst:
+                    dst.write(self.merge_separator + src.read())
+                os.remove(self.journal_file)
+            self.handle = open(self.journal_file, "ab")
+            self.appended_count = 0
+            # 已淘汰的条目不在 history 中，写入快照后即从磁盘上删除
+            self.evicted_count = 0
+            snapshot = self.take_snapshot(history)
+        
+        tmp_file = f"{self.snapshot_file}.tmp"
+        snapshot_count = self.write_snapshot(tmp_file, snapshot)
+        os.replace(tmp_file, self.snapshot_file)
+        os.remove(self.compacting_file)
+        self.last_compact = time.time()
+        self.needs_recovery = False
+        logger.info(f"🗜 去重历史压缩完成: {snapshot_count} 条")
+    
+    def close(self):
+        """写入剩余的缓冲记录并关闭日志文件"""
+        self.flush_buffer()
+        with self.lock:
+            if self.handle:
+                self.handle.close()
+                self.handle = None
+
+class CompactDigestStore:
+    """紧凑二进制摘要表
+    
+    线性探测的开放寻址哈希表，每个槽位14字节：8字节blake2b摘要、
+    4字节时间戳（秒）、2字节来源频道编号。磁盘格式与内存布局完全一致，
+    启动时直接内存映射文件，无需解析JSON（Windows下映射中的文件无法被
+    压缩替换，改为一次性读入内存）。摘要和时间戳使用本机字节序。
+    """
+    
+    MAGIC = b"TGDGST01"
+    HEADER = struct.Struct("<8sQQ")  # 魔数、容量、条目数
+    HEADER_SIZE = 64
+    SLOT_SIZE = 14
+    MAX_LOAD = 0.7
+    SAMPLE_SIZE = 16  # 超出上限时每次采样的条目数
+    
+    def __init__(self, capacity=1024):
+        self.cursor = 0
+        self.mmap = None
+        self.init_buffer(bytearray(self.file_size(capacity)), capacity, 0)
+    
+    @classmethod
+    def file_size(cls, capacity):
+        """计算指定容量的文件大小"""
+        return cls.HEADER_SIZE + capacity * cls.SLOT_SIZE
+    
+    @classmethod
+    def capacity_for(cls, entries):
+        """计算容纳 entries 条记录所需的容量（2的幂）"""
+        capacity = 1024
+        while capacity * cls.MAX_LOAD < entries:
+            capacity *= 2
+        return capacity
+    
+    @classmethod
+    def load(cls, path, min_capacity=1024):
+        """从文件加载摘要表"""
+        if not os.path.exists(path):
+            return cls(min_capacity)
+        
+        with open(path, "rb") as f:
+            magic, capacity, count = cls.HEADER.unpack(f.read(cls.HEADER.size))
+            if magic != cls.MAGIC or os.path.getsize(path) != cls.file_size(capacity):
+                raise ValueError(f"摘要表文件格式错误: {path}")
+            if os.name == "nt":
+                f.seek(0)
+                buffer = bytearray(f.read())
+            else:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        
+        store = cls.__new__(cls)
+        store.cursor = 0
+        store.mmap = buffer if isinstance(buffer, mmap.mmap) else None
+        store.init_buffer(buffer, capacity, count)
+        if capacity < min_capacity:
+            store.resize(min_capacity)
+        return store
+    
+    def init_buffer(self, buffer, capacity, count):
+        """在缓冲区上建立键、时间戳、来源三个数组视图"""
+        self.buffer = buffer
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.count = count
+        view = memoryview(buffer)
+        keys_end = self.HEADER_SIZE + capacity * 8
+        times_end = keys_end + capacity * 4
+        self.keys = view[self.HEADER_SIZE:keys_end].cast("Q")
+        self.times = view[keys_end:times_end].cast("I")
+        self.sources = view[times_end:times_end + capacity * 2].cast("H")
+    
+    def __len__(self):
+        return self.count
+    
+    def find_slot(self, digest):
+        """返回摘要所在槽位，或它应插入的空槽位"""
+        keys = self.keys
+        mask = self.mask
+        i = digest & mask
+        while True:
+            key = keys[i]
+            if key == digest or key == 0:
+                return i
+            i = (i + 1) & mask
+    
+    def get_timestamp(self, digest):
+        """返回摘要的时间戳，不存在时返回 None"""
+        i = self.find_slot(digest)
+        if self.keys[i] == digest:
+            return self.times[i]
+        return None
+    
+    def insert(self, digest, timestamp, source):
+        """插入或更新一条摘要"""
+        if self.count + 1 > self.capacity * self.MAX_LOAD:
+            self.resize(self.capacity * 2)
+        i = self.find_slot(digest)
+        if self.keys[i] == 0:
+            self.count += 1
+        self.keys[i] = digest
+        self.times[i] = timestamp
+        self.sources[i] = source
+    
+    def delete_slot(self, i):
+        """删除槽位并向前回移后续探测链（无墓碑）"""
+        keys, times, sources, mask = self.keys, self.times, self.sources, self.mask
+        keys[i] = 0
+        self.count -= 1
+        j = i
+        while True:
+            j = (j + 1) & mask
+            key = keys[j]
+            if key == 0:
+                return
+            home = key & mask
+            # home 不在 (i, j] 区间内时，该条目可以回移到 i
+            if (i <= j and (home <= i or home > j)) or (i > j and home <= i and home > j):
+                keys[i], times[i], sources[i] = key, times[j], sources[j]
+                keys[j] = 0
+                i = j
+    
+    def resize(self, new_capacity):
+        """扩容并重新插入全部条目"""
+        old_keys, old_times, old_sources = self.keys, self.times, self.sources
+        old_capacity = self.capacity
+        self.init_buffer(bytearray(self.file_size(new_capacity)), new_capacity, 0)
+        for i in range(old_capacity):
+            key = old_keys[i]
+            if key:
+                j = self.find_slot(key)
+                self.keys[j] = key
+                self.times[j] = old_times[i]
+                self.sources[j] = old_sources[i]
+                self.count += 1
+        self.cursor = 0
+        self.mmap = None
+    
+    def evict(self, cutoff, max_entries=None, budget=64):
+        """增量淘汰：从游标处扫描 budget 个槽位删除过期条目；
+        超出上限时按采样近似地淘汰最旧条目"""
+        keys, times, mask = self.keys, self.times, self.mask
+        evicted = 0
+        for _ in range(min(budget, self.capacity)):
+            if not self.count:
+                break
+            i = self.cursor
+            if keys[i] and times[i] < cutoff:
+                # 回移后的条目落在同一槽位，下一轮重新检查
+                self.delete_slot(i)
+                evicted += 1
+            else:
+                self.cursor = (i + 1) & mask
+        
+        while max_entries and self.count > max_entries and evicted < budget:
+            oldest = None
+            sampled = 0
+            i = self.cursor
+            while sampled < self.SAMPLE_SIZE and sampled < self.count:
+                if keys[i]:
+                    if oldest is None or times[i] < times[oldest]:
+                        oldest = i
+                    sampled += 1
+                i = (i + 1) & mask
+            self.cursor = i
+            self.delete_slot(oldest)
+            evicted += 1
+        return evicted
+    
+    def to_bytes(self):
+        """导出与磁盘格式一致的字节串"""
+        data = bytearray(self.buffer)
+        self.HEADER.pack_into(data, 0, self.MAGIC, self.capacity, self.count)
+        return data
+
+class BinaryDedupJournal(DedupJournal):
+    """摘要表的二进制追加日志，每条记录固定14字节"""
+    
+    RECORD = struct.Struct("<QIH")  # 摘要、时间戳、来源编号
+    merge_separator = b""
+    
+    def __init__(self, snapshot_file):
+        super().__init__(snapshot_file)
+        self.channels_file = f"{snapshot_file}.channels.json"
+    
+    def replay(self, store):
+        """将日志回放到摘要表中"""
+        self.needs_recovery = os.path.exists(self.compacting_file)
+        replayed = 0
+        for path in (self.compacting_file, self.journal_file):
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            # 末尾不完整的记录是崩溃时写了一半的，直接丢弃
+            usable = len(data) - len(data) % self.RECORD.size
+            for digest, timestamp, source in self.RECORD.iter_unpack(data[:usable]):
+                store.insert(digest, timestamp, source)
+                replayed += 1
+        self.appended_count = replayed
+        if replayed:
+            logger.info(f"📒 已回放 {replayed} 条去重日志记录")
+    
+    def open(self):
+        """以追加方式打开日志文件"""
+        if os.path.exists(self.journal_file):
+            size = os.path.getsize(self.journal_file)
+            if size % self.RECORD.size:
+                with open(self.journal_file, "r+b") as f:
+                    f.truncate(size - size % self.RECORD.size)
+        self.handle = open(self.journal_file, "ab")
+    
+    def encode_record(self, digest, timestamp, source):
+        """将一条记录编码为定长字节"""
+        return self.RECORD.pack(digest, timestamp, source)
+    
+    def append(self, digest, timestamp, source):
+        """追加一条定长记录"""
+        self.write_records(self.encode_record(digest, timestamp, source), 1)
+    
+    def load_channels(self):
+        """加载来源频道名称表"""
+        if os.path.exists(self.channels_file):
+            try:
+                with open(self.channels_file, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except Exception as e:
+                logger.warning(f"来源频道表格式错误: {e}")
+        return []
+    
+    def save_channels(self, channels):
+        """登记后台写入来源频道名称表，与之后追加的日志记录按登记顺序写入"""
+        persistence_writer.schedule(self.channels_file, lambda: self.write_channels(channels))
+    
+    def write_channels(self, channels):
+        """原子写入来源频道名称表（在写入线程中执行）"""
+        # 名称表只会追加，复制列表即可得到一致的快照
+        write_file_atomic(self.channels_file, json.dumps(list(channels), ensure_ascii=False))
+    
+    def take_snapshot(self, store):
+        return store.to_bytes()
+    
+    def write_snapshot(self, path, snapshot):
+        with open(path, "wb") as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        return CompactDigestStore.HEADER.unpack_from(snapshot)[2]
+
+class MinHashIndex:
+    """MinHash 近似重复索引（分段 LSH）
+    
+    文本去掉链接、提及和符号后切成字符片段，每个片段计算一次64字节 blake2b 摘要，
+    按位置取32个16位值中的最小值作为签名；两个签名相同位置相等的比例近似于
+    片段集合的 Jaccard 相似度。签名分为8段、每段4个值，只有至少一段完全相同的
+    签名才作为候选逐一比较，相似文本几乎必然共享某一段，查找开销与历史规模基本无关。
+    
+    签名按插入顺序存放在连续的数组中（每条64字节签名+4字节时间戳，时间戳为0表示已删除），
+    每段一个线性探测的开放寻址表，以段的8字节内容作为整数键、以槽位序号作为值（4字节），
+    不为每条签名创建Python对象。
+    """
+    
+    NOISE_PATTERN = re.compile(r'https?://\S+|@\w+|[^\w@]+')  # 链接、提及、表情、标点和空白
+    SHINGLE_SIZE = 3
+    NUM_PERM = 32  # 签名中的最小值个数，每个16位
+    BANDS = 8
+    ROWS = NUM_PERM // BANDS
+    SIGNATURE_SIZE = NUM_PERM * 2
+    MAX_LOAD = 0.7
+    SEQUENCE_MOD = 0xFFFFFFFF  # 段表中存 序号 % SEQUENCE_MOD + 1，0 表示空槽位
+    HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+    
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.signatures = array.array("Q")  # 每个槽位8个值，第 b 个值即第 b 段
+        self.times = array.array("I")
+        self.base = 0  # 数组中第一个槽位的序号
+        self.head = 0  # 最旧的可能有效的槽位
+        self.count = 0
+        self.init_tables(1024)
+    
+    def init_tables(self, capacity):
+        """建立指定容量（2的幂）的空段表"""
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.shift = 65 - capacity.bit_length()
+        self.tables = [array.array("I", bytes(4 * capacity)) for _ in range(self.BANDS)]
+    
+    @classmethod
+    def normalize(cls, text):
+        """去掉链接、提及、表情和标点，只保留文字"""
+        return cls.NOISE_PATTERN.sub("", text.lower())
+    
+    @classmethod
+    def signature(cls, normalized_text):
+        """计算文本的 MinHash 签名（64字节）"""
+        size = cls.SHINGLE_SIZE
+        shingles = {normalized_text[i:i + size] for i in range(max(1, len(normalized_text) - size + 1))}
+        digests = [
+            memoryview(hashlib.blake2b(shingle.encode("utf-8"), digest_size=cls.SIGNATURE_SIZE).digest()).cast("H")
+            for shingle in shingles
+        ]
+        # 逐列取最小值在C层完成
+        return struct.pack(f"{cls.NUM_PERM}H", *map(min, zip(*digests)))
+    
+    @classmethod
+    def similarity(cls, a, b):
+        """两个签名估计的 Jaccard 相似度"""
+        return sum(x == y for x, y in zip(memoryview(a).cast("H"), memoryview(b).cast("H"))) / cls.NUM_PERM
+    
+    def home(self, band_value):
+        """段内容在段表中的起始槽位（最小值偏向小数，先乘法散列再取高位）"""
+        return ((band_value * self.HASH_MULTIPLIER) & 0xFFFFFFFFFFFFFFFF) >> self.shift
+    
+    def reference(self, position):
+        """槽位在段表中的引用值"""
+        return (self.base + position) % self.SEQUENCE_MOD + 1
+    
+    def position(self, reference):
+        """段表引用值对应的槽位"""
+        return (reference - 1 - self.base) % self.SEQUENCE_MOD
+    
+    def signature_at(self, position):
+        """槽位中的签名（字节串）"""
+        return self.signatures[position * self.BANDS:(position + 1) * self.BANDS].tobytes()
+    
+    def __len__(self):
+        return self.count
+    
+    def items(self):
+        """按从旧到新的顺序返回 (签名, 时间戳)"""
+        times = self.times
+        return [
+            (self.signature_at(position), times[position])
+            for position in range(self.head, len(times)) if times[position]
+        ]
+    
+    def locate(self, signature):
+        """返回签名所在的有效槽位，不存在时返回None"""
+        values = array.array("Q", signature)
+        signatures, table, mask, bands = self.signatures, self.tables[0], self.mask, self.BANDS
+        i = self.home(values[0])
+        while table[i]:
+            position = self.position(table[i])
+            if signatures[position * bands] == values[0] and signatures[position * bands:(position + 1) * bands] == values:
+                return position
+            i = (i + 1) & mask
+        return None
+    
+    def insert(self, signature, timestamp):
+        """添加签名，已存在时更新时间并移到队尾"""
+        position = self.locate(signature)
+        if position is not None:
+            self.remove_slot(position)
+        if self.count + 1 > self.capacity * self.MAX_LOAD:
+            self.resize(self.capacity * 2)
+        position = len(self.times)
+        self.signatures.frombytes(signature)
+        self.times.append(max(1, timestamp))
+        self.count += 1
+        self.link(position)
+    
+    def link(self, position):
+        """把槽位加入每一段的段表"""
+        reference = self.reference(position)
+        signatures, mask, shift, multiplier = self.signatures, self.mask, self.shift, self.HASH_MULTIPLIER
+        offset = position * self.BANDS
+        for band, table in enumerate(self.tables):
+            # 与 home() 相同，扩容时逐条调用，这里展开
+            i = ((signatures[offset + band] * multiplier) & 0xFFFFFFFFFFFFFFFF) >> shift
+            while table[i]:
+                i = (i + 1) & mask
+            table[i] = reference
+    
+    def remove(self, signature):
+        """删除签名"""
+        position = self.locate(signature)
+        if position is not None:
+            self.remove_slot(position)
+    
+    def remove_slot(self, position):
+        """删除槽位：从每一段的段表中移除，并向前回移后续探测链（无墓碑）"""
+        reference = self.reference(position)
+        signatures, mask, bands = self.signatures, self.mask, self.BANDS
+        for band, table in enumerate(self.tables):
+            i = self.home(signatures[position * bands + band])
+            while table[i] != reference:
+                i = (i + 1) & mask
+            table[i] = 0
+            j = i
+            while True:
+                j = (j + 1) & mask
+                value = table[j]
+                if value == 0:
+                    break
+                home = self.home(signatures[self.position(value) * bands + band])
+                # home 不在 (i, j] 区间内时，该条目可以回移到 i
+                if (i <= j and (home <= i or home > j)) or (i > j and home <= i and home > j):
+                    table[i] = value
+                    table[j] = 0
+                    i = j
+        self.times[position] = 0
+        self.count -= 1
+    
+    def resize(self, new_capacity):
+        """扩容段表并重新加入全部有效槽位"""
+        self.init_tables(new_capacity)
+        times = self.times
+        for position in range(self.head, len(times)):
+            if times[position]:
+                self.link(position)
+    
+    def find(self, signature, cutoff=0):
+        """查找相似度不低于阈值且未过期的签名，找不到时返回None"""
+        values = memoryview(signature).cast("Q")
+        signatures, times, mask, bands = self.signatures, self.times, self.mask, self.BANDS
+        checked = set()
+        for band, table in enumerate(self.tables):
+            value = values[band]
+            i = self.home(value)
+            while table[i]:
+                position = self.position(table[i])
+                i = (i + 1) & mask
+                if signatures[position * bands + band] != value or position in checked:
+                    continue
+                checked.add(position)
+                if times[position] >= cutoff:
+                    candidate = self.signature_at(position)
+                    if self.similarity(candidate, signature) >= self.threshold:
+                        return candidate
+        return None
+    
+    def evict(self, cutoff, max_entries, budget=None):
+        """从最旧的一端淘汰过期或超出上限的签名，返回淘汰数量"""
+        times = self.times
+        evicted = 0
+        while self.head < len(times) and (budget is None or evicted < budget):
+            timestamp = times[self.head]
+            if timestamp:
+                over_limit = max_entries and self.count > max_entries
+                if not over_limit and timestamp >= cutoff:
+                    break
+                self.remove_slot(self.head)
+                evicted += 1
+            self.head += 1
+        # 已删除的槽位过半时截掉数组头部，段表中的序号不受影响
+        if self.head > 1024 and self.head * 2 > len(times):
+            del self.signatures[:self.head * self.BANDS]
+            del times[:self.head]
+            self.base += self.head
+            self.head = 0
+        return evicted
+
+class MinHashJournal(DedupJournal):
+    """MinHash 签名的快照和二进制追加日志，每条记录固定68字节"""
+    
+    RECORD = struct.Struct(f"<{MinHashIndex.SIGNATURE_SIZE}sI")  # 签名、时间戳
+    merge_separator = b""
+    
+    def replay(self, index):
+        """按 快照 → 压缩中日志 → 当前日志 的顺序加载签名"""
+        self.needs_recovery = os.path.exists(self.compacting_file)
+        replayed = 0
+        for path in (self.snapshot_file, self.compacting_file, self.journal_file):
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            # 末尾不完整的记录是崩溃时写了一半的，直接丢弃
+            usable = len(data) - len(data) % self.RECORD.size
+            for signature, timestamp in self.RECORD.iter_unpack(data[:usable]):
+                index.insert(signature, timestamp)
+                if path != self.snapshot_file:
+                    replayed += 1
+        self.appended_count = replayed
+        if len(index):
+            logger.info(f"📒 已加载 {len(index)} 条 MinHash 签名")
+    
+    def open(self):
+        """以追加方式打开日志文件"""
+        if os.path.exists(self.journal_file):
+            size = os.path.getsize(self.journal_file)
+            if size % self.RECORD.size:
+                with open(self.journal_file, "r+b") as f:
+                    f.truncate(size - size % self.RECORD.size)
+        self.handle = open(self.journal_file, "ab")
+    
+    def encode_record(self, signature, timestamp):
+        """将一条记录编码为定长字节"""
+        return self.RECORD.pack(signature, timestamp)
+    
+    def take_snapshot(self, index):
+        return index.items()
+    
+    def write_snapshot(self, path, snapshot):
+        with open(path, "wb") as f:
+            f.write(b"".join(self.RECORD.pack(signature, timestamp) for signature, timestamp in snapshot))
+            f.flush()
+            os.fsync(f.fileno())
+        return len(snapshot)
+
+# ============ 去重管理器 ============
+class DeduplicationManager:
+    """去重管理器"""
+    
+    def __init__(self, scope=None):
+        # 不同去重范围使用各自的历史文件，None 为全局范围
+        self.scope = scope
+        self.history_file = scoped_file(Config.dedup_history_file, scope)
+        self.digest_file = scoped_file(Config.dedup_digest_file, scope)
+        self.journal = None
+        self.digest_store = None
+        self.near_journal = None
+        self.near_index = None
+        if Config.enable_near_duplicate:
+            self.load_near_index()
+        if Config.dedup_storage_mode == "binary":
+            self.history = OrderedDict()
+            self.load_digest_store()
+            return
+        
+        history = self.load_history()
+        if Config.dedup_storage_mode == "journal":
+            self.journal = DedupJournal(self.history_file)
+            self.journal.replay(history)
+        # 按时间排序，最旧的条目在最前面，便于增量淘汰
+        self.history = self.apply_retention(history)
+        if self.journal is not None:
+            self.journal.evicted_count = len(history) - len(self.history)
+            self.journal.open()
+            if self.journal.needs_recovery:
+                self.compact()
+    
+    def load_digest_store(self):
+        """加载二进制摘要表、来源频道表，并回放二进制日志"""
+        self.journal = BinaryDedupJournal(self.digest_file)
+        min_capacity = CompactDigestStore.capacity_for(Config.dedup_max_entries or 0)
+        try:
+            self.digest_store = CompactDigestStore.load(self.digest_file, min_capacity)
+        except Exception as e:
+            logger.warning(f"去重摘要表加载失败，将重新建立: {e}")
+            self.digest_store = CompactDigestStore(min_capacity)
+        self.channels = self.journal.load_channels()
+        self.channel_index = {name: i for i, name in enumerate(self.channels)}
+        self.journal.replay(self.digest_store)
+        self.journal.open()
+        if self.journal.needs_recovery:
+            self.compact()
+    
+    def load_near_index(self):
+        """加载 MinHash 签名并按保留期和条数上限淘汰"""
+        self.near_journal = MinHashJournal(scoped_file(Config.near_duplicate_file, self.scope))
+        self.near_index = MinHashIndex(Config.near_duplicate_threshold)
+        self.near_journal.replay(self.near_index)
+        self.near_journal.evicted_count = self.near_index.evict(self.get_expire_cutoff(), Config.dedup_max_entries)
+        self.near_journal.open()
+        if self.near_journal.needs_recovery:
+            self.compact()
+    
+    def intern_source(self, source_info):
+        """将来源描述映射为小整数编号"""
+        index = self.channel_index.get(source_info)
+        if index is not None:
+            return index
+        if len(self.channels) >= 0xFFFF:
+            return 0xFFFF
+        index = len(self.channels)
+        self.channels.append(source_info)
+        self.channel_index[source_info] = index
+        self.journal.save_channels(self.channels)
+        return index
+    
+    def load_history(self):
+        """加载去重历史"""
+        if os.path.exists(self.history_file):
+            try:
+                with open(self.history_file, "r", encoding="utf-8") as f:
+                    content = f.read().strip()
+                    if content:
+                        return json.loads(content)
+            except Exception as e:
+                logger.warning(f"去重历史文件格式错误: {e}")
+        return {}
+    
+    def save_history(self, records=1):
+        """登记后台保存去重历史，多次修改合并为一次写入"""
+        persistence_writer.schedule(self.history_file, self.write_history, records)
+    
+    def write_history(self):
+        """原子写入去重历史（在写入线程中执行）"""
+        # 条目在修改时整体替换，浅复制即可得到一致的快照
+        snapshot = dict(self.history)
+        write_file_atomic(self.history_file, json.dumps(snapshot, indent=2, ensure_ascii=False))
+    
+    def get_expire_cutoff(self):
+        """获取过期时间点，早于此时间的条目视为过期"""
+        if not Config.dedup_retention_days:
+            return 0
+        return time.time() - Config.dedup_retention_days * 86400
+    
+    def apply_retention(self, history):
+        """按保留期和条数上限过滤历史，返回按时间排序的有序字典"""
+        cutoff = self.get_expire_cutoff()
+        items = [
+            (message_hash, entry) for message_hash, entry in history.items()
+            if isinstance(entry, dict) and entry.get("timestamp", 0) >= cutoff
+        ]
+        items.sort(key=lambda item: item[1].get("timestamp", 0))
+        if Config.dedup_max_entries and len(items) > Config.dedup_max_entries:
+            items = items[-Config.dedup_max_entries:]
+        return OrderedDict(items)
+    
+    def evict(self, budget=64):
+        """从最旧的一端增量淘汰过期或超出上限的条目，最多淘汰 budget 条"""
+        cutoff = self.get_expire_cutoff()
+        max_entries = Config.dedup_max_entries
+        if self.near_index is not None:
+            with self.near_journal.lock:
+                self.near_journal.evicted_count += self.near_index.evict(cutoff, max_entries, budget)
+        if self.digest_store is not None:
+            with self.journal.lock:
+                evicted = self.digest_store.evict(cutoff, max_entries, budget)
+                self.journal.evicted_count += evicted
+            return evicted
+        
+        evicted = 0
+        while self.history and evicted < budget:
+            oldest = next(iter(self.history.values()))
+            over_limit = max_entries and len(self.history) > max_entries
+            if not over_limit and oldest.get("timestamp", 0) >= cutoff:
+                break
+            self.history.popitem(last=False)
+            evicted += 1
+        if evicted and self.journal is not None:
+            self.journal.evicted_count += evicted
+        return evicted
+    
+    def should_compact(self):
+        """判断日志是否需要压缩"""
+        return any(journal is not None and journal.should_compact() for journal in (self.journal, self.near_journal))
+    
+    def compact(self):
+        """压缩去重日志"""
+        try:
+            if self.digest_store is not None:
+                self.journal.compact(self.digest_store)
+            elif self.journal is not None:
+                self.journal.compact(self.history)
+            if self.near_journal is not None:
+                self.near_journal.compact(self.near_index)
+        except Exception as e:
+            logger.error(f"压缩去重历史失败: {e}")
+    
+    def close(self):
+        """关闭去重历史存储"""
+        for journal in (self.journal, self.near_journal):
+            if journal is not None:
+                journal.close()
+    
+    def generate_message_hash(self, message):
+        """生成消息哈希（binary模式下为8字节blake2b整数摘要）"""
+        return self.digest_content(self.get_hash_content(message))
+    
+    def generate_album_hash(self, messages):
+        """生成相册哈希：由相册内各消息的特征串组合而成"""
+        parts = sorted(self.get_hash_content(message) for message in messages)
+        return self.digest_content("album:" + "|".join(parts))
+    
+    def digest_content(self, content):
+        """对特征串计算摘要"""
+        hash_content = content.encode('utf-8')
+        if self.digest_store is not None:
+            digest = hashlib.blake2b(hash_content, digest_size=8).digest()
+            # 0 在摘要表中表示空槽位
+            return int.from_bytes(digest, "little") or 1
+        return hashlib.md5(hash_content).hexdigest()
+    
+    def get_hash_content(self, message):
+        """生成用于哈希的消息特征串"""
+        hash_content = ""
+        
+        if message.media:
+            if hasattr(message.media, 'photo'):
+                hash_content += f"photo:{message.media.photo.id}"
+            elif hasattr(message.media, 'document'):
+                hash_content += f"doc:{message.media.document.id}"
+            elif hasattr(message.media, 'video'):
+                hash_content += f"video:{message.media.video.id}"
+            elif hasattr(message.media, 'audio'):
+                hash_content += f"audio:{message.media.audio.id}"
+            else:
+                hash_content += f"media:{type(message.media).__name__}"
+        else:
+            if message.message:
+                normalized_text = re.sub(r'\s+', ' ', message.message.strip().lower())
+                hash_content += f"text:{normalized_text}"
+            else:
+                hash_content += f"empty:{message.id}"
+        
+        return hash_content
+    
+    def generate_text_signature(self, text):
+        """生成纯文本消息的 MinHash 签名，未启用近似重复检测或文本过短时返回None"""
+        if self.near_index is None or not text:
+            return None
+        normalized_text = MinHashIndex.normalize(text)
+        if len(normalized_text) < Config.near_duplicate_min_length:
+            return None
+        return MinHashIndex.signature(normalized_text)
+    
+    def is_near_duplicate(self, signature):
+        """检查历史中是否有相似的文本"""
+        if not Config.enable_content_deduplication or signature is None or self.near_index is None:
+            return False
+        return self.near_index.find(signature, self.get_expire_cutoff()) is not None
+    
+    def is_duplicate(self, message_hash):
+        """检查是否重复"""
+        if not Config.enable_content_deduplication:
+            return False
+        if self.digest_store is not None:
+            timestamp = self.digest_store.get_timestamp(message_hash)
+            return timestamp is not None and timestamp >= self.get_expire_cutoff()
+        entry = self.history.get(message_hash)
+        return entry is not None and entry.get("timestamp", 0) >= self.get_expire_cutoff()
+    
+    def add_to_history(self, message_hash, source_info=""):
         """添加到去重历史"""
-        if Config.enable_content_deduplication and message_hash not in self.history:
-            self.history[message_hash] = {
-                "timestamp": time.time(),
+        self.add_many_to_history([message_hash], source_info)
+    
+    def add_many_to_history(self, message_hashes, source_info="", signatures=()):
+        """批量添加到去重历史，整批只写一次磁盘；signatures 为纯文本消息的 MinHash 签名"""
+        if not Config.enable_content_deduplication:
+            return
+        self.add_signatures(signatures)
+        message_hashes = [h for h in message_hashes if not self.is_duplicate(h)]
+        if not message_hashes:
+            return
+        
+        if self.digest_store is not None:
+            timestamp = int(time.time())
+            source = self.intern_source(source_info)
+            with self.journal.lock:
+                for message_hash in message_hashes:
+                    self.digest_store.insert(message_hash, timestamp, source)
+            self.evict()
+            try:
+                self.journal.append_many([(h, timestamp, source) for h in message_hashes])
+            except Exception as e:
+                logger.error(f"写入去重日志失败: {e}")
+            return
+        
+        records = []
+        now = time.time()
+        for message_hash in message_hashes:
+            entry = {
+                "timestamp": now,
                 "source": source_info
             }
-            self.save_history()
+            # 已过期的旧条目重新放到队尾
+            self.history.pop(message_hash, None)
+            self.history[message_hash] = entry
+            records.append((message_hash, entry))
+        self.evict()
+        if self.journal is not None:
+            try:
+                self.journal.append_many(records)
+            except Exception as e:
+                logger.error(f"写入去重日志失败: {e}")
+        else:
+            self.save_history(len(records))
+    
+    def add_signatures(self, signatures):
+        """将 MinHash 签名写入近似重复索引和日志"""
+        signatures = [signature for signature in signatures if signature is not None]
+        if self.near_index is None or not signatures:
+            return
+        timestamp = int(time.time())
+        with self.near_journal.lock:
+            for signature in signatures:
+                self.near_index.insert(signature, timestamp)
+        try:
+            self.near_journal.append_many([(signature, timestamp) for signature in signatures])
+        except Exception as e:
+            logger.error(f"写入 MinHash 日志失败: {e}")
 
-# ============ 转发历史管理器 ============
-class ForwardHistoryManager:
-    """转发历史管理器"""
+# ============ 转发历史存储后端 ============
+class ForwardHistoryBackend:
+    """转发历史存储后端基类"""
     
-    def __init__(self):
-        self.history_file = Config.forward_history_file
+    def load_index(self):
+        """加载全部转发记录，返回 {channel_key: set(msg_id)}"""
+        raise NotImplementedError
+    
+    def add_record(self, channel_key, msg_id, msg_type="single"):
+        """写入一条转发记录"""
+        raise NotImplementedError
+    
+    def add_records(self, channel_key, records):
+        """批量写入转发记录，records 为 (msg_id, msg_type) 列表"""
+        for msg_id, msg_type in records:
+            self.add_record(channel_key, msg_id, msg_type)
+    
+    def load_high_water_marks(self):
+        """加载每个源频道已处理到的最大消息ID，返回 {source_key: msg_id}"""
+        return {}
+    
+    def set_high_water_mark(self, source_key, msg_id):
+        """记录源频道已处理到的最大消息ID"""
+    
+    def flush(self):
+        """将缓冲中的记录落盘"""
+    
+    def close(self):
+        """关闭后端"""
+        self.flush()
+
+class JsonForwardHistoryBackend(ForwardHistoryBackend):
+    """JSON文件后端（旧格式，每次写入重写整个文件，由后台线程合并写入）"""
+    
+    # 源频道处理进度保存在同一文件的保留键下
+    HIGH_WATER_MARK_KEY = "_high_water_marks"
+    
+    def __init__(self, history_file):
+        self.history_file = history_file
         self.history = self.load_history()
+        self.high_water_marks = self.history.pop(self.HIGH_WATER_MARK_KEY, {})
+        self.normalize_message_ids()
     
     def load_history(self):
         """加载转发历史"""
@@ -386,13 +2449,251 @@ class ForwardHistoryManager:
                 logger.warning(f"转发历史文件格式错误: {e}")
         return {}
     
-    def save_history(self):
-        """保存转发历史"""
+    def save_history(self, records=1):
+        """登记后台保存转发历史，多次修改合并为一次写入"""
+        persistence_writer.schedule(self.history_file, self.write_history, records)
+    
+    def write_history(self):
+        """原子写入转发历史（在写入线程中执行）"""
+        data = {
+            channel_key: dict(channel_data, forwarded_messages=list(channel_data["forwarded_messages"]))
+            for channel_key, channel_data in list(self.history.items())
+        }
+        if self.high_water_marks:
+            data[self.HIGH_WATER_MARK_KEY] = dict(self.high_water_marks)
+        write_file_atomic(self.history_file, json.dumps(data, indent=2, ensure_ascii=False))
+    
+    def normalize_message_ids(self):
+        """将旧格式中的字符串消息ID统一转换为整数"""
+        for data in self.history.values():
+            ids = []
+            for mid in data.get("forwarded_messages", []):
+                try:
+                    ids.append(int(mid))
+                except (TypeError, ValueError):
+                    continue
+            data["forwarded_messages"] = ids
+    
+    def load_index(self):
+        return {
+            channel_key: set(data.get("forwarded_messages", []))
+            for channel_key, data in self.history.items()
+        }
+    
+    def add_record(self, channel_key, msg_id, msg_type="single"):
+        self.add_records(channel_key, [(msg_id, msg_type)])
+    
+    def add_records(self, channel_key, records):
+        if channel_key not in self.history:
+            self.history[channel_key] = {
+                "forwarded_messages": [],
+                "total_count": 0,
+                "last_update": ""
+            }
+        
+        self.history[channel_key]["forwarded_messages"].extend(int(msg_id) for msg_id, _ in records)
+        self.history[channel_key]["total_count"] += len(records)
+        self.history[channel_key]["last_update"] = str(time.time())
+        
+        self.save_history(len(records))
+    
+    def load_high_water_marks(self):
+        return {key: int(msg_id) for key, msg_id in self.high_water_marks.items()}
+    
+    def set_high_water_mark(self, source_key, msg_id):
+        # 进度变化频繁，与转发记录合并为一次后台写入
+        self.high_water_marks[source_key] = int(msg_id)
+        self.save_history()
+
+class SQLiteForwardHistoryBackend(ForwardHistoryBackend):
+    """SQLite后端（WAL模式，按 (channel_key, msg_id) 建索引，批量提交）"""
+    
+    def __init__(self, db_file, json_file=None):
+        self.db_file = db_file
+        self.pending_count = 0
+        self.last_commit = time.time()
+        self.commit_timer = None  # 提交间隔到期时提交未满一批的记录
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.create_tables()
+        if json_file:
+            self.migrate_from_json(json_file)
+    
+    def create_tables(self):
+        """创建数据表"""
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS forwarded_messages (
+                channel_key TEXT NOT NULL,
+                msg_id INTEGER NOT NULL,
+                msg_type TEXT NOT NULL DEFAULT 'single',
+                forwarded_at REAL NOT NULL,
+                PRIMARY KEY (channel_key, msg_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS channel_stats (
+                channel_key TEXT PRIMARY KEY,
+                total_count INTEGER NOT NULL DEFAULT 0,
+                last_update REAL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS source_positions (
+                source_key TEXT PRIMARY KEY,
+                last_msg_id INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            );
+        """)
+        self.conn.commit()
+    
+    def migrate_from_json(self, json_file):
+        """从旧的JSON历史文件一次性迁移"""
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'json_migrated'"
+        ).fetchone()
+        if row or not os.path.exists(json_file):
+            return
+        
+        legacy_backend = JsonForwardHistoryBackend(json_file)
+        legacy = legacy_backend.history
+        migrated = 0
+        now = time.time()
         try:
-            with open(self.history_file, "w", encoding="utf-8") as f:
-                json.dump(self.history, f, indent=2, ensure_ascii=False)
+            for channel_key, data in legacy.items():
+                rows = [
+                    (channel_key, mid, "single", now)
+                    for mid in data.get("forwarded_messages", [])
+                ]
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO forwarded_messages VALUES (?, ?, ?, ?)", rows
+                )
+                try:
+                    last_update = float(data.get("last_update") or now)
+                except (TypeError, ValueError):
+                    last_update = now
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO channel_stats VALUES (?, ?, ?)",
+                    (channel_key, int(data.get("total_count", len(rows))), last_update)
+                )
+                migrated += len(rows)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO source_positions VALUES (?, ?, ?)",
+                [(key, msg_id, now) for key, msg_id in legacy_backend.load_high_water_marks().items()]
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('json_migrated', ?)", (str(now),)
+            )
+            self.conn.commit()
+            logger.info(f"📦 已从 {json_file} 迁移 {migrated} 条转发记录到 {self.db_file}")
         except Exception as e:
-            logger.error(f"保存转发历史失败: {e}")
+            self.conn.rollback()
+            logger.error(f"迁移转发历史失败: {e}")
+    
+    def load_index(self):
+        index = {}
+        for channel_key, msg_id in self.conn.execute(
+            "SELECT channel_key, msg_id FROM forwarded_messages"
+        ):
+            ids = index.get(channel_key)
+            if ids is None:
+                ids = index[channel_key] = set()
+            ids.add(msg_id)
+        return index
+    
+    def add_record(self, channel_key, msg_id, msg_type="single"):
+        self.add_records(channel_key, [(msg_id, msg_type)])
+    
+    def add_records(self, channel_key, records):
+        now = time.time()
+        cursor = self.conn.executemany(
+            "INSERT OR IGNORE INTO forwarded_messages VALUES (?, ?, ?, ?)",
+            [(channel_key, int(msg_id), msg_type, now) for msg_id, msg_type in records]
+        )
+        if cursor.rowcount > 0:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO channel_stats VALUES (?, 0, ?)", (channel_key, now)
+            )
+            self.conn.execute(
+                "UPDATE channel_stats SET total_count = total_count + ?, last_update = ? "
+                "WHERE channel_key = ?",
+                (cursor.rowcount, now, channel_key)
+            )
+        
+        self.mark_pending(len(records), now)
+    
+    def load_high_water_marks(self):
+        return dict(self.conn.execute("SELECT source_key, last_msg_id FROM source_positions"))
+    
+    def set_high_water_mark(self, source_key, msg_id):
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO source_positions VALUES (?, ?, ?)",
+            (source_key, int(msg_id), now)
+        )
+        self.mark_pending(1, now)
+    
+    def mark_pending(self, count, now):
+        """批量提交，避免每条消息都触发一次磁盘同步"""
+        self.pending_count += count
+        if (self.pending_count >= Config.history_commit_batch_size
+                or now - self.last_commit >= Config.history_commit_interval):
+            self.flush()
+        elif self.commit_timer is None:
+            # 之后没有新记录时也在提交间隔到期后提交（连接只在事件循环线程中使用）
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            delay = max(0.0, self.last_commit + Config.history_commit_interval - now)
+            self.commit_timer = loop.call_later(delay, self.flush)
+    
+    def flush(self):
+        if self.commit_timer is not None:
+            self.commit_timer.cancel()
+            self.commit_timer = None
+        if not self.pending_count:
+            return
+        try:
+            self.conn.commit()
+        except Exception as e:
+            logger.error(f"提交转发历史失败: {e}")
+            return
+        self.pending_count = 0
+        self.last_commit = time.time()
+    
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+def create_forward_history_backend():
+    """根据配置创建转发历史存储后端"""
+    if Config.forward_history_backend == "json":
+        return JsonForwardHistoryBackend(Config.forward_history_file)
+    if Config.forward_history_backend == "sqlite":
+        return SQLiteForwardHistoryBackend(
+            Config.forward_history_db, Config.forward_history_file
+        )
+    raise ValueError(f"未知的转发历史存储后端: {Config.forward_history_backend}")
+
+# ============ 转发历史管理器 ============
+class ForwardHistoryManager:
+    """转发历史管理器"""
+    
+    def __init__(self, backend=None):
+        self.backend = backend or create_forward_history_backend()
+        # 内存索引：启动时构建一次，之后随 add_forward_record 增量更新
+        self.forwarded_index = self.backend.load_index()
+        # 每个源频道已处理到的最大消息ID，用于断线后补发
+        self.high_water_marks = self.backend.load_high_water_marks()
+    
+    def save_history(self):
+        """保存转发历史"""
+        self.backend.flush()
+    
+    def close(self):
+        """关闭存储后端"""
+        self.backend.close()
     
     def get_channel_key(self, src_id, dst_id):
         """生成频道键"""
@@ -401,32 +2702,280 @@ class ForwardHistoryManager:
     def is_already_forwarded(self, src_id, dst_id, msg_id):
         """检查消息是否已经转发过"""
         channel_key = self.get_channel_key(src_id, dst_id)
-        if channel_key not in self.history:
-            return False
-        
-        forwarded_messages = self.history[channel_key].get("forwarded_messages", [])
-        return str(msg_id) in [str(mid) for mid in forwarded_messages]
+        forwarded_ids = self.forwarded_index.get(channel_key)
+        return forwarded_ids is not None and int(msg_id) in forwarded_ids
     
     def add_forward_record(self, src_id, dst_id, msg_id, msg_type="single"):
         """添加转发记录"""
+        self.add_forward_records(src_id, dst_id, [(msg_id, msg_type)])
+    
+    def add_forward_records(self, src_id, dst_id, records):
+        """批量添加转发记录，records 为 (msg_id, msg_type) 列表"""
         channel_key = self.get_channel_key(src_id, dst_id)
-        if channel_key not in self.history:
-            self.history[channel_key] = {
-                "forwarded_messages": [],
-                "total_count": 0,
-                "last_update": ""
-            }
+        forwarded_ids = self.forwarded_index.get(channel_key)
+        if forwarded_ids is None:
+            forwarded_ids = self.forwarded_index[channel_key] = set()
+        forwarded_ids.update(int(msg_id) for msg_id, _ in records)
+        self.backend.add_records(channel_key, records)
+    
+    def get_high_water_mark(self, src_id):
+        """获取源频道已处理到的最大消息ID，从未处理过时返回None"""
+        return self.high_water_marks.get(normalize_channel_id(src_id))
+    
+    def update_high_water_mark(self, src_id, msg_id):
+        """推进源频道的处理进度，只在消息ID更大时写入"""
+        source_key = normalize_channel_id(src_id)
+        if msg_id > self.high_water_marks.get(source_key, 0):
+            self.high_water_marks[source_key] = msg_id
+            self.backend.set_high_water_mark(source_key, msg_id)
+
+# ============ 目标频道扫描 ============
+class TargetScanner:
+    """流式扫描目标频道已有消息，建立去重历史
+    
+    每一轮从最新消息向旧消息扫描，按消息ID记录进度：
+    low 为本轮已处理到的最小ID，中断后从 low 继续；一轮完成后记录 done_up_to，
+    之后只扫描比它更新的消息。
+    """
+    
+    def __init__(self, checkpoint_file):
+        self.checkpoint_file = checkpoint_file
+        self.checkpoints = self.load()
+    
+    def load(self):
+        """加载扫描进度"""
+        if os.path.exists(self.checkpoint_file):
+            try:
+                with open(self.checkpoint_file, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except Exception as e:
+                logger.warning(f"扫描进度文件格式错误，将重新扫描: {e}")
+        return {}
+    
+    def save(self):
+        """登记后台写入扫描进度"""
+        persistence_writer.schedule(self.checkpoint_file, self.write)
+    
+    def write(self):
+        """原子写入扫描进度（在写入线程中执行）"""
+        snapshot = {key: dict(state) for key, state in list(self.checkpoints.items())}
+        write_file_atomic(self.checkpoint_file, json.dumps(snapshot, indent=2))
+    
+    async def scan(self, client, target, dedup_manager, scope):
+        """扫描一个目标频道，将消息哈希批量写入去重管理器，返回本次扫描的消息数"""
+        key = f"{scope}:{normalize_channel_id(target.id)}"
+        state = self.checkpoints.setdefault(key, {"done_up_to": 0, "top": None, "low": None, "scanned": 0})
+        name = get_channel_name(target)
         
-        self.history[channel_key]["forwarded_messages"].append(str(msg_id))
-        self.history[channel_key]["total_count"] += 1
-        self.history[channel_key]["last_update"] = str(time.time())
+        # 开始新一轮扫描：记录当前最新消息ID作为本轮上界
+        if state["top"] is None:
+            latest = await client.get_messages(target, limit=1)
+            if not latest or latest[0].id <= state["done_up_to"]:
+                return 0
+            state.update(top=latest[0].id, low=latest[0].id + 1, scanned=0)
+            self.save()
+        else:
+            logger.info(f"🔍 继续扫描 {name}，从消息 {state['low']} 之前开始（本轮已扫描 {state['scanned']} 条）")
         
-        self.save_history()
+        limit = None
+        if Config.target_channel_scan_limit:
+            limit = max(0, Config.target_channel_scan_limit - state["scanned"])
+        source_info = f"扫描:{name}({target.id})"
+        started = time.monotonic()
+        scanned = 0
+        pending = 0  # 上次保存进度后扫描的消息数
+        last_id = None
+        hashes = []
+        signatures = []
+        album = []
+        
+        def flush():
+            """批量写入去重历史并保存进度"""
+            nonlocal pending
+            if album:
+                hashes.append(dedup_manager.generate_album_hash(album))
+                album.clear()
+            dedup_manager.add_many_to_history(hashes, source_info, signatures)
+            hashes.clear()
+            signatures.clear()
+            state["low"] = last_id
+            state["scanned"] += pending
+            pending = 0
+            self.save()
+        
+        async for message in client.iter_messages(
+            target, limit=limit, offset_id=state["low"], min_id=state["done_up_to"]
+        ):
+            # 相册消息连续出现，按 grouped_id 合并后计算与实时转发一致的相册哈希
+            if album and message.grouped_id != album[0].grouped_id:
+                hashes.append(dedup_manager.generate_album_hash(album))
+                album.clear()
+            # 只在相册边界保存进度，相册不会被拆到两批中
+            if not album and pending >= Config.scan_batch_size:
+                flush()
+            
+            last_id = message.id
+            scanned += 1
+            pending += 1
+            if message.message is None and not message.media:
+                continue
+            if Config.enable_album_forward and message.grouped_id:
+                album.append(message)
+            else:
+                hashes.append(dedup_manager.generate_message_hash(message))
+                if not message.media:
+                    signatures.append(dedup_manager.generate_text_signature(message.message))
+        
+        if last_id is not None:
+            flush()
+        
+        # 本轮完成
+        state.update(done_up_to=state["top"], top=None, low=None)
+        self.save()
+        logger.info(f"✅ 目标频道 {name} 扫描完成，本次 {scanned} 条，耗时 {time.monotonic() - started:.1f}秒")
+        return scanned
+
+# ============ 路由表 ============
+def get_route_config():
+    """获取路由配置，未配置路由表时由预设的源频道和目标频道生成"""
+    if Config.routes:
+        return Config.routes
+    return [{
+        "sources": Config.preset_source_channels,
+        "targets": [{"target": Config.preset_target_channel, "dedup_scope": "global"}],
+    }]
+
+async def build_routes(client_manager, filter_manager, dedup_manager):
+    """解析路由配置中的频道，编译为按源频道汇总的路由列表
+    
+    每个源频道对应一条路由 {"source": 实体, "targets": [目标路由]}，目标路由包含目标实体、
+    过滤器和去重管理器。全部频道先去重后并发解析，相同的过滤配置和去重范围共用同一个实例。
+    """
+    route_configs = get_route_config()
+    for route_config in route_configs:
+        route_config["targets"] = [
+            target if isinstance(target, dict) else {"target": target}
+            for target in route_config["targets"]
+        ]
+    aliases = list(dict.fromkeys(
+        [channel for route_config in route_configs for channel in route_config["sources"]]
+        + [target["target"] for route_config in route_configs for target in route_config["targets"]]
+    ))
+    entities = await client_manager.resolve_entities(aliases)
+    
+    filters = {None: filter_manager}
+    dedup_managers = {"global": dedup_manager}
+    routes = {}
+    
+    for route_config in route_configs:
+        targets = []
+        for target_config in route_config["targets"]:
+            target = entities[target_config["target"]]
+            
+            profile = target_config.get("filter")
+            if profile not in filters:
+                if profile not in Config.filter_profiles:
+                    raise ValueError(f"未定义的过滤配置: {profile}")
+                filters[profile] = MessageFilter(Config.filter_profiles[profile])
+            
+            scope = target_config.get("dedup_scope") or normalize_channel_id(target.id)
+            if scope not in dedup_managers:
+                dedup_managers[scope] = DeduplicationManager(scope)
+            
+            targets.append({
+                "target": target,
+                "filter": filters[profile],
+                "dedup": dedup_managers[scope],
+                "dedup_scope": scope,
+            })
+            logger.info(f"✅ 目标频道验证成功: {get_channel_name(target)}（过滤配置 {profile or '默认'}，去重范围 {scope}）")
+        
+        for channel in route_config["sources"]:
+            source = entities[channel]
+            route = routes.setdefault(utils.get_peer_id(source), {"source": source, "targets": []})
+            # 同一源频道出现在多条路由中时合并目标，相同目标只保留一个
+            known = {target["target"].id for target in route["targets"]}
+            route["targets"].extend(t for t in targets if t["target"].id not in known)
+            logger.info(f"✅ 源频道验证成功: {get_channel_name(source)}")
+    
+    return list(routes.values())
+
+# ============ 处理进度 ============
+class SourceProgress:
+    """跟踪一个源频道已入队消息单元的完成情况，计算可以安全保存的处理进度
+    
+    单元在入队时登记，所有目标都已跳过、过滤或确实发送成功后才算完成。
+    进度只推进到最小的未完成或失败单元之前：仍在批量转发窗口中、被其他工作协程
+    乱序超过、转发失败或因队列满被丢弃的消息都不会被跳过。断线补发期间进度
+    停在缺口之前（hold），补发把缺口中的消息全部登记后才解除。
+    """
+    
+    def __init__(self):
+        self.pending = []  # 未完成单元ID的小顶堆（惰性删除）
+        self.pending_ids = set()
+        self.completed = []  # 已完成、但前面还有未完成单元的ID（小顶堆）
+        self.failed = set()  # 失败的单元ID，重试成功或被跳过前阻止进度推进
+        self.hold = None  # 补发完成前进度不越过的消息ID
+    
+    def register(self, unit_id):
+        """登记一个已入队的单元"""
+        self.failed.discard(unit_id)
+        if unit_id not in self.pending_ids:
+            self.pending_ids.add(unit_id)
+            heapq.heappush(self.pending, unit_id)
+    
+    def floor(self):
+        """最小的未完成、失败或冻结的消息ID，没有时返回None"""
+        while self.pending and self.pending[0] not in self.pending_ids:
+            heapq.heappop(self.pending)
+        candidates = [self.hold] if self.hold is not None else []
+        if self.pending:
+            candidates.append(self.pending[0])
+        if self.failed:
+            candidates.append(min(self.failed))
+        return min(candidates) if candidates else None
+    
+    def advance(self):
+        """返回可以推进到的进度（消息ID），不能推进时返回None"""
+        floor = self.floor()
+        progress = None
+        while self.completed and (floor is None or self.completed[0] < floor):
+            progress = heapq.heappop(self.completed)
+        return progress
+    
+    def complete(self, unit_id):
+        """单元完成，返回可以推进到的进度"""
+        if unit_id not in self.pending_ids:
+            return None
+        self.pending_ids.discard(unit_id)
+        heapq.heappush(self.completed, unit_id)
+        return self.advance()
+    
+    def fail(self, unit_id):
+        """单元处理或转发失败（包括入队时被丢弃），等待重试"""
+        self.pending_ids.discard(unit_id)
+        self.failed.add(unit_id)
+    
+    def skip(self, unit_id):
+        """放弃重试失败的单元，返回可以推进到的进度"""
+        self.failed.discard(unit_id)
+        return self.advance()
+    
+    def hold_at(self, unit_id):
+        """补发开始前冻结进度：不越过 unit_id"""
+        self.hold = unit_id if self.hold is None else min(self.hold, unit_id)
+    
+    def release_hold(self):
+        """补发已登记缺口中的全部消息，解除冻结并返回可以推进到的进度"""
+        self.hold = None
+        return self.advance()
 
 # ============ 实时转发器 ============
 class RealtimeForwarder:
     """实时转发器"""
     
+    RETRY_DELAYS = (30, 120, 600)  # 失败单元和补发的重试间隔（秒），用完后跳过
+    
     def __init__(self, client_manager, filter_manager, dedup_manager, history_manager):
         self.client_manager = client_manager
         self.filter_manager = filter_manager
@@ -435,154 +2984,725 @@ class RealtimeForwarder:
         self.is_running = False
         self.reconnect_attempts = 0
         self.last_health_check = time.time()
+        self.client_retry_tasks = {}  # 账号名称 -> 后台重试启动的任务
+        self.scan_task = None
+        self.backfill_task = None
+        self.stop_event = asyncio.Event()  # SIGINT/SIGTERM 触发停止
+        self.stopped = False
         
-    async def start_forwarding(self, source_channels, target_channel):
+        # 处理队列：事件处理器只负责入队，由工作协程过滤和转发
+        self.message_queue = None
+        self.worker_tasks = []
+        self.inflight_hashes = set()
+        self.pipeline_stats = {
+            "received": 0,
+            "dropped": 0,
+            "processed": 0,
+            "failed": 0,
+            "max_queue_depth": 0,
+            "wait_times": deque(maxlen=1000),  # 最近的排队耗时（秒）
+            "latencies": deque(maxlen=1000),  # 最近的入队到处理完成耗时（秒）
+            "batches": 0,
+            "batched_messages": 0,
+            "backfilled": 0,
+        }
+        
+        # 批量转发：(源频道ID, 目标频道ID) -> 等待合并发送的消息
+        self.pending_batches = {}
+        
+        # 处理进度：源频道ID -> SourceProgress；(源频道ID, 单元ID) -> 尚未完成的目标数
+        self.source_progress = {}
+        self.unit_targets = {}
+        self.unit_retries = {}  # (源频道ID, 单元ID) -> 已重试次数
+        
+        # 路由表：源频道 peer ID -> 路由，所有源频道共用一个事件处理器
+        self.routes = {}
+        self.listener_client = None
+        self.dedup_managers = [dedup_manager]  # 全部去重范围的管理器
+        
+        # 录制收到的消息，用于离线回放
+        self.recorder = EventRecorder(Config.event_capture_file) if Config.event_capture_file else None
+        
+    async def start_forwarding(self, routes):
         """开始实时转发"""
         logger.info("🚀 启动实时转发服务...")
         self.is_running = True
         
-        # 启动所有客户端
-        await self.start_all_clients()
+        # 启动后台写入线程，文件写入不再阻塞事件循环
+        persistence_writer.start()
+        
+        # 启动处理队列和工作协程
+        self.start_workers()
         
+        # 启动本地指标接口
+        metrics.add_collector(self.collect_metrics)
+        if Config.enable_metrics:
+            await metrics.start(Config.metrics_host, Config.metrics_port)
+        if self.recorder is not None:
+            logger.info(f"🎥 正在录制收到的消息到 {self.recorder.capture_file}")
+
         # 设置消息监听器
-        await self.setup_listeners(source_channels, target_channel)
+        await self.setup_listeners(routes)
+        
+        # 补发停机期间遗漏的消息
+        self.start_backfill()
         
         # 启动健康检查
         asyncio.create_task(self.health_check_loop())
         
+        # 启动去重日志后台压缩
+        asyncio.create_task(self.dedup_compaction_loop())
+        
+        # 在后台重新验证过期的频道实体缓存
+        asyncio.create_task(self.client_manager.revalidate_entities())
+        
+        # 在后台扫描目标频道，实时转发不等待扫描完成
+        if Config.enable_content_deduplication and Config.enable_target_scan:
+            self.scan_task = asyncio.create_task(self.scan_targets(routes))
+        
         logger.info("✅ 实时转发服务已启动")
         
-        # 保持运行
+        # 保持运行。Ctrl+C 和 pkill 的 SIGTERM 都触发停止事件；在 asyncio.run 中
+        # KeyboardInterrupt 表现为取消任务，由 finally 保证停止流程执行、数据落盘
+        self.install_signal_handlers()
         try:
-            while self.is_running:
-                await asyncio.sleep(1)
-        except KeyboardInterrupt:
-            logger.info("🛑 收到停止信号，正在关闭服务...")
+            while self.is_running and not self.stop_event.is_set():
+                try:
+                    await asyncio.wait_for(self.stop_event.wait(), 1)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
             await self.stop_forwarding()
     
+    def install_signal_handlers(self):
+        """将 SIGINT/SIGTERM 转为停止事件（Windows 不支持，仍由 KeyboardInterrupt 取消任务）"""
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.request_stop, signum)
+            except (NotImplementedError, RuntimeError):
+                pass
+    
+    def request_stop(self, signum=None):
+        """请求停止服务"""
+        if signum is not None:
+            logger.info(f"🛑 收到停止信号 {signal.Signals(signum).name}，正在关闭服务...")
+        self.stop_event.set()
+    
     async def start_all_clients(self):
-        """启动所有客户端"""
-        for client_data in self.client_manager.clients:
+        """并发启动所有客户端，单个账号超时不影响其他账号"""
+        started = time.monotonic()
+        clients = self.client_manager.clients
+        
+        # 需要输入验证码的账号先逐个交互登录：input() 会阻塞事件循环，
+        # 放在并发启动中会使其他账号的启动超时而被误停用
+        needs_login = await asyncio.gather(*[self.needs_login(client_data) for client_data in clients])
+        for client_data, login in zip(clients, needs_login):
+            if login:
+                await self.login_client(client_data)
+        
+        results = await asyncio.gather(*[self.start_client(client_data) for client_data in clients])
+        
+        elapsed = time.monotonic() - started
+        timings = "，".join(f"{c['name']} {c['start_time']:.1f}秒" for c in clients if c["start_time"] is not None)
+        logger.info(f"🚀 {sum(results)}/{len(clients)} 个账号启动成功，总耗时 {elapsed:.1f}秒（{timings}）")
+        
+        # 当前账号启动失败时换用第一个可用账号监听和解析频道
+        if clients and not clients[self.client_manager.current_index]["enabled"]:
+            for index, client_data in enumerate(clients):
+                if client_data["enabled"]:
+                    self.client_manager.current_index = index
+                    break
+        
+        # 重连时监听账号变化，需要把监听器转移到新账号，否则不会再收到消息
+        current_client = self.client_manager.get_current_client() if clients else None
+        if self.listener_client is not None and current_client is not self.listener_client:
+            self.register_dispatchers(current_client)
+            logger.info(f"👂 监听器已转移到账号 {self.client_manager.clients[self.client_manager.current_index]['name']}")
+    
+    async def needs_login(self, client_data):
+        """连接账号并检查是否需要交互登录，连接失败留给 start_client 处理"""
+        client = client_data["client"]
+        try:
+            await asyncio.wait_for(client.connect(), Config.client_start_timeout)
+            return not await asyncio.wait_for(client.is_user_authorized(), Config.client_start_timeout)
+        except Exception:
+            return False
+    
+    async def login_client(self, client_data):
+        """交互登录单个账号（需要输入手机号和验证码，不设超时）"""
+        logger.info(f"🔐 账号 {client_data['name']} 需要登录")
+        try:
+            await client_data["client"].start()
+        except Exception as e:
+            logger.error(f"❌ 账号 {client_data['name']} 登录失败: {e}")
+    
+    async def start_client(self, client_data, schedule_retry=True):
+        """启动单个账号并记录耗时，失败或超时时停用该账号并安排后台重试"""
+        client = client_data["client"]
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(client.connect(), Config.client_start_timeout)
+            if not await asyncio.wait_for(client.is_user_authorized(), Config.client_start_timeout):
+                # 交互登录只在 start_all_clients 中逐个进行，后台重试时不能等待输入
+                raise Exception("账号未登录，请重启程序完成登录")
+            await asyncio.wait_for(client.start(), Config.client_start_timeout)
+        except Exception as e:
+            client_data["start_time"] = time.monotonic() - started
+            reason = "启动超时" if isinstance(e, asyncio.TimeoutError) else f"启动失败: {e}"
+            logger.error(f"❌ 账号 {client_data['name']} {reason}（{client_data['start_time']:.1f}秒），暂时停用")
+            client_data["enabled"] = False
+            if schedule_retry and client_data["name"] not in self.client_retry_tasks:
+                self.client_retry_tasks[client_data["name"]] = asyncio.create_task(
+                    self.retry_client_start(client_data)
+                )
+            return False
+        
+        client_data["start_time"] = time.monotonic() - started
+        client_data["enabled"] = True
+        logger.info(f"✅ 账号 {client_data['name']} 启动成功（{client_data['start_time']:.1f}秒）")
+        return True
+    
+    async def retry_client_start(self, client_data):
+        """在后台定期重试启动失败的账号，成功后重新加入发送账号池"""
+        try:
+            while True:
+                await asyncio.sleep(Config.client_start_retry_interval)
+                logger.info(f"🔄 重试启动账号 {client_data['name']}...")
+                if await self.start_client(client_data, schedule_retry=False):
+                    return
+        finally:
+            self.client_retry_tasks.pop(client_data["name"], None)
+    
+    async def setup_listeners(self, routes):
+        """设置消息监听器"""
+        # 预先建立 chat_id -> 路由 的索引，事件分发时只需一次字典查找
+        for route in routes:
+            self.routes[utils.get_peer_id(route["source"])] = route
+            active_listeners.add(normalize_channel_id(route["source"].id))
+            for target in route["targets"]:
+                if target["dedup"] not in self.dedup_managers:
+                    self.dedup_managers.append(target["dedup"])
+        
+        # 监听开始前冻结进度，实时消息不会在补发完成前把进度推过停机期间的缺口
+        self.hold_progress()
+        self.register_dispatchers(self.client_manager.get_current_client())
+        for route in routes:
+            logger.info(f"👂 已为频道 {get_channel_name(route['source'])} 设置监听器（{len(route['targets'])} 个目标）")
+    
+    def register_dispatchers(self, client):
+        """在监听账号上注册唯一的事件处理器，覆盖全部源频道"""
+        if self.listener_client is not None:
+            self.listener_client.remove_event_handler(self.handle_message)
+            self.listener_client.remove_event_handler(self.handle_album)
+        
+        chats = [route["source"] for route in self.routes.values()]
+        client.add_event_handler(self.handle_message, events.NewMessage(chats=chats))
+        # 相册整体作为一个单元处理
+        if Config.enable_album_forward:
+            client.add_event_handler(self.handle_album, events.Album(chats=chats))
+        self.listener_client = client
+    
+    def start_workers(self):
+        """创建处理队列并启动工作协程"""
+        self.message_queue = asyncio.Queue(maxsize=Config.message_queue_size)
+        self.worker_tasks = [
+            asyncio.create_task(self.message_worker(worker_id))
+            for worker_id in range(Config.worker_count)
+        ]
+        logger.info(f"⚙️ 已启动 {Config.worker_count} 个消息处理协程，队列上限 {Config.message_queue_size}")
+    
+    async def handle_message(self, event):
+        """接收新消息并放入处理队列，不在事件处理器中执行过滤和转发"""
+        route = self.routes.get(event.chat_id)
+        if route is None:
+            return
+        # 相册中的每条消息也会单独触发 NewMessage，在这里录制即可覆盖全部消息
+        if self.recorder is not None:
+            self.recorder.record([event.message])
+        # 相册中的消息由 handle_album 统一处理
+        if Config.enable_album_forward and event.message.grouped_id:
+            return
+        self.enqueue_messages([event.message], route)
+    
+    async def handle_album(self, event):
+        """接收相册并作为一个单元放入处理队列"""
+        route = self.routes.get(event.chat_id)
+        if route is None:
+            return
+        self.enqueue_messages(list(event.messages), route)
+    
+    def enqueue_messages(self, messages, route):
+        """将一条消息或一个相册放入处理队列，队列满时丢弃并计数"""
+        stats = self.pipeline_stats
+        stats["received"] += 1
+        metrics.inc("tg_forward_received_total", len(messages), origin="live")
+        try:
+            self.message_queue.put_nowait({
+                "messages": messages,
+                "route": route,
+                "enqueued_at": time.monotonic(),
+            })
+        except asyncio.QueueFull:
+            stats["dropped"] += 1
+            metrics.inc("tg_forward_dropped_total", len(messages))
+            logger.warning(f"⚠️ 处理队列已满，丢弃消息: {describe_messages(messages)}（累计丢弃 {stats['dropped']} 条）")
+            # 丢弃的消息阻止进度越过它，稍后重试
+            self.get_source_progress(route["source"].id).fail(max(m.id for m in messages))
+            self.retry_later(messages, route)
+            return
+        self.register_unit(messages, route)
+        
+        queue_depth = self.message_queue.qsize()
+        if queue_depth > stats["max_queue_depth"]:
+            stats["max_queue_depth"] = queue_depth
+    
+    async def message_worker(self, worker_id):
+        """工作协程：从队列取出消息并处理"""
+        stats = self.pipeline_stats
+        while self.is_running:
+            item = await self.message_queue.get()
+            stats["wait_times"].append(time.monotonic() - item["enqueued_at"])
             try:
-                await client_data["client"].start()
-                logger.info(f"✅ 账号 {client_data['name']} 启动成功")
+                # 进度在每个目标确实发送（或跳过、过滤）后由 finish_target 推进
+                await self.process_messages(item["messages"], item["route"])
+                stats["processed"] += 1
             except Exception as e:
-                logger.error(f"❌ 账号 {client_data['name']} 启动失败: {e}")
-                client_data["enabled"] = False
+                stats["failed"] += 1
+                metrics.inc("tg_forward_failed_total", len(item["messages"]))
+                # 去掉服务消息后重新登记过的单元也一并标记失败
+                remaining = [m for m in item["messages"] if m.message is not None or m.media]
+                for unit_messages in (item["messages"], remaining):
+                    if unit_messages:
+                        self.finish_target(item["route"]["source"], unit_messages, False)
+                logger.error(f"❌ 工作协程 {worker_id} 处理消息 {describe_messages(item['messages'])} 失败: {e}")
+            finally:
+                stats["latencies"].append(time.monotonic() - item["enqueued_at"])
+                self.message_queue.task_done()
     
-    async def setup_listeners(self, source_channels, target_channel):
-        """设置消息监听器"""
-        client = self.client_manager.get_current_client()
+    def get_source_progress(self, source_id):
+        """获取源频道的处理进度跟踪器"""
+        progress = self.source_progress.get(source_id)
+        if progress is None:
+            progress = self.source_progress[source_id] = SourceProgress()
+        return progress
+    
+    def register_unit(self, messages, route):
+        """登记已入队的单元，所有目标完成前进度不会越过它"""
+        source_id = route["source"].id
+        unit_id = max(m.id for m in messages)
+        self.get_source_progress(source_id).register(unit_id)
+        self.unit_targets.setdefault((source_id, unit_id), len(route["targets"]))
+    
+    def finish_target(self, source_channel, messages, success):
+        """一个目标处理结束：全部目标成功后完成单元并推进进度，任一目标失败则单元失败
         
-        # 为每个源频道设置监听器
-        for source_channel in source_channels:
-            channel_id = normalize_channel_id(source_channel.id)
-            
-            @client.on(events.NewMessage(chats=source_channel))
-            async def handle_new_message(event):
-                await self.handle_message(event, source_channel, target_channel)
-            
-            logger.info(f"👂 已为频道 {get_channel_name(source_channel)} 设置监听器")
-            active_listeners.add(channel_id)
+        跳过和过滤也算成功；单元已完成或已失败时忽略。
+        """
+        source_id = source_channel.id
+        unit_id = max(m.id for m in messages)
+        key = (source_id, unit_id)
+        remaining = self.unit_targets.get(key)
+        if remaining is None:
+            return
+        progress = self.get_source_progress(source_id)
+        if not success:
+            del self.unit_targets[key]
+            progress.fail(unit_id)
+            route = self.routes.get(utils.get_peer_id(source_channel))
+            if route is not None:
+                self.retry_later(messages, route)
+            return
+        if remaining > 1:
+            self.unit_targets[key] = remaining - 1
+            return
+        del self.unit_targets[key]
+        self.unit_retries.pop(key, None)
+        self.advance_progress(source_id, progress.complete(unit_id))
+    
+    def advance_progress(self, source_id, high_water_mark):
+        """保存推进后的处理进度"""
+        if high_water_mark is not None:
+            self.history_manager.update_high_water_mark(source_id, high_water_mark)
+    
+    def retry_later(self, messages, route):
+        """失败的单元稍后重新入队；重试次数用完后跳过，不再阻止进度推进"""
+        source_id = route["source"].id
+        unit_id = max(m.id for m in messages)
+        key = (source_id, unit_id)
+        attempt = self.unit_retries.get(key, 0)
+        if attempt >= len(self.RETRY_DELAYS) or not self.is_running:
+            self.unit_retries.pop(key, None)
+            if self.is_running:
+                logger.error(f"❌ 消息 {describe_messages(messages)} 重试 {attempt} 次仍失败，已跳过")
+                self.advance_progress(source_id, self.get_source_progress(source_id).skip(unit_id))
+            return
+        self.unit_retries[key] = attempt + 1
+        asyncio.get_running_loop().call_later(self.RETRY_DELAYS[attempt], self.retry_unit, messages, route)
+    
+    def retry_unit(self, messages, route):
+        """重新放入处理队列，队列满时计为一次失败"""
+        if not self.is_running:
+            return
+        logger.info(f"🔁 重试失败的消息: {describe_messages(messages)}")
+        try:
+            self.message_queue.put_nowait({
+                "messages": messages,
+                "route": route,
+                "enqueued_at": time.monotonic(),
+            })
+        except asyncio.QueueFull:
+            self.retry_later(messages, route)
+            return
+        self.register_unit(messages, route)
     
-    async def handle_message(self, event, source_channel, target_channel):
-        """处理新消息"""
-        message = event.message
+    def get_pipeline_stats(self):
+        """获取处理队列统计：队列深度、排队耗时、端到端耗时和丢弃数量"""
+        stats = self.pipeline_stats
+        
+        def percentile(samples, ratio):
+            if not samples:
+                return 0.0
+            ordered = sorted(samples)
+            return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
         
+        return {
+            "queue_depth": self.message_queue.qsize() if self.message_queue else 0,
+            "max_queue_depth": stats["max_queue_depth"],
+            "received": stats["received"],
+            "processed": stats["processed"],
+            "batches": stats["batches"],
+            "batched_messages": stats["batched_messages"],
+            "backfilled": stats["backfilled"],
+            "failed": stats["failed"],
+            "dropped": stats["dropped"],
+            "wait_p50": percentile(stats["wait_times"], 0.5),
+            "wait_p99": percentile(stats["wait_times"], 0.99),
+            "latency_p50": percentile(stats["latencies"], 0.5),
+            "latency_p99": percentile(stats["latencies"], 0.99),
+        }
+    
+    async def process_messages(self, messages, route):
+        """处理一条消息或一个相册：只计算一次哈希，再并发转发到路由中的每个目标"""
         # 跳过服务消息
-        if message.message is None and not message.media:
-            logger.debug(f"跳过服务消息: {message.id}")
+        source_channel = route["source"]
+        original = messages
+        messages = [m for m in messages if m.message is not None or m.media]
+        if not messages:
+            logger.debug("跳过服务消息")
+            for _ in route["targets"]:
+                self.finish_target(source_channel, original, True)
             return
+        if len(messages) < len(original):
+            # 单元ID按剩余消息重新登记，再完成原来的登记
+            self.register_unit(messages, route)
+            for _ in route["targets"]:
+                self.finish_target(source_channel, original, True)
         
-        # 检查是否已经转发过
-        if self.history_manager.is_already_forwarded(
-            source_channel.id, target_channel.id, message.id
-        ):
-            logger.debug(f"跳过已转发消息: {message.id}")
-            return
+        # 内容哈希和过滤所需的特征只计算一次，所有目标共用
+        if len(messages) == 1:
+            message_hash = self.dedup_manager.generate_message_hash(messages[0])
+        else:
+            message_hash = self.dedup_manager.generate_album_hash(messages)
+        # 相册以说明文字和是否含媒体作为整体判断
+        text = next((m.message for m in messages if m.message and m.message.strip()), None)
+        has_media = any(m.media is not None for m in messages)
+        # 纯文本消息另外计算 MinHash 签名，用于识别近似重复
+        signature = None if has_media else self.dedup_manager.generate_text_signature(text)
+        unit = (messages, message_hash, signature)
         
-        # 内容去重检查
-        message_hash = self.dedup_manager.generate_message_hash(message)
-        if self.dedup_manager.is_duplicate(message_hash):
-            logger.debug(f"跳过重复内容: {message.id}")
+        targets = route["targets"]
+        if len(targets) == 1:
+            await self.process_target(unit, text, has_media, route["source"], targets[0])
             return
         
-        # 内容过滤
-        has_media = message.media is not None
-        has_text = message.message is not None and message.message.strip()
+        results = await asyncio.gather(*[
+            self.process_target(unit, text, has_media, route["source"], target)
+            for target in targets
+        ], return_exceptions=True)
+        errors_found = [result for result in results if isinstance(result, Exception)]
+        for target, result in zip(targets, results):
+            if isinstance(result, Exception):
+                logger.error(f"❌ 转发到 {get_channel_name(target['target'])} 失败: {result}")
+        if errors_found:
+            raise errors_found[0]
+    
+    async def process_target(self, unit, text, has_media, source_channel, target):
+        """针对一个目标去重、过滤、转发并记录，unit 为 (消息列表, 内容哈希, MinHash 签名)"""
+        messages, message_hash, signature = unit
+        target_channel = target["target"]
+        description = describe_messages(messages)
         
-        # 广告过滤
-        if has_text and self.filter_manager.is_ad_message(message.message, has_media):
-            logger.info(f"🚫 过滤广告消息: {message.id}")
+        inflight_key = (target["dedup_scope"], message_hash)
+        with metrics.timer("tg_forward_stage_seconds", stage="dedup_lookup"):
+            # 检查是否已经转发过（相册中任一消息已转发则整体跳过）
+            already_forwarded = any(
+                self.history_manager.is_already_forwarded(source_channel.id, target_channel.id, message.id)
+                for message in messages
+            )
+            # 内容去重检查（同时检查其他工作协程正在处理的相同内容）
+            duplicate = not already_forwarded and (
+                target["dedup"].is_duplicate(message_hash) or inflight_key in self.inflight_hashes
+            )
+            near_duplicate = not already_forwarded and not duplicate and target["dedup"].is_near_duplicate(signature)
+        if already_forwarded:
+            metrics.inc("tg_forward_filtered_total", len(messages), reason="already_forwarded")
+            logger.debug(f"跳过已转发消息: {description}", extra={"category": "skipped_forwarded"})
+            self.finish_target(source_channel, messages, True)
+            return
+        if duplicate:
+            metrics.inc("tg_forward_filtered_total", len(messages), reason="duplicate")
+            logger.debug(f"跳过重复内容: {description}", extra={"category": "skipped_duplicate"})
+            self.finish_target(source_channel, messages, True)
             return
+        if near_duplicate:
+            metrics.inc("tg_forward_filtered_total", len(messages), reason="near_duplicate")
+            logger.debug(f"跳过近似重复内容: {description}", extra={"category": "skipped_near_duplicate"})
+            self.finish_target(source_channel, messages, True)
+            return
+        
+        self.inflight_hashes.add(inflight_key)
+        handed_off = False
+        try:
+            handed_off = await self.filter_and_forward(unit, text, has_media, source_channel, target)
+        finally:
+            # 交给批量转发的消息由 flush_batch 在发送后释放
+            if not handed_off:
+                self.inflight_hashes.discard(inflight_key)
+    
+    async def filter_and_forward(self, unit, text, has_media, source_channel, target):
+        """按目标的过滤配置过滤后转发消息并更新记录，消息交给批量转发时返回True"""
+        messages = unit[0]
+        description = f"{describe_messages(messages)} → {get_channel_name(target['target'])}"
+        filter_manager = target["filter"]
+        has_text = text is not None
+        
+        reason = None
+        with metrics.timer("tg_forward_stage_seconds", stage="filter"):
+            # 广告过滤
+            if has_text and filter_manager.is_ad_message(text, has_media):
+                reason = "ad"
+            # 内容质量过滤
+            elif has_text and filter_manager.is_meaningless_message(text, has_media):
+                reason = "meaningless"
+            # 媒体要求过滤
+            elif filter_manager.setting("enable_media_required_filter") and not has_media and not has_text:
+                reason = "empty"
         
-        # 内容质量过滤
-        if has_text and self.filter_manager.is_meaningless_message(message.message, has_media):
-            logger.info(f"🗑️ 过滤无意义内容: {message.id}")
+        if reason is not None:
+            metrics.inc("tg_forward_filtered_total", len(messages), reason=reason)
+            # 过滤日志按原因采样，广告集中出现时不会刷满日志
+            extra = {"category": f"filtered_{reason}"}
+            if reason == "ad":
+                logger.info(f"🚫 过滤广告消息: {description}", extra=extra)
+            elif reason == "meaningless":
+                logger.info(f"🗑️ 过滤无意义内容: {description}", extra=extra)
+            else:
+                logger.info(f"🚫 过滤无媒体无文本消息: {description}", extra=extra)
+            self.finish_target(source_channel, messages, True)
             return
         
-        # 媒体要求过滤
-        if Config.enable_media_required_filter and not has_media and not has_text:
-            logger.info(f"🚫 过滤无媒体无文本消息: {message.id}")
+        # 合并到批量转发
+        if Config.forward_batch_window > 0:
+            await self.add_to_batch(unit, source_channel, target)
+            return True
+        
+        await self.forward_and_record([unit], source_channel, target)
+        return False
+    
+    async def add_to_batch(self, unit, source_channel, target):
+        """将通过过滤的消息加入同一来源的待发送批次，窗口结束或达到上限时发送"""
+        messages = unit[0]
+        max_messages = max(1, min(100, Config.forward_batch_max_messages))
+        key = (source_channel.id, target["target"].id)
+        
+        # 放不下时先发送已有批次，相册不拆分；发送期间其他工作协程可能已建立新批次
+        batch = self.pending_batches.get(key)
+        while batch and batch["count"] + len(messages) > max_messages:
+            await self.flush_batch(key)
+            batch = self.pending_batches.get(key)
+        
+        if batch is None:
+            batch = self.pending_batches[key] = {
+                "units": [],
+                "count": 0,
+                "source": source_channel,
+                "target": target,
+                "timer": None,
+            }
+        batch["units"].append(unit)
+        batch["count"] += len(messages)
+        
+        if batch["count"] >= max_messages:
+            await self.flush_batch(key)
+        elif batch["timer"] is None:
+            batch["timer"] = asyncio.create_task(self.batch_timer(key))
+    
+    async def batch_timer(self, key):
+        """合并窗口结束后发送批次"""
+        await asyncio.sleep(Config.forward_batch_window)
+        await self.flush_batch(key)
+    
+    async def flush_batch(self, key):
+        """发送一个待发送批次并释放其中的处理中标记，失败时记录并计入失败数"""
+        batch = self.pending_batches.pop(key, None)
+        if batch is None:
             return
+        timer = batch["timer"]
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        try:
+            await self.forward_and_record(batch["units"], batch["source"], batch["target"])
+        except Exception as e:
+            self.pipeline_stats["failed"] += len(batch["units"])
+            metrics.inc("tg_forward_failed_total", batch["count"])
+            logger.error(f"❌ 批量转发失败: {e}")
+            for unit_messages, _, _ in batch["units"]:
+                self.finish_target(batch["source"], unit_messages, False)
+        finally:
+            for _, message_hash, _ in batch["units"]:
+                self.inflight_hashes.discard((batch["target"]["dedup_scope"], message_hash))
+    
+    async def flush_all_batches(self):
+        """发送全部待发送批次"""
+        for key in list(self.pending_batches):
+            await self.flush_batch(key)
+    
+    async def forward_and_record(self, units, source_channel, target):
+        """在一次请求中按消息ID顺序转发若干单元（单条消息或相册），并整批更新记录
+        
+        units 为 (消息列表, 内容哈希, MinHash 签名) 列表。
+        """
+        target_channel = target["target"]
+        units = sorted(units, key=lambda unit: unit[0][0].id)
+        messages = [message for unit_messages, _, _ in units for message in unit_messages]
+        
+        # 相册按 delay_group 与 delay_single 的比例消耗令牌，一次请求只消耗一份
+        tokens = 1
+        if any(len(unit_messages) > 1 for unit_messages, _, _ in units) and Config.delay_single > 0:
+            tokens = max(1, Config.delay_group / Config.delay_single)
+        description = None
+        if len(units) > 1:
+            description = f"批量 {messages[0].id}-{messages[-1].id}（{len(units)}个单元 {len(messages)}条）"
         
         # 执行转发
-        await self.forward_message_safe(message, target_channel, source_channel)
+        sender = await self.forward_message_safe(
+            messages, target_channel, source_channel, tokens, description
+        )
+        if sender is None:
+            # 重试耗尽或没有可用账号：与处理异常一样计入失败
+            self.pipeline_stats["failed"] += len(units)
+            metrics.inc("tg_forward_failed_total", len(messages))
+            for unit_messages, _, _ in units:
+                self.finish_target(source_channel, unit_messages, False)
+            return
+        metrics.inc("tg_forward_forwarded_total", len(messages))
         
         # 更新记录
-        self.history_manager.add_forward_record(
-            source_channel.id, target_channel.id, message.id
-        )
-        self.dedup_manager.add_to_history(
-            message_hash, f"{get_channel_name(source_channel)}({source_channel.id})"
-        )
+        records = [
+            (message.id, "album" if len(unit_messages) > 1 else "single")
+            for unit_messages, _, _ in units
+            for message in unit_messages
+        ]
+        with metrics.timer("tg_forward_stage_seconds", stage="history_persist"):
+            self.history_manager.add_forward_records(source_channel.id, target_channel.id, records)
+            target["dedup"].add_many_to_history(
+                [message_hash for _, message_hash, _ in units],
+                f"{get_channel_name(source_channel)}({source_channel.id})",
+                [signature for _, _, signature in units]
+            )
+        for unit_messages, _, _ in units:
+            self.finish_target(source_channel, unit_messages, True)
+        
+        stats = self.pipeline_stats
+        stats["batches"] += 1
+        stats["batched_messages"] += len(messages)
         
         # 增加转发计数并检查账号轮换
-        self.client_manager.increment_forward_count()
+        self.client_manager.increment_forward_count(len(messages), sender)
         if self.client_manager.should_rotate_account():
-            await self.handle_account_rotation(source_channel, target_channel)
+            await self.handle_account_rotation()
     
-    async def forward_message_safe(self, message, target_channel, source_channel):
-        """安全转发消息"""
+    async def forward_message_safe(self, messages, target_channel, source_channel, tokens=1, description=None):
+        """安全转发消息，多条消息在一次请求中转发，返回发送账号，失败时返回None"""
         max_retries = 3
         retry_delay = 2
+        description = description or describe_messages(messages)
+        message_ids = [message.id for message in messages]
         
-        for attempt in range(max_retries):
+        attempt = 0
+        while attempt < max_retries:
+            client_data = None
             try:
-                client = self.client_manager.get_current_client()
-                await client.forward_messages(target_channel, message)
-                
-                logger.info(f"✅ 转发成功: {message.id} 从 {get_channel_name(source_channel)} 到 {get_channel_name(target_channel)}")
+                client_data, source_peer, target_peer = await self.client_manager.acquire_sender(
+                    source_channel, target_channel
+                )
+                # 只在令牌耗尽时等待，避免触发限制
+                await client_data["rate_limiter"].acquire(tokens)
+                # 使用发送账号自己的 InputPeer，消息按ID转发
+                with metrics.timer("tg_forward_stage_seconds", stage="forward_call"):
+                    await client_data["client"].forward_messages(target_peer, message_ids, from_peer=source_peer)
                 
-                # 添加延迟避免触发限制
-                await asyncio.sleep(Config.delay_single)
-                return
+                logger.info(f"✅ 转发成功: {description} 从 {get_channel_name(source_channel)} 到 {get_channel_name(target_channel)}（账号 {client_data['name']}）")
+                return client_data
                 
             except errors.FloodWaitError as e:
-                logger.warning(f"⏸ FloodWait，等待 {e.seconds} 秒")
-                await asyncio.sleep(e.seconds + 5)
+                # 记录受限账号后立即换账号重试，不计入重试次数
+                self.client_manager.block_account(client_data, e.seconds + 5)
+                
+            except NoSenderAvailableError as e:
+                # 重试无法改变账号的访问权限，直接放弃这条消息
+                logger.error(f"❌ 转发失败: {description}，{e}")
+                return None
+                
+            except (errors.ChannelInvalidError, errors.ChannelPrivateError, errors.PeerIdInvalidError) as e:
+                if client_data is None:
+                    # 选择发送账号时就无法解析频道，没有可失效的缓存，按无法访问处理
+                    logger.error(
+                        f"❌ 转发失败: {description}，无法访问 {get_channel_name(source_channel)} "
+                        f"或 {get_channel_name(target_channel)}: {e}"
+                    )
+                    return None
+                # 缓存的 access_hash 可能已失效，丢弃后重新解析
+                self.client_manager.invalidate_peers(client_data, (source_channel, target_channel))
+                attempt += 1
+                if attempt >= max_retries:
+                    logger.error(f"❌ 转发失败，频道无法访问: {e}")
+                    return None
+                logger.warning(f"⚠️ 频道无法访问，重新解析后重试 {attempt}/{max_retries - 1}: {e}")
                 
             except errors.ChatWriteForbiddenError:
-                logger.error(f"🚫 目标频道禁止写入: {get_channel_name(target_channel)}")
-                return
+                logger.error(
+                    f"🚫 目标频道禁止写入: {get_channel_name(target_channel)}（账号 {client_data['name']}），"
+                    f"{Config.no_access_retry_interval} 秒内不再用该账号发送到此频道"
+                )
+                # 换用其他可以写入目标频道的账号
+                self.client_manager.mark_no_access(client_data, target_channel)
+                if not self.client_manager.get_sender_candidates((source_channel, target_channel)):
+                    return None
                 
             except Exception as e:
-                if attempt < max_retries - 1:
-                    logger.warning(f"⚠️ 转发失败，重试 {attempt + 1}/{max_retries - 1}: {e}")
-                    await asyncio.sleep(retry_delay * (attempt + 1))
+                attempt += 1
+                if attempt < max_retries:
+                    logger.warning(f"⚠️ 转发失败，重试 {attempt}/{max_retries - 1}: {e}")
+                    await asyncio.sleep(retry_delay * attempt)
                 else:
                     logger.error(f"❌ 转发失败，已耗尽重试次数: {e}")
-                    return
+                    return None
+            finally:
+                if client_data is not None:
+                    await self.client_manager.release_sender(client_data)
+        return None
     
-    async def handle_account_rotation(self, source_channel, target_channel):
+    async def handle_account_rotation(self):
         """处理账号轮换"""
         logger.info("🔄 检查账号轮换...")
         
         if self.client_manager.switch_to_next_account():
             await asyncio.sleep(Config.account_delay)
             
-            # 重新设置监听器
-            await self.setup_listeners([source_channel], target_channel)
+            # 将全部源频道的监听器转移到新账号
+            self.register_dispatchers(self.client_manager.get_current_client())
             
             self.client_manager.reset_forward_count()
             logger.info("✅ 账号轮换完成")
@@ -596,26 +3716,230 @@ class RealtimeForwarder:
                     await self.perform_health_check()
                     self.last_health_check = current_time
                 
+                # 定期提交批量缓冲的转发历史
+                self.history_manager.save_history()
+                
                 await asyncio.sleep(60)  # 每分钟检查一次
                 
             except Exception as e:
                 logger.error(f"❌ 健康检查异常: {e}")
                 await asyncio.sleep(10)
     
+    async def scan_targets(self, routes):
+        """依次扫描所有目标频道（每个去重范围扫描一次），建立去重历史"""
+        scanner = TargetScanner(Config.scan_checkpoint_file)
+        owner = self.client_manager.entity_owner or self.client_manager.clients[self.client_manager.current_index]
+        client = owner["client"]
+        targets = {}
+        for route in routes:
+            for target in route["targets"]:
+                targets[(target["dedup_scope"], target["target"].id)] = target
+        
+        logger.info(f"🔍 开始在后台扫描 {len(targets)} 个目标频道以建立去重历史...")
+        for target in targets.values():
+            while True:
+                try:
+                    await scanner.scan(client, target["target"], target["dedup"], target["dedup_scope"])
+                except errors.FloodWaitError as e:
+                    # 扫描进度已按批保存，等待后从断点继续
+                    logger.warning(f"⏸ 扫描 {get_channel_name(target['target'])} 触发 FloodWait，{e.seconds} 秒后继续")
+                    await asyncio.sleep(e.seconds)
+                    continue
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"❌ 扫描目标频道 {get_channel_name(target['target'])} 失败: {e}")
+                break
+        logger.info("✅ 去重历史准备完成")
+    
+    def hold_progress(self):
+        """冻结每个源频道的处理进度，直到补发登记完缺口中的消息"""
+        if not Config.enable_gap_backfill:
+            return
+        for route in self.routes.values():
+            source_id = route["source"].id
+            high_water_mark = self.history_manager.get_high_water_mark(source_id)
+            if high_water_mark is not None:
+                self.get_source_progress(source_id).hold_at(high_water_mark + 1)
+    
+    def start_backfill(self):
+        """在后台补发断线期间遗漏的消息，已有补发任务时从头重新开始（进度仍停在缺口之前）"""
+        if not Config.enable_gap_backfill or not self.routes:
+            return
+        if self.backfill_task is not None and not self.backfill_task.done():
+            self.backfill_task.cancel()
+        # 立即记录各源频道的处理进度，避免补发开始前实时消息推进进度而跳过缺口
+        high_water_marks = {
+            peer_id: self.history_manager.get_high_water_mark(route["source"].id)
+            for peer_id, route in self.routes.items()
+        }
+        self.backfill_task = asyncio.create_task(self.backfill_sources(high_water_marks))
+    
+    async def backfill_sources(self, high_water_marks):
+        """依次检查每个源频道的消息ID缺口，并通过正常处理流程补发"""
+        owner = self.client_manager.entity_owner
+        if owner is None or not owner["enabled"]:
+            owner = self.client_manager.clients[self.client_manager.current_index]
+        client = owner["client"]
+        # 补发与实时消息共用处理队列，单独限速
+        rate_limiter = TokenBucket(Config.backfill_rate, Config.backfill_rate)
+        total = 0
+        for peer_id, high_water_mark in high_water_marks.items():
+            route = self.routes[peer_id]
+            if high_water_mark is None:
+                # 首次运行没有处理进度，从实时消息开始记录
+                continue
+            source = route["source"]
+            for delay in (0,) + self.RETRY_DELAYS:
+                await asyncio.sleep(delay)
+                try:
+                    total += await self.backfill_source(client, route, high_water_mark, rate_limiter)
+                    break
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"❌ 补发频道 {get_channel_name(source)} 的遗漏消息失败: {e}")
+            else:
+                logger.error(f"❌ 频道 {get_channel_name(source)} 补发多次失败，跳过消息 {high_water_mark} 之后的缺口")
+            # 缺口中的消息都已登记（或放弃补发），进度可以继续推进
+            self.advance_progress(source.id, self.get_source_progress(source.id).release_hold())
+        if total:
+            logger.info(f"✅ 断线补发完成，共补发 {total} 条消息")
+    
+    async def backfill_source(self, client, route, high_water_mark, rate_limiter):
+        """按消息ID从旧到新补发一个源频道在处理进度之后的消息，返回补发的消息数"""
+        source = route["source"]
+        backfilled = 0
+        album = []
+        last_id = high_water_mark
+        while True:
+            try:
+                async for message in client.iter_messages(
+                    source, limit=Config.backfill_max_messages - backfilled - len(album), min_id=last_id, reverse=True
+                ):
+                    # 相册消息ID连续，按 grouped_id 合并后作为一个单元处理
+                    if album and message.grouped_id != album[0].grouped_id:
+                        await self.enqueue_backfill(album, route, rate_limiter)
+                        backfilled += len(album)
+                        album = []
+                    last_id = message.id
+                    if Config.enable_album_forward and message.grouped_id:
+                        album.append(message)
+                        continue
+                    await self.enqueue_backfill([message], route, rate_limiter)
+                    backfilled += 1
+                break
+            except errors.FloodWaitError as e:
+                # 从最后取到的消息之后继续
+                logger.warning(f"⏸ 补发频道 {get_channel_name(source)} 触发 FloodWait，{e.seconds} 秒后继续")
+                await asyncio.sleep(e.seconds)
+        if album:
+            await self.enqueue_backfill(album, route, rate_limiter)
+            backfilled += len(album)
+        
+        if backfilled:
+            logger.info(f"⏪ 频道 {get_channel_name(source)} 从消息 {high_water_mark} 之后补发 {backfilled} 条")
+            if backfilled == Config.backfill_max_messages:
+                logger.warning(f"⚠️ 频道 {get_channel_name(source)} 的缺口超过补发上限 {Config.backfill_max_messages} 条，其余消息未补发")
+        return backfilled
+    
+    async def enqueue_backfill(self, messages, route, rate_limiter):
+        """限速放入处理队列，队列积压过半时等待，优先处理实时消息"""
+        await rate_limiter.acquire(len(messages))
+        backlog_limit = max(1, Config.message_queue_size // 2)
+        while self.message_queue.qsize() >= backlog_limit:
+            await asyncio.sleep(0.5)
+        self.pipeline_stats["backfilled"] += 1
+        metrics.inc("tg_forward_received_total", len(messages), origin="backfill")
+        self.message_queue.put_nowait({
+            "messages": messages,
+            "route": route,
+            "enqueued_at": time.monotonic(),
+        })
+        self.register_unit(messages, route)
+    
+    async def dedup_compaction_loop(self):
+        """去重历史维护循环：增量淘汰过期条目，并在线程池中压缩日志"""
+        loop = asyncio.get_event_loop()
+        while self.is_running:
+            try:
+                for dedup_manager in self.dedup_managers:
+                    dedup_manager.evict(budget=10000)
+                    if dedup_manager.should_compact():
+                        await loop.run_in_executor(None, dedup_manager.compact)
+                await asyncio.sleep(10)
+            except Exception as e:
+                logger.error(f"❌ 去重日志压缩异常: {e}")
+                await asyncio.sleep(10)
+    
     async def perform_health_check(self):
         """执行健康检查"""
         try:
             client = self.client_manager.get_current_client()
             if not client.is_connected():
                 logger.warning("⚠️ 客户端连接断开，尝试重新连接...")
+                self.hold_progress()
                 await client.connect()
+                self.start_backfill()
                 
             logger.info("💚 健康检查通过")
+            self.log_pipeline_stats()
+            for name, state in self.client_manager.get_rate_limit_stats().items():
+                logger.info(
+                    f"🪣 账号 {name} 令牌 {state['tokens']}/{state['capacity']}，"
+                    f"速率 {state['rate']:.2f}/秒，累计等待 {state['wait_count']} 次 {state['total_wait']}秒"
+                )
+            for name, state in self.client_manager.get_sender_stats().items():
+                logger.info(
+                    f"📤 账号 {name} {'可用' if state['enabled'] else '已停用'}，"
+                    f"进行中 {state['inflight']}，累计转发 {state['forward_count']} 条，"
+                    f"FloodWait {state['flood_waits']} 次 {state['flood_wait_seconds']} 秒"
+                    + (f"，剩余 {state['blocked_for']} 秒" if state['blocked_for'] else "")
+                )
             
         except Exception as e:
             logger.error(f"❌ 健康检查失败: {e}")
             await self.handle_reconnection()
     
+    def collect_metrics(self):
+        """抓取指标前刷新队列深度和各账号状态"""
+        metrics.set("tg_forward_queue_depth", self.message_queue.qsize() if self.message_queue else 0)
+        for name, state in self.client_manager.get_sender_stats().items():
+            metrics.set("tg_forward_account_flood_waits_total", state["flood_waits"], account=name)
+            metrics.set("tg_forward_account_flood_wait_seconds_total", state["flood_wait_seconds"], account=name)
+            metrics.set("tg_forward_account_blocked_seconds", state["blocked_for"], account=name)
+            metrics.set("tg_forward_account_inflight", state["inflight"], account=name)
+        persist_stats = persistence_writer.get_stats()
+        metrics.set("tg_forward_persist_flushes_total", persist_stats["flushes"])
+        metrics.set("tg_forward_persist_records_total", persist_stats["records"])
+        metrics.set("tg_forward_persist_pending", persist_stats["pending"])
+        metrics.set("tg_forward_persist_flush_seconds", persist_stats["last_latency"], stat="last")
+        metrics.set("tg_forward_persist_flush_seconds", persist_stats["max_latency"], stat="max")
+        metrics.set("tg_forward_persist_flush_seconds", persist_stats["avg_latency"], stat="avg")
+    
+    def log_pipeline_stats(self):
+        """输出处理队列统计"""
+        stats = self.get_pipeline_stats()
+        logger.info(
+            f"📊 队列深度 {stats['queue_depth']}（峰值 {stats['max_queue_depth']}），"
+            f"已接收 {stats['received']}，补发 {stats['backfilled']}，已处理 {stats['processed']}，"
+            f"失败 {stats['failed']}，丢弃 {stats['dropped']}，"
+            f"排队耗时 p50/p99 {stats['wait_p50']:.3f}/{stats['wait_p99']:.3f}s，"
+            f"端到端耗时 p50/p99 {stats['latency_p50']:.3f}/{stats['latency_p99']:.3f}s"
+        )
+        persist_stats = persistence_writer.get_stats()
+        if persist_stats["flushes"]:
+            logger.info(
+                f"💾 后台写入 {persist_stats['flushes']} 次，平均每次 {persist_stats['records_per_flush']:.1f} 条记录，"
+                f"耗时 平均/最大 {persist_stats['avg_latency'] * 1000:.1f}/{persist_stats['max_latency'] * 1000:.1f}ms"
+                + (f"，失败 {persist_stats['errors']} 次" if persist_stats["errors"] else "")
+            )
+        if stats["batches"]:
+            logger.info(
+                f"📦 转发请求 {stats['batches']} 次，共 {stats['batched_messages']} 条，"
+                f"平均每次 {stats['batched_messages'] / stats['batches']:.1f} 条"
+            )
+    
     async def handle_reconnection(self):
         """处理重连"""
         if self.reconnect_attempts >= Config.max_reconnect_attempts:
@@ -627,19 +3951,36 @@ class RealtimeForwarder:
         logger.info(f"🔄 尝试重连 {self.reconnect_attempts}/{Config.max_reconnect_attempts}")
         
         try:
+            self.hold_progress()
             await asyncio.sleep(Config.reconnect_delay)
             await self.start_all_clients()
             self.reconnect_attempts = 0
             logger.info("✅ 重连成功")
+            self.start_backfill()
             
         except Exception as e:
             logger.error(f"❌ 重连失败: {e}")
     
     async def stop_forwarding(self):
-        """停止转发服务"""
+        """停止转发服务，重复调用时直接返回"""
+        if self.stopped:
+            return
+        self.stopped = True
         logger.info("🛑 正在停止实时转发服务...")
         self.is_running = False
         
+        # 停止工作协程、账号重试任务和扫描任务（扫描进度已按批保存）
+        for task in self.worker_tasks + list(self.client_retry_tasks.values()):
+            task.cancel()
+        for task in (self.scan_task, self.backfill_task):
+            if task is not None:
+                task.cancel()
+        self.worker_tasks = []
+        
+        # 发送合并窗口中剩余的消息
+        await self.flush_all_batches()
+        await metrics.stop()
+        
         # 断开所有客户端
         for client_data in self.client_manager.clients:
             try:
@@ -647,6 +3988,17 @@ class RealtimeForwarder:
             except Exception as e:
                 logger.warning(f"断开客户端时出错: {e}")
         
+        # 等待后台写入线程写完待写入的文件，再落盘剩余的转发历史
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, persistence_writer.stop)
+            self.history_manager.close()
+            for dedup_manager in self.dedup_managers:
+                dedup_manager.close()
+            if self.recorder is not None:
+                self.recorder.close()
+        except Exception as e:
+            logger.warning(f"关闭历史存储时出错: {e}")
+        
         logger.info("✅ 实时转发服务已停止")
 
 # ============ 主函数 ============
@@ -666,50 +4018,35 @@ async def main():
         logger.error("❌ 没有可用的账号！请检查账号配置。")
         return
     
-    # 获取客户端
-    client = client_manager.get_current_client()
-    
-    # 验证预设频道
-    source_channels = []
-    target_channel = None
-    
-    if Config.preset_source_channels and Config.preset_target_channel:
-        try:
-            # 验证源频道
-            for channel_id in Config.preset_source_channels:
-                entity = await client.get_entity(channel_id)
-                source_channels.append(entity)
-                logger.info(f"✅ 源频道验证成功: {get_channel_name(entity)}")
-            
-            # 验证目标频道
-            target_channel = await client.get_entity(Config.preset_target_channel)
-            logger.info(f"✅ 目标频道验证成功: {get_channel_name(target_channel)}")
-            
-        except Exception as e:
-            logger.error(f"❌ 频道验证失败: {e}")
-            return
-    else:
+    if not (Config.routes or (Config.preset_source_channels and Config.preset_target_channel)):
         logger.error("❌ 请配置源频道和目标频道")
         return
     
-    # 扫描目标频道（如果需要去重）
-    if Config.enable_content_deduplication:
-        logger.info("🔍 正在扫描目标频道以建立去重历史...")
-        # 这里可以添加扫描逻辑，但为了实时转发，通常不需要完整扫描
-        logger.info("✅ 去重历史准备完成")
-    
-    # 启动实时转发器
     forwarder = RealtimeForwarder(
         client_manager, filter_manager, dedup_manager, history_manager
     )
     
+    # 任何退出路径（包括 Ctrl+C 取消 main）都执行停止流程，写完待写入的数据
     try:
-        await forwarder.start_forwarding(source_channels, target_channel)
-    except KeyboardInterrupt:
-        logger.info("🛑 收到停止信号")
-        await forwarder.stop_forwarding()
-    except Exception as e:
-        logger.error(f"❌ 运行时错误: {e}")
+        # 并发启动所有客户端
+        await forwarder.start_all_clients()
+        if not any(client_data["enabled"] for client_data in client_manager.clients):
+            logger.error("❌ 所有账号启动失败！")
+            return
+        
+        # 验证路由中的频道（优先使用频道实体缓存）
+        try:
+            routes = await build_routes(client_manager, filter_manager, dedup_manager)
+        except Exception as e:
+            logger.error(f"❌ 频道验证失败: {e}")
+            return
+        
+        # 启动实时转发
+        try:
+            await forwarder.start_forwarding(routes)
+        except Exception as e:
+            logger.error(f"❌ 运行时错误: {e}")
+    finally:
         await forwarder.stop_forwarding()
 
 # ============ 运行 ============
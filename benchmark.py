@@ -0,0 +1,816 @@
+#!/usr/bin/env python3
+"""
+TG Realtime Forward 性能基准测试脚本
+用于在不连接Telegram的情况下测量热点路径的耗时
+
+用法:
+    python3 benchmark.py            # 运行全部基准
+    python3 benchmark.py history    # 只运行指定基准
+    python3 benchmark.py dedup --dedup-entries 1000000
+    python3 benchmark.py pipeline --scenarios spam,album --messages 2000
+    python3 benchmark.py replay --capture capture.jsonl --speed 1
+"""
+
+import os
+import sys
+import time
+import argparse
+import asyncio
+import gc
+import logging
+import random
+import re
+import hashlib
+import struct
+import tempfile
+import tracemalloc
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from telethon import errors, events, utils
+from telethon.tl import types
+
+import TG_Realtime_Forward
+from TG_Realtime_Forward import (
+    ClientManager, CompactDigestStore, Config, DeduplicationManager, EventRecorder, ForwardHistoryBackend,
+    ForwardHistoryManager, MessageFilter, MinHashIndex, RealtimeForwarder, persistence_writer
+)
+
+# ============ 工具函数 ============
+def measure(func, repeat):
+    """重复调用 func，返回单次平均耗时（纳秒）"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e9
+
+def format_bytes(size):
+    """格式化字节数"""
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}"
+        size /= 1024
+
+def print_header(title):
+    """打印基准标题"""
+    print(f"\n📊 {title}")
+    print("-" * 60)
+
+@contextmanager
+def override_config(**values):
+    """临时修改 Config 的属性，退出时恢复"""
+    original = {name: getattr(Config, name) for name in values}
+    for name, value in values.items():
+        setattr(Config, name, value)
+    try:
+        yield
+    finally:
+        for name, value in original.items():
+            setattr(Config, name, value)
+
+# ============ 转发历史查询 ============
+class MemoryForwardHistoryBackend(ForwardHistoryBackend):
+    """不落盘的后端，只用于基准测试"""
+
+    def load_index(self):
+        return {}
+
+    def add_record(self, channel_key, msg_id, msg_type="single"):
+        pass
+
+def legacy_is_already_forwarded(forwarded_messages, msg_id):
+    """旧实现：每次重建字符串列表并线性扫描"""
+    return str(msg_id) in [str(mid) for mid in forwarded_messages]
+
+def bench_forward_history(args, sizes=(1_000, 10_000, 100_000, 1_000_000, 3_000_000)):
+    """is_already_forwarded 单次查询耗时随历史规模的变化"""
+    print_header("转发历史查询 is_already_forwarded")
+    print(f"{'历史条数':>12} {'索引查询(ns)':>14} {'旧实现(ns)':>14}")
+
+    src_id, dst_id = -1001000000001, -1001000000002
+    for size in sizes:
+        manager = ForwardHistoryManager(MemoryForwardHistoryBackend())
+        channel_key = manager.get_channel_key(src_id, dst_id)
+        manager.forwarded_index[channel_key] = set(range(size))
+
+        # 查询一半命中、一半未命中的消息ID
+        probes = [size // 2, size + 1]
+        repeat = 20_000
+        hit = measure(lambda: manager.is_already_forwarded(src_id, dst_id, probes[0]), repeat)
+        miss = measure(lambda: manager.is_already_forwarded(src_id, dst_id, probes[1]), repeat)
+        indexed = (hit + miss) / 2
+
+        # 旧实现是 O(n)，只在较小规模下对比
+        if size <= 100_000:
+            legacy_list = [str(mid) for mid in range(size)]
+            legacy_repeat = max(1, 2_000_000 // size)
+            legacy = measure(
+                lambda: legacy_is_already_forwarded(legacy_list, probes[1]), legacy_repeat
+            )
+            legacy_text = f"{legacy:>14.0f}"
+        else:
+            legacy_text = f"{'-':>14}"
+
+        print(f"{size:>12,} {indexed:>14.0f} {legacy_text}")
+
+# ============ 去重摘要存储 ============
+def bench_dedup_store(args):
+    """对比字典历史与紧凑二进制摘要表的内存占用和查询耗时"""
+    entries = args.dedup_entries
+    print_header(f"去重历史存储（{entries:,} 条）")
+
+    # 字典实现：md5十六进制键 + {时间戳, 来源} 字典，按抽样规模线性外推
+    sample = min(entries, 200_000)
+    now = time.time()
+    tracemalloc.start()
+    history = OrderedDict()
+    for i in range(sample):
+        message_hash = hashlib.md5(str(i).encode()).hexdigest()
+        history[message_hash] = {"timestamp": now, "source": f"示例频道(-10012345678{i % 20})"}
+    dict_bytes = tracemalloc.get_traced_memory()[0] / sample * entries
+    tracemalloc.stop()
+    probe = next(reversed(history))
+    dict_lookup = measure(lambda: probe in history, 200_000)
+    del history
+
+    # 紧凑摘要表：按最大条数预分配，实际插入全部条目，内存即缓冲区大小
+    store = CompactDigestStore(CompactDigestStore.capacity_for(entries))
+    start = time.perf_counter()
+    timestamp = int(now)
+    for chunk_start in range(0, entries, 100_000):
+        chunk = os.urandom(8 * min(100_000, entries - chunk_start))
+        for digest in memoryview(chunk).cast("Q"):
+            store.insert(digest or 1, timestamp, chunk_start % 20)
+    insert_ns = (time.perf_counter() - start) / entries * 1e9
+    store_bytes = len(store.buffer)
+    probe = next(key for key in store.keys if key)
+    store_lookup = measure(lambda: store.get_timestamp(probe), 200_000)
+
+    print(f"{'实现':<14} {'内存':>12} {'每条字节':>10} {'查询(ns)':>10}")
+    print(f"{'字典(外推)':<14} {format_bytes(dict_bytes):>12} {dict_bytes / entries:>10.0f} {dict_lookup:>10.0f}")
+    print(f"{'紧凑摘要表':<14} {format_bytes(store_bytes):>12} {store_bytes / entries:>10.0f} {store_lookup:>10.0f}")
+    print(f"摘要表插入: {insert_ns:.0f} ns/条，容量 {store.capacity:,}，装载率 {len(store) / store.capacity:.2f}")
+
+# ============ 消息样本 ============
+SAMPLE_MESSAGES = [
+    "哈哈",
+    "👍",
+    "打卡",
+    "好的",
+    "沙发",
+    "哈哈哈哈哈哈哈哈",
+    "😂😂😂😂",
+    "ok",
+    "今天的更新已经上传，大家注意查收",
+    "这个版本修复了上次反馈的闪退问题，感谢大家的耐心等待。",
+    "【每日新闻】央行宣布下调存款准备金率0.5个百分点，释放长期资金约1万亿元。",
+    "限时推广！官网注册即送彩金，详情咨询客服 https://example.com/promo",
+    "提款秒到账，资金保障，联系 support@example.com",
+    "更多内容请看 https://t.me/example https://example.org/a https://example.org/b "
+    "https://example.org/c https://example.org/d",
+    "Release notes: fixed a crash when opening large albums, improved search speed "
+    "and reduced memory usage on older devices.",
+    "周末活动安排：周六上午十点在老地方集合，记得带好装备，有问题群里说。" * 4,
+    "Check this out: https://example.com/video",
+    "新人报到，请多关照 😊",
+    "看看",
+    "分享一个实用技巧：在设置里打开省电模式后，后台刷新会自动暂停，续航能提升不少。",
+]
+
+def build_corpus(size, seed=42):
+    """按样本生成测试语料，附加编号避免完全重复"""
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(size):
+        text = rng.choice(SAMPLE_MESSAGES)
+        if rng.random() < 0.5 and len(text) > 10:
+            text = f"{text} #{i}"
+        corpus.append(text)
+    return corpus
+
+def build_keywords(count, seed=7):
+    """生成 count 个额外的广告关键词，模拟线上规模"""
+    rng = random.Random(seed)
+    chars = "代理加盟招商投资理财店铺注册官方佣金汇旺返水入款出款彩金提款充值优惠福利会员客服"
+    keywords = set(Config.ad_keywords)
+    while len(keywords) < count:
+        keywords.add("".join(rng.choice(chars) for _ in range(rng.randint(2, 4))))
+    return sorted(keywords)
+
+# ============ 广告过滤 ============
+def legacy_is_ad_message(text, has_media=False):
+    """旧实现：逐个关键词子串查找，每次调用都经由re缓存查找正则"""
+    if not Config.enable_ad_filter or not text:
+        return False
+    text_lower = text.lower()
+    for keyword in Config.ad_keywords:
+        if keyword in text_lower:
+            return True
+    link_count = 0
+    for pattern in Config.ad_patterns:
+        matches = re.findall(pattern, text)
+        if pattern == r'https?://[^\s]+':
+            link_count += len(matches)
+        elif matches:
+            return True
+    if link_count > Config.max_links_per_message:
+        return True
+    if len(text.strip()) < Config.min_message_length:
+        if not has_media:
+            return True
+    return False
+
+def bench_ad_filter(args, keyword_counts=(22, 100, 300, 1000)):
+    """is_ad_message 编译匹配器与旧实现的对比"""
+    print_header("广告过滤 is_ad_message")
+    print(f"{'关键词数':>8} {'编译匹配器(µs)':>16} {'旧实现(µs)':>12} {'加速比':>8}")
+
+    corpus = build_corpus(20_000)
+    original_keywords = Config.ad_keywords
+    try:
+        for count in keyword_counts:
+            Config.ad_keywords = build_keywords(count)
+            filter_manager = MessageFilter()
+
+            # 结果必须与旧实现一致
+            for text in corpus[:2_000]:
+                assert filter_manager.is_ad_message(text) == legacy_is_ad_message(text), text
+
+            start = time.perf_counter()
+            for text in corpus:
+                filter_manager.is_ad_message(text)
+            compiled = (time.perf_counter() - start) / len(corpus) * 1e6
+
+            start = time.perf_counter()
+            for text in corpus:
+                legacy_is_ad_message(text)
+            legacy = (time.perf_counter() - start) / len(corpus) * 1e6
+
+            print(f"{count:>8} {compiled:>16.2f} {legacy:>12.2f} {legacy / compiled:>7.1f}x")
+    finally:
+        Config.ad_keywords = original_keywords
+
+# ============ 无意义内容过滤 ============
+def legacy_is_meaningless_message(text, has_media=False):
+    """旧实现：每次重建词表，并对文本做多次遍历"""
+    if not Config.enable_content_filter or not text:
+        return False
+    text = text.strip()
+    if text.lower() in [word.lower() for word in Config.meaningless_words]:
+        return not has_media
+    if len(text) > 1:
+        char_counts = {}
+        for char in text:
+            char_counts[char] = char_counts.get(char, 0) + 1
+        max_char_count = max(char_counts.values())
+        if max_char_count > Config.max_repeat_chars and max_char_count / len(text) > 0.6:
+            return not has_media
+    emoji_count = len([c for c in text if ord(c) > 127 and c not in '，。！？；：""''（）【】《》'])
+    if len(text) > 0 and emoji_count / len(text) > Config.max_emoji_ratio:
+        return not has_media
+    meaningful_chars = len([c for c in text if c.isalnum() or c in '，。！？；：""''（）【】《》'])
+    if meaningful_chars < Config.min_meaningful_length:
+        return not has_media
+    if len(set(text.replace(' ', ''))) <= 1 and len(text) > 1:
+        return not has_media
+    return False
+
+def bench_meaningless_filter(args):
+    """is_meaningless_message 单次遍历实现与旧实现的对比"""
+    print_header("无意义内容过滤 is_meaningless_message")
+
+    corpus = build_corpus(20_000)
+    filter_manager = MessageFilter()
+
+    # 结果必须与旧实现一致（包括有/无媒体两种情况）
+    for text in corpus + ["   ", " 哈 ", "a a a", "\"\"", "！！！！！", "🎉🎉🎉 好"]:
+        for has_media in (False, True):
+            expected = legacy_is_meaningless_message(text, has_media)
+            assert filter_manager.is_meaningless_message(text, has_media) == expected, text
+
+    print(f"{'语料':<10} {'条数':>8} {'单次遍历(µs)':>14} {'旧实现(µs)':>12} {'加速比':>8}")
+    short = [text for text in corpus if len(text) <= 20]
+    long = [text for text in corpus if len(text) > 20]
+    for name, texts in (("短消息", short), ("长消息", long), ("混合", corpus)):
+        start = time.perf_counter()
+        for text in texts:
+            filter_manager.is_meaningless_message(text)
+        single_pass = (time.perf_counter() - start) / len(texts) * 1e6
+
+        start = time.perf_counter()
+        for text in texts:
+            legacy_is_meaningless_message(text)
+        legacy = (time.perf_counter() - start) / len(texts) * 1e6
+
+        print(f"{name:<10} {len(texts):>8} {single_pass:>14.2f} {legacy:>12.2f} {legacy / single_pass:>7.1f}x")
+
+# ============ 近似重复检测 ============
+NEAR_DUPLICATE_PAIRS = [
+    ("限时推广！官网注册即送彩金，每日返水，详情咨询客服 https://example.com/promo?id=1",
+     "限时推广！官网注册即送彩金，每日返水，详情咨询客服 https://example.net/p/2 🔥🔥"),
+    ("【每日新闻】央行宣布下调存款准备金率0.5个百分点，释放长期资金约1万亿元。",
+     "【每日新闻】央行宣布下调存款准备金率0.5个百分点，释放长期资金约1万亿元。\n—— 来自 @news_channel"),
+    ("分享一个实用技巧：在设置里打开省电模式后，后台刷新会自动暂停，续航能提升不少。",
+     "分享一个实用技巧：在设置里打开省电模式后，后台刷新会自动暂停，续航能提升不少！👍"),
+]
+
+def bench_near_duplicate(args):
+    """MinHash 分段 LSH 索引与线性扫描的查找耗时对比"""
+    entries = args.near_entries
+    threshold = Config.near_duplicate_threshold
+    print_header(f"近似重复检测 MinHash（{entries:,} 条签名，相似度阈值 {threshold}）")
+    
+    # 只差链接、表情或签名的转载应当命中
+    print(f"{'样例':<6} {'相似度':>8} {'判定':>6}")
+    for i, (original, repost) in enumerate(NEAR_DUPLICATE_PAIRS, 1):
+        similarity = MinHashIndex.similarity(
+            MinHashIndex.signature(MinHashIndex.normalize(original)),
+            MinHashIndex.signature(MinHashIndex.normalize(repost))
+        )
+        print(f"{i:<6} {similarity:>8.2f} {'重复' if similarity >= threshold else '不同':>6}")
+    
+    texts = build_corpus(5_000)
+    start = time.perf_counter()
+    for text in texts:
+        MinHashIndex.signature(MinHashIndex.normalize(text))
+    signature_us = (time.perf_counter() - start) / len(texts) * 1e6
+    print(f"签名计算: {signature_us:.1f} µs/条")
+    
+    # 随机签名的各段互不相同，相当于没有近似重复的历史
+    index = MinHashIndex(threshold)
+    timestamp = int(time.time())
+    size = MinHashIndex.SIGNATURE_SIZE
+    tracemalloc.start()
+    start = time.perf_counter()
+    for chunk_start in range(0, entries, 10_000):
+        chunk = os.urandom(size * min(10_000, entries - chunk_start))
+        for offset in range(0, len(chunk), size):
+            index.insert(chunk[offset:offset + size], timestamp)
+    insert_us = (time.perf_counter() - start) / entries * 1e6
+    index_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    
+    # 命中查询：已有签名随机替换阈值允许范围内的值；未命中查询：随机签名
+    rng = random.Random(1)
+    stored = [signature for signature, _ in index.items()]
+    max_changes = int(MinHashIndex.NUM_PERM * (1 - threshold))
+    hits = []
+    for signature in rng.sample(stored, 1000):
+        values = list(memoryview(signature).cast("H"))
+        for position in rng.sample(range(MinHashIndex.NUM_PERM), rng.randint(0, max_changes)):
+            values[position] ^= 1
+        hits.append(struct.pack(f"{MinHashIndex.NUM_PERM}H", *values))
+    misses = [os.urandom(size) for _ in range(1000)]
+    
+    def linear_find(signature):
+        return next((c for c in stored if MinHashIndex.similarity(c, signature) >= threshold), None)
+    
+    print(f"{'查询':<8} {'LSH索引(µs)':>14} {'线性扫描(µs)':>14} {'加速比':>8}")
+    for name, probes in (("命中", hits), ("未命中", misses)):
+        start = time.perf_counter()
+        found = sum(index.find(probe) is not None for probe in probes)
+        indexed = (time.perf_counter() - start) / len(probes) * 1e6
+        # 线性扫描很慢，只抽样几次
+        sample = probes[:3]
+        start = time.perf_counter()
+        for probe in sample:
+            linear_find(probe)
+        linear = (time.perf_counter() - start) / len(sample) * 1e6
+        print(f"{name:<8} {indexed:>14.2f} {linear:>14.0f} {linear / indexed:>7.0f}x（命中 {found}/{len(probes)}）")
+    print(f"索引插入: {insert_us:.2f} µs/条，内存 {format_bytes(index_bytes)}（每条 {index_bytes / entries:.0f} 字节）")
+
+# ============ 转发流水线 ============
+class FakeTelegramClient:
+    """进程内模拟的 TelegramClient，只实现转发流程用到的接口
+    
+    forward_messages 等待 latency 秒模拟网络耗时，并按 flood_rate 的概率
+    抛出 FloodWaitError；emit 按 Telethon 的方式把消息派发给已注册的事件处理器。
+    """
+    
+    def __init__(self, *args, latency=0.0, flood_rate=0.0, flood_seconds=0, seed=0, **kwargs):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.rng = random.Random(seed)
+        self.handlers = []  # (事件类型, 回调)
+        self.entities = {}  # peer ID -> 实体
+        self.forward_calls = 0
+        self.forwarded = 0
+        self.flood_errors = 0
+    
+    def on(self, event):
+        def decorator(callback):
+            self.add_event_handler(callback, event)
+            return callback
+        return decorator
+    
+    def add_event_handler(self, callback, event):
+        self.handlers.append((event, callback))
+    
+    def remove_event_handler(self, callback):
+        self.handlers = [(event, handler) for event, handler in self.handlers if handler != callback]
+    
+    async def connect(self):
+        pass
+    
+    async def start(self):
+        return self
+    
+    async def is_user_authorized(self):
+        return True
+    
+    def is_connected(self):
+        return True
+    
+    async def disconnect(self):
+        pass
+    
+    def add_entity(self, entity):
+        """登记可解析的频道实体"""
+        self.entities[utils.get_peer_id(entity)] = entity
+    
+    async def get_entity(self, peer):
+        try:
+            return self.entities[peer]
+        except KeyError:
+            raise ValueError(f"Cannot find any entity corresponding to {peer}")
+    
+    async def get_input_entity(self, peer):
+        return utils.get_input_peer(await self.get_entity(peer))
+    
+    async def forward_messages(self, entity, messages, from_peer=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_rate and self.rng.random() < self.flood_rate:
+            self.flood_errors += 1
+            raise errors.FloodWaitError(request=None, capture=self.flood_seconds)
+        self.forward_calls += 1
+        self.forwarded += len(messages)
+        return messages
+    
+    async def emit(self, messages):
+        """派发一个单元：每条消息触发 NewMessage，相册整体再触发一次 Album"""
+        for message in messages:
+            event = SimpleNamespace(message=message, chat_id=message.chat_id)
+            for event_type, callback in self.handlers:
+                if isinstance(event_type, events.NewMessage):
+                    await callback(event)
+        if messages[0].grouped_id:
+            event = SimpleNamespace(messages=messages, chat_id=messages[0].chat_id)
+            for event_type, callback in self.handlers:
+                if isinstance(event_type, events.Album):
+                    await callback(event)
+
+class FakeMessage:
+    """只包含转发流程用到字段的消息"""
+    
+    def __init__(self, msg_id, chat_id, text=None, photo_id=None, grouped_id=None):
+        self.id = msg_id
+        self.chat_id = chat_id
+        self.message = text
+        self.media = SimpleNamespace(photo=SimpleNamespace(id=photo_id)) if photo_id else None
+        self.grouped_id = grouped_id
+        self.date = None
+
+def make_channel(channel_id, title):
+    """构造离线的频道实体"""
+    return types.Channel(
+        id=channel_id, title=title, photo=types.ChatPhotoEmpty(), date=None,
+        access_hash=channel_id * 7, broadcast=True
+    )
+
+SPAM_MESSAGES = [text for text in SAMPLE_MESSAGES if any(k in text for k in ("推广", "提款", "https://t.me"))]
+SHORT_MESSAGES = [text for text in SAMPLE_MESSAGES if len(text) <= 4]
+NORMAL_MESSAGES = [
+    text for text in SAMPLE_MESSAGES
+    if len(text) > 10 and text not in SPAM_MESSAGES and "http" not in text
+]
+
+# 内容质量过滤把非ASCII字符都计为表情，中文正文会因表情比例被过滤；
+# 流水线基准放宽这一项，其余过滤参数保持默认
+PIPELINE_FILTER_PROFILE = {"max_emoji_ratio": 1.0}
+
+PIPELINE_SCENARIOS = ("text", "photo", "album", "spam", "mixed", "flood")
+
+def build_stream(scenario, count, chat_id, seed=1):
+    """生成 count 个单元的合成消息流，每个单元是一条消息或一个相册
+    
+    返回 (单元列表, 预期转发的消息数)。
+    """
+    rng = random.Random(seed)
+    units = []
+    texts = []  # 之前的纯文本消息，用于生成重复内容
+    expected = 0
+    next_id = 1
+    
+    def make(text=None, photo=False, grouped_id=None):
+        nonlocal next_id
+        message = FakeMessage(next_id, chat_id, text, next_id if photo else None, grouped_id)
+        next_id += 1
+        return message
+    
+    for i in range(count):
+        kind = scenario
+        if scenario == "mixed":
+            kind = rng.choice(("text", "text", "photo", "album", "spam"))
+        elif scenario == "flood":
+            kind = "text"
+        
+        if kind == "text":
+            text = f"{rng.choice(NORMAL_MESSAGES)} #{i}"
+            units.append([make(text)])
+            texts.append(text)
+            expected += 1
+        elif kind == "photo":
+            units.append([make(f"图片说明 #{i}" if rng.random() < 0.5 else None, photo=True)])
+            expected += 1
+        elif kind == "album":
+            size = rng.randint(2, 10)
+            units.append([make(f"相册说明 #{i}" if j == 0 else None, photo=True, grouped_id=i + 1) for j in range(size)])
+            expected += size
+        else:
+            # 广告、无意义短消息、重复转发和正常消息的混合，只有正常消息会被转发
+            roll = rng.random()
+            if roll < 0.3:
+                text = rng.choice(SPAM_MESSAGES)
+            elif roll < 0.5:
+                text = rng.choice(SHORT_MESSAGES)
+            elif roll < 0.8 and texts:
+                # 重复之前的文本：已转发过的被去重，其余本来就会被过滤
+                text = rng.choice(texts)
+            else:
+                text = f"{rng.choice(NORMAL_MESSAGES)} #{i}"
+                expected += 1
+            units.append([make(text)])
+            texts.append(text)
+    return units, expected
+
+def make_sources(count):
+    """构造 count 个源频道"""
+    return [make_channel(1000000001 + i, f"基准源频道{i + 1}") for i in range(count)]
+
+async def run_pipeline(sources, stream, args, trace_memory=False, flood_rate=0.0, flood_seconds=0, offsets=None):
+    """在临时目录中把消息流送入 handle_message，返回吞吐、耗时和内存统计
+    
+    offsets 为每个单元相对开始时间的输入时刻（秒），None 表示尽快输入。
+    """
+    target = make_channel(1000000000, "基准目标频道")
+    
+    # 第一个账号按 flood_rate 的概率触发 FloodWait，其余账号正常发送
+    account_index = iter(range(args.accounts))
+    
+    def make_client(*client_args, **client_kwargs):
+        index = next(account_index)
+        return FakeTelegramClient(
+            latency=args.latency / 1000, flood_rate=flood_rate if index == 0 else 0.0,
+            flood_seconds=flood_seconds, seed=index
+        )
+    
+    original_client_class = TG_Realtime_Forward.TelegramClient
+    TG_Realtime_Forward.TelegramClient = make_client
+    try:
+        client_manager = ClientManager()
+    finally:
+        TG_Realtime_Forward.TelegramClient = original_client_class
+    for client_data in client_manager.clients:
+        for entity in sources + [target]:
+            client_data["client"].add_entity(entity)
+    client_manager.entity_owner = client_manager.clients[0]
+    
+    filter_manager = MessageFilter(PIPELINE_FILTER_PROFILE)
+    dedup_manager = DeduplicationManager()
+    forwarder = RealtimeForwarder(client_manager, filter_manager, dedup_manager, ForwardHistoryManager())
+    # 保留全部耗时样本，而不只是最近1000个
+    forwarder.pipeline_stats["latencies"] = deque()
+    routes = [{
+        "source": source,
+        "targets": [{"target": target, "filter": filter_manager, "dedup": dedup_manager, "dedup_scope": "global"}],
+    } for source in sources]
+    
+    forwarder.is_running = True
+    persistence_writer.start()
+    forwarder.start_workers()
+    await forwarder.setup_listeners(routes)
+    listener = client_manager.get_current_client()
+    
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    for index, unit in enumerate(stream):
+        if offsets is not None:
+            delay = started + offsets[index] - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        # 队列将满时等待工作协程，测量的是吞吐而不是丢弃
+        while forwarder.message_queue.qsize() >= Config.message_queue_size - 1:
+            await asyncio.sleep(0.001)
+        await listener.emit(unit)
+    await forwarder.message_queue.join()
+    # 等待合并窗口到期后已在发送中的批次，处理中标记在批次发送后释放
+    while forwarder.pending_batches or forwarder.inflight_hashes:
+        await forwarder.flush_all_batches()
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - started
+    
+    memory_growth = None
+    if trace_memory:
+        memory_growth = tracemalloc.get_traced_memory()[0] - memory_before
+        tracemalloc.stop()
+    
+    stats = forwarder.get_pipeline_stats()
+    fake_clients = [client_data["client"] for client_data in client_manager.clients]
+    await forwarder.stop_forwarding()
+    return {
+        "units": len(stream),
+        "messages": sum(len(unit) for unit in stream),
+        "elapsed": elapsed,
+        "latency_p50": stats["latency_p50"],
+        "latency_p99": stats["latency_p99"],
+        "forward_calls": sum(client.forward_calls for client in fake_clients),
+        "forwarded": sum(client.forwarded for client in fake_clients),
+        "flood_errors": sum(client.flood_errors for client in fake_clients),
+        "memory_growth": memory_growth,
+    }
+
+def run_pipeline_isolated(sources, stream, args, trace_memory=False, batch_window=None, **kwargs):
+    """在独立的临时目录和配置下运行一次流水线基准，batch_window 为 None 时使用 --batch-window"""
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir, override_config(
+        accounts=[
+            {"api_id": 1, "api_hash": "x", "session_name": f"bench_{i}", "enabled": True}
+            for i in range(args.accounts)
+        ],
+        enable_metrics=False,
+        enable_target_scan=False,
+        enable_gap_backfill=False,
+        event_capture_file=None,
+        enable_near_duplicate=False,
+        send_rate_per_account=1_000_000,
+        send_burst_per_account=1_000_000,
+        forward_batch_window=args.batch_window if batch_window is None else batch_window,
+    ):
+        os.chdir(workdir)
+        try:
+            return asyncio.run(run_pipeline(sources, stream, args, trace_memory, **kwargs))
+        finally:
+            os.chdir(original_cwd)
+
+def bench_pipeline(args):
+    """用模拟客户端驱动完整的接收、过滤、去重、转发和记录流程"""
+    scenarios = args.scenarios.split(",") if args.scenarios else PIPELINE_SCENARIOS
+    print_header(
+        f"转发流水线（每个场景 {args.messages:,} 个单元，{args.accounts} 个账号，"
+        f"模拟延迟 {args.latency}ms，合并窗口 {args.batch_window}s）"
+    )
+    print_pipeline_columns()
+    
+    sources = make_sources(1)
+    with quiet_logging():
+        for scenario in scenarios:
+            if scenario not in PIPELINE_SCENARIOS:
+                print(f"❌ 未知的场景: {scenario}（可选: {', '.join(PIPELINE_SCENARIOS)}）")
+                continue
+            stream, expected = build_stream(scenario, args.messages, utils.get_peer_id(sources[0]))
+            offsets = [index / args.rate for index in range(len(stream))] if args.rate else None
+            flood_rate = args.flood_rate if scenario == "flood" else 0.0
+            # flood 场景逐条发送，请求数足够多才会稳定触发 FloodWait
+            batch_window = 0 if scenario == "flood" else None
+            result = print_pipeline_result(
+                scenario, sources, stream, args, batch_window=batch_window,
+                flood_rate=flood_rate, flood_seconds=args.flood_seconds, offsets=offsets
+            )
+            # 转发数必须与合成数据的预期一致，FloodWait 后由其他账号补上
+            assert result["forwarded"] == expected, f"{scenario}: 转发 {result['forwarded']} 条，预期 {expected} 条"
+            if flood_rate:
+                assert result["flood_errors"] > 0, f"{scenario}: 没有触发 FloodWait"
+
+@contextmanager
+def quiet_logging():
+    """基准期间只输出错误日志"""
+    root_logger = logging.getLogger()
+    original_level = root_logger.level
+    root_logger.setLevel(logging.ERROR)
+    try:
+        yield
+    finally:
+        root_logger.setLevel(original_level)
+
+def print_pipeline_columns():
+    print(f"{'场景':<8} {'消息':>7} {'转发':>7} {'请求':>6} {'吞吐(条/秒)':>12} "
+          f"{'p50(ms)':>9} {'p99(ms)':>9} {'内存增长':>10} {'FloodWait':>10}")
+
+def print_pipeline_result(name, sources, stream, args, **kwargs):
+    """运行一次流水线基准并输出一行结果，返回吞吐测量的结果"""
+    # tracemalloc 会拖慢执行，吞吐和内存分两次测量
+    result = run_pipeline_isolated(sources, stream, args, **kwargs)
+    memory = run_pipeline_isolated(sources, stream, args, trace_memory=True, **kwargs)["memory_growth"]
+    print(
+        f"{name:<8} {result['messages']:>7} {result['forwarded']:>7} {result['forward_calls']:>6} "
+        f"{result['messages'] / result['elapsed']:>12.0f} "
+        f"{result['latency_p50'] * 1000:>9.2f} {result['latency_p99'] * 1000:>9.2f} "
+        f"{format_bytes(memory):>10} {result['flood_errors']:>10}"
+    )
+    return result
+
+# ============ 录制回放 ============
+def load_capture_stream(capture_file):
+    """读取录制文件，按来源映射到基准源频道，并把相册中连续的消息合并为一个单元
+    
+    返回 (源频道列表, 单元列表, 每个单元的原始接收时刻)。
+    """
+    messages = EventRecorder.load(capture_file)
+    chat_ids = list(OrderedDict.fromkeys(message.chat_id for message in messages))
+    sources = make_sources(len(chat_ids))
+    peer_ids = {chat_id: utils.get_peer_id(source) for chat_id, source in zip(chat_ids, sources)}
+    
+    units = []
+    for message in messages:
+        message.chat_id = peer_ids[message.chat_id]
+        previous = units[-1][0] if units else None
+        if (message.grouped_id and previous is not None
+                and previous.grouped_id == message.grouped_id and previous.chat_id == message.chat_id):
+            units[-1].append(message)
+        else:
+            units.append([message])
+    timestamps = [unit[0].timestamp for unit in units]
+    return sources, units, timestamps
+
+def bench_replay(args):
+    """将录制的真实消息流回放到完整流水线，按原始节奏或尽快输入"""
+    if not args.capture:
+        print_header("录制回放")
+        print("⏭  未指定录制文件，跳过（配置 EVENT_CAPTURE_FILE 录制后使用 --capture 指定）")
+        return
+    sources, stream, timestamps = load_capture_stream(args.capture)
+    if not stream:
+        print_header("录制回放")
+        print(f"⏭  录制文件 {args.capture} 中没有消息")
+        return
+    
+    duration = timestamps[-1] - timestamps[0]
+    pace = f"{args.speed}倍原始节奏" if args.speed else "尽快输入"
+    print_header(
+        f"录制回放（{args.capture}：{len(stream):,} 个单元，{len(sources)} 个源频道，"
+        f"原始时长 {duration:.1f}秒，{pace}）"
+    )
+    print_pipeline_columns()
+    
+    offsets = None
+    if args.speed:
+        offsets = [(timestamp - timestamps[0]) / args.speed for timestamp in timestamps]
+    with quiet_logging():
+        print_pipeline_result("replay", sources, stream, args, offsets=offsets)
+
+# ============ 主函数 ============
+BENCHMARKS = {
+    "history": bench_forward_history,
+    "dedup": bench_dedup_store,
+    "ad_filter": bench_ad_filter,
+    "meaningless": bench_meaningless_filter,
+    "near_duplicate": bench_near_duplicate,
+    "pipeline": bench_pipeline,
+    "replay": bench_replay,
+}
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="TG Realtime Forward 性能基准测试")
+    parser.add_argument("names", nargs="*", help=f"要运行的基准: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--dedup-entries", type=int, default=10_000_000,
+                        help="去重存储基准的条目数（默认1000万）")
+    parser.add_argument("--near-entries", type=int, default=1_000_000,
+                        help="近似重复检测基准的签名条数（默认100万）")
+    parser.add_argument("--scenarios", default="",
+                        help=f"流水线基准的场景，逗号分隔（默认全部: {','.join(PIPELINE_SCENARIOS)}）")
+    parser.add_argument("--messages", type=int, default=5000, help="流水线基准每个场景的单元数（默认5000）")
+    parser.add_argument("--accounts", type=int, default=3, help="流水线基准的模拟账号数（默认3）")
+    parser.add_argument("--latency", type=float, default=5, help="模拟 forward_messages 耗时（毫秒，默认5）")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="流水线基准的输入速率（单元/秒），0表示尽快输入（默认0）")
+    parser.add_argument("--batch-window", type=float, default=0.05,
+                        help="流水线基准的批量转发合并窗口（秒，默认0.05）")
+    parser.add_argument("--flood-rate", type=float, default=0.05,
+                        help="flood 场景中第一个账号触发 FloodWait 的概率（默认0.05）")
+    parser.add_argument("--flood-seconds", type=int, default=2,
+                        help="flood 场景中 FloodWaitError 要求等待的秒数（默认2）")
+    parser.add_argument("--capture", default="", help="回放基准的录制文件（由 EVENT_CAPTURE_FILE 生成）")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="回放速度：1表示按原始节奏，2表示两倍速，0表示尽快输入（默认0）")
+    args = parser.parse_args()
+
+    names = args.names or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        print(f"❌ 未知的基准: {', '.join(unknown)}")
+        sys.exit(1)
+
+    print("⏱  TG Realtime Forward 性能基准测试")
+    print("=" * 60)
+    for name in names:
+        BENCHMARKS[name](args)
+
+if __name__ == "__main__":
+    main()
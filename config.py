@@ -62,9 +62,29 @@ PRESET_SOURCE_CHANNELS = [
     -1001670294604,  # 源频道1
 ]
 
-# 目标频道配置 - 只支持单个目标频道
+# 目标频道配置 - 未配置 ROUTES 时使用的单个目标频道
 PRESET_TARGET_CHANNEL = -1001666667684  # 替换为您的目标频道ID
 
+# ============ 路由配置 ============
+# 路由表：每个源频道可以转发到一个或多个目标，每个目标使用自己的过滤配置和去重范围
+# 同一条消息只获取和计算一次哈希，再并发转发到所有匹配的目标
+# 为空时使用 PRESET_SOURCE_CHANNELS -> PRESET_TARGET_CHANNEL
+# 省略 dedup_scope 时每个目标单独去重；"global" 表示与未配置路由时共用去重历史
+ROUTES = [
+    # {
+    #     "sources": [-1001670294604, "@channel_username"],
+    #     "targets": [
+    #         -1001666667684,                                              # 默认过滤配置
+    #         {"target": -1001888888888, "filter": "strict", "dedup_scope": "strict"},
+    #     ],
+    # },
+]
+
+# 过滤配置：名称 -> 覆盖的过滤参数（参数名与下方过滤配置相同，小写）
+FILTER_PROFILES = {
+    # "strict": {"min_message_length": 20, "max_links_per_message": 0},
+}
+
 # ============ 实时转发配置 ============
 # 是否启用实时转发（如果为False，脚本将不会启动）
 ENABLE_REALTIME_FORWARD = True
@@ -84,6 +104,12 @@ MAX_RECONNECT_ATTEMPTS = 10
 # 重连延迟（秒）
 RECONNECT_DELAY = 60
 
+# 所有账号并发启动；单个账号启动超时（秒）后暂时停用，不阻塞其他账号
+CLIENT_START_TIMEOUT = 30
+
+# 启动失败账号的后台重试间隔（秒），重试成功后自动加入发送账号池
+CLIENT_START_RETRY_INTERVAL = 60
+
 # ============ 账号轮换配置 ============
 # 是否启用账号轮换
 ENABLE_ACCOUNT_ROTATION = False
@@ -97,13 +123,88 @@ ACCOUNT_DELAY = 5
 # 是否启用智能账号切换（自动跳过无法访问频道的账号）
 ENABLE_SMART_ACCOUNT_SWITCH = True
 
+# ============ 处理队列配置 ============
+# 新消息先进入有界队列，由多个工作协程并发过滤和转发，单个频道的突发消息不会阻塞其他频道
+# 待处理消息队列上限，队列满时丢弃新消息并计数
+MESSAGE_QUEUE_SIZE = 1000
+
+# 并发处理消息的工作协程数量
+WORKER_COUNT = 3
+
 # ============ 转发延迟配置 ============
 # 单条消息转发延迟（秒）
 DELAY_SINGLE = 1
 
-# 相册消息转发延迟（秒）
+# 相册消息转发延迟（秒），相册按 DELAY_GROUP/DELAY_SINGLE 倍消耗发送令牌
 DELAY_GROUP = 4
 
+# 是否相册整体转发（整个相册作为一个单元过滤、去重，并在一次请求中转发）
+ENABLE_ALBUM_FORWARD = True
+
+# ============ 批量转发配置 ============
+# 同一来源频道在短时间内通过过滤的消息合并为一次 forward_messages 请求，按消息ID顺序转发
+# 合并等待时间（秒），0表示每条消息单独转发
+FORWARD_BATCH_WINDOW = 1.0
+
+# 单次请求最多包含的消息数（Telegram上限为100），达到后立即发送
+FORWARD_BATCH_MAX_MESSAGES = 50
+
+# ============ 发送限流配置 ============
+# 每个账号使用一个令牌桶限流：空闲时累积令牌，可以立即连续发送；令牌耗尽后才按持续速率等待
+# 持续发送速率（次/秒），None表示按 1/DELAY_SINGLE 计算
+SEND_RATE_PER_ACCOUNT = None
+
+# 令牌桶容量：账号空闲后允许连续发送的次数
+SEND_BURST_PER_ACCOUNT = 5
+
+# ============ 发送账号池配置 ============
+# 所有可用账号同时发送，按剩余令牌最多、最久未使用的顺序选择账号，吞吐量随账号数量线性增长
+# 关闭时只使用当前账号发送，并按 ROTATION_INTERVAL 轮换
+ENABLE_SENDER_POOL = True
+
+# 每个账号同时进行中的转发请求上限
+MAX_INFLIGHT_PER_ACCOUNT = 2
+
+# FloodWait 不超过该秒数时由 Telethon 原地等待；超过时记录账号受限并立即换其他账号重试
+# 所有账号都受限时才等待最早解除的账号
+FLOOD_SLEEP_THRESHOLD = 0
+
+# 账号无法访问频道（如目标频道禁止写入）时暂停用其发送的秒数，到期后重新解析并再次尝试
+NO_ACCESS_RETRY_INTERVAL = 600
+
+# ============ 频道实体缓存配置 ============
+# 解析过的频道（ID和access_hash，按账号保存）写入本地缓存，热启动时无需联网解析
+ENTITY_CACHE_FILE = "entity_cache.json"
+
+# 启动时并发解析频道的数量上限，避免大量 ResolveUsername 请求触发 FloodWait
+ENTITY_RESOLVE_CONCURRENCY = 5
+
+# 缓存超过该秒数后，在转发启动后于后台重新验证；0表示不重新验证
+ENTITY_CACHE_TTL = 7 * 86400
+
+# ============ 后台持久化配置 ============
+# 去重日志、JSON历史、频道实体缓存和扫描进度由后台线程合并写入
+# 文件修改后最长等待多少秒写入
+PERSIST_FLUSH_INTERVAL = 0.5
+
+# 累计多少条记录后立即写入
+PERSIST_FLUSH_MAX_RECORDS = 200
+
+# ============ 指标监控配置 ============
+# 在本地提供 Prometheus 格式的 /metrics 接口
+ENABLE_METRICS = True
+
+# 监听地址，默认仅本机访问
+METRICS_HOST = "127.0.0.1"
+
+# 监听端口，被占用时只记录错误，不影响转发
+METRICS_PORT = 9108
+
+# ============ 事件录制配置 ============
+# 将收到的源频道消息（ID、文本、媒体类型和ID、grouped_id、时间）追加录制到 JSONL 文件，
+# 可用 python3 benchmark.py replay --capture 文件名 离线回放；None表示不录制
+EVENT_CAPTURE_FILE = None
+
 # ============ 文件配置 ============
 # 转发历史记录文件
 FORWARD_HISTORY_FILE = "forward_history.json"
@@ -114,6 +215,90 @@ DEDUP_HISTORY_FILE = "dedup_history.json"
 # 日志文件
 LOG_FILE = "tg_realtime_forward.log"
 
+# ============ 日志配置 ============
+# 日志级别，调试时改为 "DEBUG"
+LOG_LEVEL = "INFO"
+
+# 日志轮转方式: "size"（按大小）或 "time"（按时间）
+LOG_ROTATION = "size"
+
+# 按大小轮转时单个日志文件上限（字节）
+LOG_MAX_BYTES = 10 * 1024 * 1024
+
+# 按时间轮转的周期，取值同 TimedRotatingFileHandler 的 when，如 "midnight"、"H"
+LOG_ROTATE_WHEN = "midnight"
+
+# 保留的历史日志文件数
+LOG_BACKUP_COUNT = 7
+
+# 同类高频日志（如过滤消息）每个周期最多输出条数，0表示不限制
+LOG_SAMPLE_LIMIT = 20
+
+# 高频日志采样周期（秒）
+LOG_SAMPLE_INTERVAL = 60
+
+# ============ 转发历史存储配置 ============
+# 存储后端: "sqlite"（推荐，增量写入）或 "json"（旧格式，每条消息重写整个文件）
+# 使用sqlite时，首次启动会自动从 FORWARD_HISTORY_FILE 迁移旧的JSON历史
+FORWARD_HISTORY_BACKEND = "sqlite"
+
+# SQLite数据库文件
+FORWARD_HISTORY_DB = "forward_history.db"
+
+# 每累计多少条转发记录提交一次
+HISTORY_COMMIT_BATCH_SIZE = 50
+
+# 最长提交间隔（秒）
+HISTORY_COMMIT_INTERVAL = 5
+
+# ============ 断线补发配置 ============
+# 启动和重连后补发每个源频道在断线期间遗漏的消息
+ENABLE_GAP_BACKFILL = True
+
+# 补发速率上限（条/秒），避免挤占实时消息
+BACKFILL_RATE = 5
+
+# 每个源频道单次最多补发的消息数，None表示不限制
+BACKFILL_MAX_MESSAGES = 1000
+
+# ============ 去重历史存储配置 ============
+# 存储模式:
+#   "journal" - 快照+追加日志，每条消息只追加一行（默认）
+#   "binary"  - 紧凑二进制摘要表，每条约14字节，启动时直接内存映射，适合千万级历史
+#   "json"    - 旧格式，每条消息重写整个文件
+# journal模式下新记录写入 DEDUP_HISTORY_FILE + ".journal"，定期压缩进快照文件
+# 注意：binary模式使用独立的摘要格式，切换模式不会迁移已有去重历史
+DEDUP_STORAGE_MODE = "journal"
+
+# binary模式的摘要表文件
+DEDUP_DIGEST_FILE = "dedup_history.bin"
+
+# 日志压缩间隔（秒）
+DEDUP_COMPACT_INTERVAL = 600
+
+# 日志累计多少条记录后提前压缩
+DEDUP_COMPACT_THRESHOLD = 5000
+
+# 去重历史保留天数，超过此时间的记录会被淘汰，None表示永久保留
+DEDUP_RETENTION_DAYS = 30
+
+# 去重历史最大条数，超出时淘汰最旧的记录，None表示不限制
+DEDUP_MAX_ENTRIES = 500000
+
+# ============ 近似重复检测配置 ============
+# 用 MinHash 识别只差一个链接、表情或结尾签名的重复文本（只针对纯文本消息）
+# 签名的保留期和条数上限与 DEDUP_RETENTION_DAYS / DEDUP_MAX_ENTRIES 一致
+ENABLE_NEAR_DUPLICATE = False
+
+# 估计的 Jaccard 相似度（0~1）不低于该值视为重复，越小越宽松
+NEAR_DUPLICATE_THRESHOLD = 0.8
+
+# 去掉链接和符号后短于该长度的文本只做精确去重
+NEAR_DUPLICATE_MIN_LENGTH = 20
+
+# MinHash 签名快照文件，新签名追加到同名的 .journal 文件
+NEAR_DUPLICATE_FILE = "dedup_minhash.bin"
+
 # ============ 广告过滤配置 ============
 # 是否启用广告过滤
 ENABLE_AD_FILTER = False
@@ -124,7 +309,11 @@ AD_KEYWORDS = [
     # 可以根据需要添加更多关键词
 ]
 
-# 广告正则模式
+# 广告正则模式，可写成 (正则, 角色) 指定用途：
+#   "count_links" - 统计链接数量，超过 MAX_LINKS_PER_MESSAGE 时判定为广告
+#   "reject"      - 只要匹配即判定为广告
+# 只写正则时，链接正则 r'https?://[^\s]+' 默认为 "count_links"，其余为 "reject"
+# 关键词和正则在首次过滤时编译一次，之后只在配置变化时重新编译
 AD_PATTERNS = [
    # r'https?://[^\s]+',  # 链接检测
    # r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}',  # 邮箱检测
@@ -168,9 +357,18 @@ MAX_EMOJI_RATIO = 1
 # 是否启用内容去重
 ENABLE_CONTENT_DEDUPLICATION = True
 
+# 启动后是否在后台扫描目标频道已有消息并写入去重历史（实时转发不等待扫描完成）
+ENABLE_TARGET_SCAN = True
+
 # 目标频道扫描范围（条消息），None表示扫描所有
 TARGET_CHANNEL_SCAN_LIMIT = None
 
+# 扫描进度文件，中断后从上次位置继续；扫描完成后再次启动只扫描新消息
+SCAN_CHECKPOINT_FILE = "scan_checkpoint.json"
+
+# 每扫描多少条消息批量写入去重历史并保存进度
+SCAN_BATCH_SIZE = 500
+
 # 是否显示详细的去重日志
 VERBOSE_DEDUP_LOGGING = False
 
@@ -197,11 +395,22 @@ def validate_config():
             errors.append(f"账号 {i+1} 缺少 session_name")
     
     # 检查频道配置
-    if not PRESET_SOURCE_CHANNELS:
-        errors.append("未配置源频道")
-    
-    if not PRESET_TARGET_CHANNEL:
-        errors.append("未配置目标频道")
+    if ROUTES:
+        for i, route in enumerate(ROUTES):
+            if not route.get("sources"):
+                errors.append(f"路由 {i+1} 未配置源频道")
+            if not route.get("targets"):
+                errors.append(f"路由 {i+1} 未配置目标频道")
+            for target in route.get("targets", []):
+                profile = target.get("filter") if isinstance(target, dict) else None
+                if profile and profile not in FILTER_PROFILES:
+                    errors.append(f"路由 {i+1} 使用了未定义的过滤配置: {profile}")
+    else:
+        if not PRESET_SOURCE_CHANNELS:
+            errors.append("未配置源频道")
+        
+        if not PRESET_TARGET_CHANNEL:
+            errors.append("未配置目标频道")
     
     # 检查数值配置
     if ROTATION_INTERVAL <= 0:
@@ -220,6 +429,8 @@ def export_config_template():
         "accounts": ACCOUNTS,
         "source_channels": PRESET_SOURCE_CHANNELS,
         "target_channel": PRESET_TARGET_CHANNEL,
+        "routes": ROUTES,
+        "filter_profiles": FILTER_PROFILES,
         "realtime_config": {
             "enable_realtime_forward": ENABLE_REALTIME_FORWARD,
             "forward_only_new_messages": FORWARD_ONLY_NEW_MESSAGES,
@@ -236,11 +447,15 @@ def export_config_template():
         },
         "delays": {
             "delay_single": DELAY_SINGLE,
-            "delay_group": DELAY_GROUP
+            "delay_group": DELAY_GROUP,
+            "enable_album_forward": ENABLE_ALBUM_FORWARD
         },
         "files": {
             "forward_history_file": FORWARD_HISTORY_FILE,
+            "forward_history_backend": FORWARD_HISTORY_BACKEND,
+            "forward_history_db": FORWARD_HISTORY_DB,
             "dedup_history_file": DEDUP_HISTORY_FILE,
+            "dedup_storage_mode": DEDUP_STORAGE_MODE,
             "log_file": LOG_FILE
         },
         "filter_config": {